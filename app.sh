@@ -7,5 +7,10 @@ python ./src/etl/create_tables.py
 # Perform ETL
 python ./src/etl/etl.py
 
+# # To reload while an app is already serving the database, build the new
+# # tables in a shadow schema and swap them in instead of the two steps above
+# python ./src/etl/create_tables.py --blue-green
+# python ./src/etl/etl.py --blue-green
+
 # Launch Dash app
 python ./src/app/app.py
@@ -4,21 +4,262 @@ This module controls the Dash app that can be viewed from the browser.
 Author: M. Sanchez-Ayala (04/14/2020)
 """
 
+import os
+import sys
+import threading
 import dash
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
-import plotly.graph_objs as go
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
+import pandas as pd
+from flask import Flask, Response, jsonify, request, stream_with_context
+from flask_compress import Compress
 import app_helpers
+import cube
+import departures
+import export
+import live
+import rolling
 from consts import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+
 
 ### LOAD DATA ###
 
 
-tod_df = app_helpers.create_df()
-time_series_fig = app_helpers.time_series_main(tod_df)
+# Boot from the snapshot built by the last ETL load when it is up to date.
+# Its figures cover the default view, so no data has to be processed here.
+with metrics.stage('load_snapshot', prefix='app'):
+    manifest = app_helpers.fresh_snapshot()
+    figures = app_helpers.snapshot.read_figures(manifest) if manifest else None
+
+_data = {}
+
+def get_tod_df():
+    """
+    Returns
+    -------
+    [Pandas df] trips_time, loaded on first use from the snapshot if there is
+    one, otherwise from the database.
+    """
+    if 'tod_df' not in _data:
+        with metrics.stage('create_df', prefix='app'):
+            _data['tod_df'] = app_helpers.sort_df(app_helpers.load_df(manifest))
+    return _data['tod_df']
+
+def get_signatures_df():
+    """
+    Returns
+    -------
+    [Pandas df] route_signatures, from the snapshot or queried on first use.
+    """
+    if 'signatures_df' not in _data:
+        if manifest and 'signatures' in manifest:
+            _data['signatures_df'] = pd.DataFrame(
+                manifest['signatures'], columns = ['signature_id', 'signature']
+            )
+        else:
+            _data['signatures_df'] = app_helpers.create_signatures_df()
+    return _data['signatures_df']
+
+def get_cube():
+    """
+    Returns
+    -------
+    [dict] cube.build() of all of trips_time, whose cached slices serve the
+    breakdowns and heatmap of any routes over the whole date range. Rebuilt
+    when the data changes, which drops the cached slices of the old data.
+    """
+    if 'cube' not in _data or _data['cube']['version'] != data_version:
+        with metrics.stage('build_cube', prefix='app'):
+            _data['cube'] = cube.build(get_tod_df(), version = data_version)
+    return _data['cube']
+
+def get_trend(route_id, window):
+    """
+    Returns
+    -------
+    [rolling.RollingSeries] Rolling statistics over the last `window`
+    seconds at every trip of `route_id`. Series are kept between callbacks
+    and only fed the trips they haven't seen, so trips loaded since don't
+    recompute the history.
+    """
+    with trends_lock:
+        df = get_tod_df()
+        first, last = app_helpers.route_block(df, route_id)
+        key = (route_id, window)
+        series = _data.setdefault('trends', {}).get(key, rolling.RollingSeries(window))
+        _data['trends'][key] = rolling.update(
+            series,
+            df['departure_ts'].values[first:last],
+            df['duration'].values[first:last].astype('int64')
+        )
+        return _data['trends'][key]
+
+# Callbacks run in threads; a series is fed by one at a time
+trends_lock = threading.Lock()
+
+def get_view(start_date, end_date, route_ids, snapshot_figures):
+    """
+    Returns
+    -------
+    [Pandas df] trips_time restricted to the dates and routes picked in the
+    filters, or None when the filters are at their defaults and the
+    snapshot's precomputed figures can be served instead.
+
+    Parameters
+    ----------
+    snapshot_figures: [dict] `figures` as the callback read it. Streamed
+    trips set it to None from another thread, so callbacks read it once.
+    """
+    if snapshot_figures and not start_date and not end_date \
+            and set(route_ids or []) == set(default_route_ids):
+        return None
+
+    return app_helpers.slice_df(
+        get_tod_df(),
+        app_helpers.date_to_ts(start_date),
+        app_helpers.date_to_ts(end_date, days = 1),
+        route_ids or []
+    )
+
+def get_departures():
+    """
+    Returns
+    -------
+    [dict] departures.build_table() of departure_slots, from the snapshot or
+    queried on first use.
+    """
+    if 'departures' not in _data:
+        if manifest and 'departure_slots' in manifest:
+            slots_df = pd.DataFrame(
+                manifest['departure_slots'],
+                columns = ['route_id', 'day', 'slot', 'num_trips', 'p50', 'p90']
+            )
+        else:
+            slots_df = app_helpers.create_departure_slots_df()
+        _data['departures'] = departures.build_table(slots_df)
+    return _data['departures']
+
+def get_disruptions():
+    """
+    Returns
+    -------
+    [Pandas df] create_disruptions_df(), from the snapshot or queried on
+    first use.
+    """
+    if 'disruptions' not in _data:
+        if manifest and 'disruptions' in manifest:
+            _data['disruptions'] = pd.DataFrame(
+                manifest['disruptions'],
+                columns = ['route_id', 'kind', 'started_ts', 'ended_ts', 'num_trips',
+                           'peak_ts', 'duration', 'expected', 'signature']
+            )
+        else:
+            _data['disruptions'] = app_helpers.create_disruptions_df()
+    return _data['disruptions']
+
+def apply_streamed_trips(payloads):
+    """
+    Adds the trips streamed into the database since they were loaded (see
+    live.py) to the cached trips, and drops what was built from the old
+    ones: the cube, the snapshot's figures and, if a trip has a new
+    route signature, the signatures. Trend lines just take in the new trips,
+    and the disruptions they flagged are read again.
+
+    Parameters
+    ----------
+    payloads: [list] Notifications from src/etl/stream.py. Empty when the
+    listener has just (re)connected, and trips of any route may have been
+    loaded while it wasn't listening.
+    """
+    global data_version, figures
+
+    if payloads:
+        route_ids = sorted(set(route_id for payload in payloads for route_id in payload['route_ids']))
+    else:
+        route_ids = None
+    with metrics.stage('apply_streamed_trips', prefix='app'):
+        df, new_df = app_helpers.append_new_trips(get_tod_df(), route_ids)
+    if new_df.empty:
+        return
+
+    _data['tod_df'] = df
+    if not new_df['signature_id'].dropna().isin(get_signatures_df()['signature_id']).all():
+        _data['signatures_df'] = app_helpers.create_signatures_df()
+    # The default view is now drawn from the data, not the snapshot
+    figures = None
+    # New ETags, and the cube is rebuilt on next use
+    if payloads:
+        data_version = payloads[-1]['load_token']
+    else:
+        data_version = app_helpers.latest_load_token() or data_version
+    _data['disruptions'] = app_helpers.create_disruptions_df()
+    metrics.inc('app_streamed_trips_total', len(new_df))
+    print('{} streamed trips added for routes {}'.format(
+        len(new_df), ', '.join(sorted(new_df['route_id'].unique()))
+    ))
+
+def preload():
+    """
+    Loads the trips and builds the cube from them. Called by wsgi.py in the
+    gunicorn master, so the workers it forks share both instead of each
+    building its own on first use.
+    """
+    df = get_tod_df()
+    get_cube()
+    if manifest:
+        unshared = app_helpers.unshared_columns(df, manifest)
+        if unshared:
+            print('Snapshot columns copied into memory: {}'.format(', '.join(unshared)))
+
+def start_live_updates():
+    """
+    Starts listening for streamed trips if LIVE_UPDATES=1. Called once per
+    serving process: below for the development server, and by
+    gunicorn.conf.py in each worker, since threads don't survive the fork.
+    """
+    if os.environ.get('LIVE_UPDATES') == '1':
+        live.start(apply_streamed_trips)
+
+# Identifies the data being served, for the departures endpoint's ETags
+if manifest:
+    data_version = manifest.get('load_token') or manifest['path']
+else:
+    data_version = app_helpers.latest_load_token() or 'unversioned'
+
+# Date range and routes for the filters
+if manifest and 'route_ids' in manifest:
+    extent = manifest
+else:
+    extent = app_helpers.data_extent(get_tod_df())
+default_route_ids = app_helpers.default_route_ids(extent['route_ids'])
+
+if manifest and 'routes' in manifest:
+    routes = manifest['routes']
+else:
+    routes = app_helpers.create_routes_df().values.tolist()
+route_labels = {route[0]: app_helpers.route_label(route) for route in routes}
+
+# Resolves map clicks to the nearest routes; the tables are small
+if manifest and 'locations' in manifest:
+    locations = manifest['locations']
+else:
+    locations = app_helpers.create_locations_df().values.tolist()
+location_index = app_helpers.build_location_index(locations, routes)
+route_map_fig = app_helpers.plot_route_map(location_index)
+
+# Percentiles come from the stored sketches, a few KB whatever the history
+if figures:
+    percentiles_fig = figures['percentiles']
+else:
+    percentiles_fig = app_helpers.percentiles_main(
+        app_helpers.create_sketches_df(), default_route_ids
+    )
 
 
 ### APP ###
@@ -35,8 +276,9 @@ navbar = dbc.NavbarSimple(
 This dashboard serves to compare travel times at a glance. You can visualize
 different statistics below!
 
-Note: "Starting location A" implies that the trip describes going from location A
-to location B and vice versa.
+Pick the routes to compare in the filter at the top. A route is a trip from
+one location to another by one mode of transport, e.g. "A: A to B (transit)"
+describes going from location A to location B by transit.
                 """)
                 ),
                 dbc.ModalFooter(
@@ -66,13 +308,61 @@ body = dbc.Container(
                 'padding-top':'15px'
             }
         ),
+        dbc.Row(
+            [
+                dcc.DatePickerRange(
+                    id = 'date_range',
+                    min_date_allowed = pd.to_datetime(extent['min_departure_ts'], unit = 's').date(),
+                    max_date_allowed = pd.to_datetime(extent['max_departure_ts'], unit = 's').date(),
+                    initial_visible_month = pd.to_datetime(extent['max_departure_ts'], unit = 's').date(),
+                    clearable = True
+                ),
+                dcc.Dropdown(
+                    id = 'route_filter',
+                    options = [
+                        {'label': route_labels.get(route_id, route_id), 'value': route_id}
+                        for route_id in extent['route_ids']
+                    ],
+                    value = default_route_ids,
+                    multi = True,
+                    placeholder = 'Routes',
+                    style = {'min-width': '300px', 'padding-left': '15px'}
+                ),
+            ],
+            justify='center'
+        ),
+        dbc.Row(
+            dcc.Graph(
+                id = 'route_map',
+                figure = route_map_fig,
+                style = {'width':'100%'}
+            )
+        ),
         dbc.Row(
             dcc.Graph(
                 id='time_series',
-                figure = time_series_fig,
                 style = {'width':'100%'}
             )
         ),
+        dbc.Row(
+            [
+                dcc.Dropdown(
+                    id = 'trend_window',
+                    options = trend_windows,
+                    value = None,
+                    placeholder = 'Trend window',
+                    style = {'width': '200px'}
+                ),
+                dcc.Checklist(
+                    id = 'trend_stats',
+                    options = trend_stat_options,
+                    value = ['median'],
+                    labelStyle = {'display': 'inline-block', 'padding-left': '15px'}
+                ),
+            ],
+            justify='center',
+            align='center'
+        ),
         dbc.Row(
             dcc.Dropdown(
                 id = 'stats_dropdown',
@@ -82,6 +372,9 @@ body = dbc.Container(
             ),
 
         ),
+        # Breakdown data for every statistic; the figures are drawn from it
+        # in the browser by assets/dashboard.js
+        dcc.Store(id = 'stats_store'),
         dbc.Row(
             dcc.Graph(
                 id ='hour_breakdown',
@@ -109,32 +402,215 @@ body = dbc.Container(
                 )
             ]
         ),
+        dbc.Row(
+            dcc.Graph(
+                id = 'heatmap',
+                style = {'width':'100%'}
+            )
+        ),
+        dbc.Row(
+            dcc.Graph(
+                id = 'route_choice',
+                style = {'width':'100%'}
+            )
+        ),
+        dbc.Row(
+            dcc.Graph(
+                id = 'percentiles',
+                figure = percentiles_fig,
+                style = {'width':'100%'}
+            )
+        ),
     ]
 )
 
-app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+# Responses are compressed with brotli for browsers that accept it, else
+# gzip. Dash would only use gzip, so compression is set up here instead. A
+# middling brotli level keeps per-callback compression time small.
+server = Flask(__name__)
+server.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+server.config['COMPRESS_BR_LEVEL'] = 5
+Compress(server)
+app = dash.Dash(__name__, server=server, external_stylesheets=[dbc.themes.BOOTSTRAP], compress=False)
 app.layout = html.Div([navbar, body])
 
-@app.callback(
+@app.server.route('/metrics')
+def prometheus_metrics():
+    """
+    Exposes callback latency and other app metrics to Prometheus.
+    """
+    return Response(metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.server.route('/api/departures')
+@metrics.timed('app_api', endpoint='departures')
+def departure_advice():
+    """
+    Recommends when to leave. Query parameters:
+
+        route: route code, e.g. A
+        day: ISO weekday, 1 (Monday) to 7 (Sunday)
+        start, end: departure window as HH:MM; may run past midnight
+        stat: p50 (default) for the quickest typical trip, or p90 for the
+              quickest trip to count on
+
+    e.g. /api/departures?route=A&day=1&start=07:00&end=09:00
+
+    Responses carry an ETag tied to the loaded data, so clients and proxies
+    can revalidate with If-None-Match and get a 304 until the next load.
+    """
+    try:
+        route_id = request.args['route']
+        day = int(request.args['day'])
+        start = departures.parse_time(request.args['start'])
+        end = departures.parse_time(request.args['end'])
+        stat = request.args.get('stat', 'p50')
+        best = departures.best_slot(get_departures(), route_id, day, start, end, stat)
+    except KeyError as e:
+        return jsonify(error = 'Unknown or missing parameter {}'.format(e)), 400
+    except ValueError as e:
+        return jsonify(error = str(e)), 400
+
+    if best is None:
+        return jsonify(error = 'No trips recorded in that window'), 404
+
+    return app_helpers.revalidate(jsonify(best), data_version, request)
+
+@app.server.route('/api/export')
+@metrics.timed('app_api', endpoint='export')
+def export_trips():
+    """
+    Streams trips for analysis. Query parameters, all optional:
+
+        format: csv (default), ndjson or parquet
+        route: route code to export; repeat for several, e.g. route=A&route=B.
+               Every route when left out.
+        start, end: first and last departure date to export, as YYYY-MM-DD
+        steps: 1 for one row per step of each trip, with the line ridden
+
+    e.g. /api/export?format=ndjson&route=A&start=2020-04-01&end=2020-04-30
+
+    Rows are read and sent in batches, in the order they were loaded, so
+    any amount of data can be exported in bounded memory.
+    """
+    fmt = request.args.get('format', 'csv')
+    try:
+        chunks = export.stream(
+            app_helpers.open_connection,
+            fmt,
+            route_ids = request.args.getlist('route'),
+            start_ts = app_helpers.date_to_ts(request.args.get('start')),
+            end_ts = app_helpers.date_to_ts(request.args.get('end'), days = 1),
+            steps = request.args.get('steps') == '1'
+        )
+    except ValueError as e:
+        return jsonify(error = str(e)), 400
+
+    mimetype, extension = export.formats[fmt]
+    return Response(
+        stream_with_context(chunks),
+        mimetype = mimetype,
+        headers = {'Content-Disposition': 'attachment; filename=trips.{}'.format(extension)}
+    )
+
+app.clientside_callback(
+    ClientsideFunction(namespace = 'dashboard', function_name = 'toggle_modal'),
     Output("modal", "is_open"),
     [Input("learn_more", "n_clicks"), Input("close", "n_clicks")],
     [State("modal", "is_open")],
 )
-def toggle_modal(n1, n2, is_open):
-    if n1 or n2:
-        return not is_open
-    return is_open
 
 @app.callback(
-    [dash.dependencies.Output('hour_breakdown', 'figure'),
-     dash.dependencies.Output('day_breakdown', 'figure'),
-     dash.dependencies.Output('is_weekday_breakdown', 'figure')],
-    [dash.dependencies.Input('stats_dropdown', 'value')]
+    Output('route_filter', 'value'),
+    [Input('route_map', 'clickData')]
+)
+@metrics.timed('app_callback', callback='select_routes_on_map')
+def select_routes_on_map(click_data):
+    """
+    Selects the routes starting nearest to where the map was clicked.
+    """
+    if not click_data:
+        raise PreventUpdate
+
+    point = click_data['points'][0]
+    nearest = app_helpers.spatial.nearest_routes(location_index, point['lat'], point['lon'])
+    route_ids = [route['route_id'] for route in nearest if route['route_id'] in extent['route_ids']]
+    if not route_ids:
+        raise PreventUpdate
+    return route_ids
+
+filter_inputs = [
+    Input('date_range', 'start_date'),
+    Input('date_range', 'end_date'),
+    Input('route_filter', 'value')
+]
+
+@app.callback(
+    Output('time_series', 'figure'),
+    filter_inputs + [Input('trend_window', 'value'), Input('trend_stats', 'value')]
+)
+@metrics.timed('app_callback', callback='update_time_series')
+def update_time_series(start_date, end_date, route_ids, window, stats):
+    """
+    Plots the durations in view with the disruptions flagged in them, and
+    rolling statistics over `window` seconds as trend lines if one is
+    picked.
+    """
+    start_ts = app_helpers.date_to_ts(start_date)
+    end_ts = app_helpers.date_to_ts(end_date, days = 1)
+    snapshot_figures = figures
+    view = get_view(start_date, end_date, route_ids, snapshot_figures)
+    if view is None:
+        # Already marked with the snapshot's disruptions
+        fig = snapshot_figures['time_series']
+        if not window or not stats:
+            return fig
+        # Shared by every session, so the trends go on a copy
+        fig = dict(fig, data = list(fig['data']))
+    else:
+        fig = app_helpers.time_series_main(view)
+        app_helpers.add_disruptions(fig, get_disruptions(), start_ts, end_ts)
+
+    if window and stats:
+        # Same order as the routes' traces, which skip routes not in view
+        trends = []
+        for route_id in sorted(route_ids or []):
+            trend = get_trend(route_id, window).slice(start_ts, end_ts)
+            if len(trend['departure_ts']):
+                trends.append((len(trends), route_id, trend))
+        window_labels = {option['value']: option['label'] for option in trend_windows}
+        app_helpers.add_trends(fig, trends, stats, window_labels[window])
+    return fig
+
+@app.callback(
+    Output('stats_store', 'data'),
+    filter_inputs
+)
+@metrics.timed('app_callback', callback='update_stats_store')
+def update_stats_store(start_date, end_date, route_ids):
+    """
+    Sends the breakdown, heatmap and route choice data for every statistic
+    at once, so the browser can switch statistics on its own.
+    """
+    snapshot_figures = figures
+    view = get_view(start_date, end_date, route_ids, snapshot_figures)
+    if view is None:
+        return snapshot_figures['stats']
+    # Over the whole date range, the breakdowns roll up from the cached cube
+    if not start_date and not end_date:
+        return app_helpers.stats_payload(view, get_signatures_df(), get_cube())
+    return app_helpers.stats_payload(view, get_signatures_df())
+
+app.clientside_callback(
+    ClientsideFunction(namespace = 'dashboard', function_name = 'stats_figures'),
+    [Output('hour_breakdown', 'figure'),
+     Output('day_breakdown', 'figure'),
+     Output('is_weekday_breakdown', 'figure'),
+     Output('route_choice', 'figure'),
+     Output('heatmap', 'figure')],
+    [Input('stats_dropdown', 'value'), Input('stats_store', 'data')]
 )
-def update_hour_breakdown(stat):
-    figs = app_helpers.stats_main(tod_df, stat)
-    return figs['hour'], figs['day'], figs['is_weekday']
 
 
 if __name__ == '__main__':
+    start_live_updates()
     app.run_server(host='0.0.0.0', port=8050, debug=True)
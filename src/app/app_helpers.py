@@ -6,12 +6,28 @@ Dash.
 Author: M. Sanchez-Ayala (04/14/2020)
 """
 
+import base64
+import functools
+import hashlib
+import json
+import os
+import sys
+import numpy as np
 import psycopg2
 import pandas as pd
 from pandas.io.sql import read_sql_query
 import plotly.graph_objects as go
 from consts import *
-from sql_queries import trips_time_select
+from sql_queries import trips_time_select, route_signatures_select, latest_load_select
+from sql_queries import trips_time_since_select
+from sql_queries import duration_sketches_select, departure_slots_select, routes_select
+from sql_queries import locations_select, disruptions_select
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import cube
+import snapshot
+import spatial
+from sketches import DDSketch
 
 
 ### ALL-PURPOSE PROCESSING ###
@@ -33,28 +49,298 @@ def open_connection():
     return conn
 
 
-def create_df():
+def create_df(query = trips_time_select, params = None):
     """
     Returns
     -------
     tod_df: [Pandas df] of the query inner joining trips and time tables.
 
     Also closes connection to db.
-    """
 
-    query = trips_time_select
+    Parameters
+    ----------
+    query: [str] SELECT statement to run. Defaults to all of trips_time.
+
+    params: [dict] Parameters of `query`, if it has any.
+    """
 
     # Connect to db
     conn = open_connection()
 
     # generate time of day df
-    tod_df = read_sql_query(query, conn)
+    tod_df = read_sql_query(query, conn, params = params)
 
     # Don't want connection to linger
     conn.close()
 
     return tod_df
 
+def append_new_trips(df, route_ids = None):
+    """
+    Returns
+    -------
+    Tuple of `df` with the trips of `route_ids` it doesn't have yet, sorted
+    as sort_df(), and those new trips. Each route's trips are fetched from
+    just after the last one `df` has of it, so trips whose notifications
+    were missed come along too.
+
+    Parameters
+    ----------
+    df: [Pandas df] Output of sort_df().
+
+    route_ids: [list] Routes to fetch trips of. None fetches every route.
+    """
+    if route_ids is None:
+        route_ids = create_routes_df()['route_id'].tolist()
+
+    departure_ts = df['departure_ts'].values
+    since = []
+    for route_id in route_ids:
+        first, last = route_block(df, route_id)
+        since.append(int(departure_ts[last - 1]) if last > first else -1)
+
+    new_df = create_df(trips_time_since_select, {'route_ids': list(route_ids), 'since': since})
+    if new_df.empty:
+        return df, new_df
+
+    merged = pd.concat([df, new_df[df.columns]], ignore_index = True)
+    return sort_df(merged), new_df
+
+
+def latest_load_token():
+    """
+    Returns
+    -------
+    [str] Token of the most recent ETL load, or None if the database cannot
+    be reached or has no record of loads.
+    """
+    try:
+        conn = open_connection()
+    except psycopg2.Error:
+        return None
+
+    try:
+        cur = conn.cursor()
+        cur.execute(latest_load_select)
+        row = cur.fetchone()
+    except psycopg2.Error:
+        row = None
+    finally:
+        conn.close()
+
+    return str(row[0]) if row else None
+
+
+def fresh_snapshot(folder = snapshot.default_folder):
+    """
+    Returns
+    -------
+    [dict] Manifest of the snapshot in `folder` if it was built from the
+    latest load, otherwise None. If the database is unreachable the snapshot
+    is used as is, since it is the best data available.
+    """
+    manifest = snapshot.read_manifest(folder)
+    if manifest is None:
+        return None
+
+    token = latest_load_token()
+    if token is not None and token != manifest.get('load_token'):
+        return None
+
+    return manifest
+
+
+def load_df(manifest = None):
+    """
+    Returns
+    -------
+    tod_df: [Pandas df] Same data as create_df(). When the manifest of a
+    snapshot is given, the frame is built from its memory-mapped columns
+    instead of querying the database, each its own block over the mapping,
+    so processes reading the snapshot share its pages rather than copy
+    them. Text columns can't be mapped as Python strings; they hold one
+    string per distinct value instead.
+    """
+    if manifest is None:
+        return create_df()
+
+    columns = snapshot.read_columns(manifest)
+    for column, values in columns.items():
+        if values.dtype.kind == 'U':
+            uniques, inverse = np.unique(values, return_inverse = True)
+            columns[column] = uniques.astype(object)[inverse]
+    return pd.DataFrame(columns, columns = manifest['columns'], copy = False)
+
+
+def unshared_columns(df, manifest):
+    """
+    Returns
+    -------
+    [list] Columns of `df`, other than text, that no longer share memory
+    with the snapshot described by `manifest`, e.g. because pandas merged
+    them into a copy.
+    """
+    unshared = []
+    for column, values in snapshot.read_columns(manifest).items():
+        if values.dtype.kind == 'U':
+            continue
+        # Views of a mapping lead back to it through their bases
+        base = df[column].values
+        while base is not None and not isinstance(base, np.memmap):
+            base = getattr(base, 'base', None)
+        if base is None or os.path.realpath(base.filename) != os.path.realpath(values.filename):
+            unshared.append(column)
+    return unshared
+
+
+def sort_df(df):
+    """
+    Returns
+    -------
+    [Pandas df] `df` ordered by route_id, then departure_ts, with a fresh
+    RangeIndex, so each route is one contiguous block slice_df() can binary
+    search. Returned unchanged if already sorted.
+    """
+    route_ids = df['route_id'].values
+    departure_ts = df['departure_ts'].values
+    same_route = route_ids[1:] == route_ids[:-1]
+    if df['route_id'].is_monotonic_increasing \
+            and (departure_ts[1:] >= departure_ts[:-1])[same_route].all():
+        return df
+    return df.sort_values(['route_id', 'departure_ts'], kind = 'mergesort').reset_index(drop = True)
+
+
+def route_block(df, route_id):
+    """
+    Returns
+    -------
+    Tuple of the first and one past the last row of `route_id` in `df`,
+    found by binary search. Both are equal if the route has no rows.
+
+    Parameters
+    ----------
+    df: [Pandas df] Output of sort_df().
+    """
+    route_ids = df['route_id'].values
+    return (
+        route_ids.searchsorted(route_id, side = 'left'),
+        route_ids.searchsorted(route_id, side = 'right')
+    )
+
+
+def slice_df(df, start_ts = None, end_ts = None, route_ids = None):
+    """
+    Returns
+    -------
+    [Pandas df] Rows of `df` on one of `route_ids` departing in
+    [start_ts, end_ts). Each route's block, and the time window within it,
+    are found by binary search, so the cost depends on the size of the
+    result rather than of `df`.
+
+    Parameters
+    ----------
+    df: [Pandas df] Output of sort_df().
+
+    start_ts, end_ts: [int] Unix timestamps. None means unbounded.
+
+    route_ids: [list] route_id values to keep. None keeps all.
+    """
+    if route_ids is None:
+        route_ids = df['route_id'].unique()
+
+    departure_ts = df['departure_ts'].values
+    rows = []
+    for route_id in sorted(route_ids):
+        first, last = route_block(df, route_id)
+        block_ts = departure_ts[first:last]
+        start = 0 if start_ts is None else block_ts.searchsorted(start_ts, side = 'left')
+        end = len(block_ts) if end_ts is None else block_ts.searchsorted(end_ts, side = 'left')
+        rows.append(np.arange(first + start, first + end))
+
+    if not rows:
+        return df.iloc[:0]
+    return take_rows(df, np.concatenate(rows))
+
+
+def take_rows(df, rows):
+    """
+    Returns
+    -------
+    [Pandas df] df.iloc[rows], taken column by column. Taking rows of a
+    whole frame makes pandas merge its columns of the same dtype into one
+    block, which would copy the snapshot's mapped columns in load_df().
+    """
+    return pd.DataFrame(
+        {column: df[column].values[rows] for column in df.columns},
+        index = df.index[rows],
+        columns = df.columns
+    )
+
+
+def data_extent(df):
+    """
+    Returns
+    -------
+    [dict] First and last departure_ts and the sorted route_ids in `df`,
+    used to set up the dashboard's filters.
+    """
+    return {
+        'min_departure_ts': int(df['departure_ts'].min()),
+        'max_departure_ts': int(df['departure_ts'].max()),
+        'route_ids': sorted(df['route_id'].unique().tolist()),
+    }
+
+
+def default_route_ids(route_ids):
+    """
+    Returns
+    -------
+    [list] The routes selected when the dashboard opens: the first
+    max_default_routes of the sorted `route_ids`.
+    """
+    return sorted(route_ids)[:max_default_routes]
+
+
+def create_routes_df():
+    """
+    Returns
+    -------
+    [Pandas df] One row per route with columns route_id, origin,
+    destination and mode, e.g. ('A', 'A', 'B', 'transit').
+    """
+    return create_df(routes_select)
+
+
+def route_label(route):
+    """
+    Returns
+    -------
+    [str] Label of one row of create_routes_df() for the route filter, e.g.
+    'A: A to B (transit)'.
+    """
+    route_id, origin, destination, mode = route
+    if destination is None:
+        return f'{route_id}: from {origin} ({mode})'
+    return f'{route_id}: {origin} to {destination} ({mode})'
+
+
+def date_to_ts(date, days = 0):
+    """
+    Returns
+    -------
+    [int] Unix timestamp of midnight on `date` plus `days`, or None if no
+    date is given.
+
+    Parameters
+    ----------
+    date: [str] Date as sent by dcc.DatePickerRange, e.g. '2020-04-13'. Dates
+    are read in the same UTC clock process_df() displays.
+    """
+    if not date:
+        return None
+    return int((pd.Timestamp(date[:10]) + pd.Timedelta(days = days)).timestamp())
+
+
 def convert_to_day(num):
     """
     Helper for process_df()
@@ -98,7 +384,7 @@ def process_df(df):
     pro_df = df.copy()
 
     # Convert ts to datetime
-    pro_df['departure_ts'] = pro_df['departure_ts'].map(lambda ts: pd.to_datetime(ts, unit = 's'))
+    pro_df['departure_ts'] = pd.to_datetime(pro_df['departure_ts'], unit = 's')
 
     # Set index and sort
     pro_df.set_index('departure_ts', inplace = True)
@@ -114,18 +400,23 @@ def split_df(df):
     """
     Returns
     -------
-    List of two dataframes. The inputted df is split based on start_location_id
-    for easier Plotly graphing.
+    List of dataframes, one per route_id in sorted order, for easier Plotly
+    graphing.
 
     Parameters
     ----------
-    df: [Pandas dataframe] time_series dataframe with both start_location_ids. Assumes
-    the index is already set to departure_ts.
+    df: [Pandas dataframe] Any dataframe with a route_id column.
     """
-    df_a = df[df['start_location_id'] == 'A']
-    df_b = df[df['start_location_id'] == 'B']
+    return [route_df for _, route_df in df.groupby('route_id', sort = True)]
 
-    return [df_a, df_b]
+
+def route_color(i):
+    """
+    Returns
+    -------
+    [str] Color of the `i`th route in a figure.
+    """
+    return graph_colors[i % len(graph_colors)]
 
 
 ### TIME SERIES UTILS ###
@@ -154,11 +445,15 @@ def plot_time_series(dfs, subset = None):
     # Add one trace for the data in each df
     for i, df in enumerate(dfs):
 
+        # A route can be filtered out of the current view
+        if df.empty:
+            continue
+
         fig.add_trace(go.Scatter(
             x = df.index,
             y = df.duration,
-            line_color = graph_colors[i],
-            name = df['start_location_id'].values[0] # Legend labels for this trace
+            line_color = route_color(i),
+            name = df['route_id'].values[0] # Legend labels for this trace
 
         ))
 
@@ -166,7 +461,7 @@ def plot_time_series(dfs, subset = None):
         title = f'Trip Duration for {subset}' if subset else 'Trip Durations',
         yaxis_title = 'Duration (minutes)',
         xaxis_title = 'Departure Time',
-        legend_title = 'Starting Location',
+        legend_title = 'Route',
         title_x = title_x_pos,
         title_xanchor = title_x_anchor,
         template = 'plotly_white'
@@ -179,12 +474,166 @@ def time_series_main(df):
     """
     Plots time series from raw dataframe from SQL
     """
-    pro_df = process_df(df)
+    return time_series_figure(df)
+
+
+@functools.lru_cache(maxsize = None)
+def time_series_layout(subset = None):
+    """
+    Returns
+    -------
+    [dict] JSON layout of plot_time_series(), validated by plotly once per
+    process. Shared, so copy it before changing it.
+    """
+    return plot_time_series([], subset).to_plotly_json()['layout']
+
+
+def route_blocks(route_ids):
+    """
+    Yields the first and one past the last row of each route in
+    `route_ids`, a sorted array, by binary search.
+    """
+    first = 0
+    while first < len(route_ids):
+        last = route_ids.searchsorted(route_ids[first], side = 'right')
+        yield first, last
+        first = last
+
+
+def time_series_figure(df, subset = None):
+    """
+    Returns
+    -------
+    [dict] The figure plot_time_series() makes of `df`, serializing to the
+    same JSON, built straight from its columns. plotly validates and copies
+    every value of a go.Figure's traces, which for a year of trips costs
+    more than the rest of the callback.
+
+    Parameters
+    ----------
+    df: [Pandas df] raw dataframe from SQL query
+
+    subset: [str] As in plot_time_series().
+    """
+    df = sort_df(df)
+    route_ids = df['route_id'].values
+    durations = df['duration'].values
+    # ISO strings, as plotly would write the datetimes, but made in one go
+    x = np.datetime_as_string(df['departure_ts'].values.astype('datetime64[s]'))
+
+    data = []
+    for i, (first, last) in enumerate(route_blocks(route_ids)):
+        data.append({
+            'line': {'color': route_color(i)},
+            'name': route_ids[first],
+            'x': x[first:last],
+            'y': durations[first:last],
+            'type': 'scatter'
+        })
+
+    return {'data': data, 'layout': dict(time_series_layout(subset))}
+
+
+def add_trends(fig, trends, stats, window_label):
+    """
+    Adds a line for each statistic in `stats` of each route in `trends` to
+    a time series from time_series_figure(), in the route's color.
+
+    Parameters
+    ----------
+    trends: [list] Tuples of the index of the route's trace, its route_id
+    and rolling.RollingSeries.slice() of its trips in view.
+
+    stats: [list] Any of rolling.stats.
+
+    window_label: [str] Label of the window, e.g. '1 day'.
+    """
+    labels = {option['value']: option['label'] for option in trend_stat_options}
+    for i, route_id, trend in trends:
+        # ISO strings, as plotly would write the datetimes, but made in one go
+        x = np.datetime_as_string(trend['departure_ts'].astype('datetime64[s]'))
+        for stat in stats:
+            fig['data'].append({
+                'legendgroup': route_id,
+                'line': {'color': route_color(i), 'dash': trend_dashes[stat], 'width': 2},
+                'name': '{} {} ({})'.format(route_id, labels[stat].lower(), window_label),
+                'x': x,
+                'y': trend[stat],
+                'type': 'scatter'
+            })
+    return fig
+
+
+def create_disruptions_df():
+    """
+    Returns
+    -------
+    [Pandas df] disruptions, with route_id as the route code, in order of
+    their worst trip.
+    """
+    return create_df(disruptions_select)
+
+
+def describe_disruption(row):
+    """
+    Returns
+    -------
+    [str] Hover text of a disruption, a row of create_disruptions_df().
+    """
+    started = pd.to_datetime(row.started_ts, unit = 's').strftime('%a %b %d %H:%M')
+    if pd.isnull(row.ended_ts):
+        until = 'ongoing'
+    else:
+        until = 'until ' + pd.to_datetime(row.ended_ts, unit = 's').strftime('%H:%M')
+    if row.kind == 'detour':
+        what = 'Detour via {}'.format(row.signature)
+    else:
+        what = 'Slow service'
+    if pd.isnull(row.expected):
+        took = '{} min'.format(row.duration)
+    else:
+        took = '{} min, usually {:.0f}'.format(row.duration, row.expected)
+    return '{} on {}<br>{}, {}, {} trips<br>Worst trip: {}'.format(
+        what, row.route_id, started, until, row.num_trips, took
+    )
 
-    plot_dfs = split_df(pro_df)
 
-    fig = plot_time_series(plot_dfs)
+def add_disruptions(fig, disruptions_df, start_ts = None, end_ts = None):
+    """
+    Marks the worst trip of each disruption on a time series from
+    time_series_figure(), in its route's color, for the routes it plots and
+    the disruptions departing in [start_ts, end_ts). None means unbounded.
 
+    Parameters
+    ----------
+    disruptions_df: [Pandas df] Output of create_disruptions_df().
+    """
+    colors = {trace['name']: trace['line']['color'] for trace in fig['data']}
+    in_view = disruptions_df['route_id'].isin(colors)
+    if start_ts is not None:
+        in_view &= disruptions_df['peak_ts'] >= start_ts
+    if end_ts is not None:
+        in_view &= disruptions_df['peak_ts'] < end_ts
+
+    for kind, name, symbol in [('slow', 'Slow service', 'x'), ('detour', 'Detour', 'diamond')]:
+        df = disruptions_df[in_view & (disruptions_df['kind'] == kind)]
+        if df.empty:
+            continue
+        fig['data'].append({
+            'hovertemplate': '%{text}<extra></extra>',
+            'marker': {
+                'color': [colors[route_id] for route_id in df['route_id']],
+                'line': {'color': 'black', 'width': 1},
+                'size': 11,
+                'symbol': symbol
+            },
+            'mode': 'markers',
+            'name': name,
+            'text': [describe_disruption(row) for row in df.itertuples()],
+            'x': np.datetime_as_string(df['peak_ts'].values.astype('datetime64[s]')),
+            'y': df['duration'].values,
+            'type': 'scatter'
+        })
     return fig
 
 
@@ -201,16 +650,16 @@ def agg_column(df, column, stats):
     ----------
     df: [Pandas df] A processed df. Should be output of process_df()
 
-    column: [str] Name of column to group by after location id
+    column: [str] Name of column to group by after route id
 
     stats: [str, list] Name of statistic(s) to compute.
     """
     if type(stats) == list:
-        sort_cols = 'start_location_id'
+        sort_cols = 'route_id'
     elif type(stats) == str:
-        sort_cols = ['start_location_id','duration']
+        sort_cols = ['route_id','duration']
 
-    df = df.groupby(['start_location_id',column])
+    df = df.groupby(['route_id',column])
     return df.agg(stats).reset_index().sort_values(sort_cols)
 
 
@@ -226,11 +675,14 @@ def plot_stats(dfs, column, stats):
     # Add one trace for the data in each df
     for i, df in enumerate(dfs):
 
+        if df.empty:
+            continue
+
         fig.add_trace(go.Bar(
             x = df[column],
             y = df.duration.astype(int),
-            marker_color = graph_colors[i],
-            name = df['start_location_id'].values[0] # Legend labels for this trace
+            marker_color = route_color(i),
+            name = df['route_id'].values[0] # Legend labels for this trace
         ))
 
     fig.update_layout(
@@ -239,7 +691,7 @@ def plot_stats(dfs, column, stats):
         xaxis_title = column.title(),
         title_x = title_x_pos,
         title_xanchor = title_x_anchor,
-        legend_title = 'Starting Location',
+        legend_title = 'Route',
         template = 'plotly_white'
     )
 
@@ -250,22 +702,635 @@ def stats_main(df, stats):
     """
     Returns
     -------
-    Dict of plotly graph objects figures for each breakdown plot for the given
-    data and statistic to display.
+    Dict of figures for each breakdown plot for the given data and
+    statistic to display.
+
+    Parameters
+    ----------
+    df: [Pandas df] raw dataframe from SQL query
+
+    stats: [str] statistic to display
+    """
+    return {column: stats_figure(df, column, stats) for column in ['hour', 'day', 'is_weekday']}
+
+
+@functools.lru_cache(maxsize = None)
+def stats_layout(column, stats):
+    """
+    Returns
+    -------
+    [dict] JSON layout of plot_stats(), validated by plotly once per
+    process. Shared, so copy it before changing it.
+    """
+    return plot_stats([], column, stats).to_plotly_json()['layout']
+
+
+def stats_figure(df, column, stats):
+    """
+    Returns
+    -------
+    [dict] The figure plot_stats() makes of agg_column() of `df`,
+    serializing to the same JSON, built straight from the aggregated
+    columns.
 
     Parameters
     ----------
     df: [Pandas df] raw dataframe from SQL query
 
+    column: [str] Name of column to group by after route id
+
     stats: [str] statistic to display
     """
-    pro_df = process_df(df)
+    stats_df = df.groupby(['route_id', column])['duration'].agg(stats).reset_index()
+    if column == 'day':
+        stats_df['day'] = stats_df['day'].map(convert_to_day)
+    # agg_column() sorts the groups, in order of `column`, by duration
+    stats_df = stats_df.sort_values(['route_id', 'duration', column], kind = 'mergesort')
+
+    route_ids = stats_df['route_id'].values
+    x = stats_df[column].values
+    durations = stats_df['duration'].values.astype(int)
+
+    data = []
+    for i, (first, last) in enumerate(route_blocks(route_ids)):
+        data.append({
+            'marker': {'color': route_color(i)},
+            'name': route_ids[first],
+            'x': x[first:last],
+            'y': durations[first:last],
+            'type': 'bar'
+        })
+
+    return {'data': data, 'layout': dict(stats_layout(column, stats))}
+
+
+def plot_heatmap(z, stats, days = (), hours = ()):
+    """
+    Returns
+    -------
+    Plotly graph objects fig with a heatmap of trip duration by hour of day
+    and day of week.
+
+    Parameters
+    ----------
+    z: [list] One row per hour of the statistic on each day, or None for an
+    empty figure.
+
+    stats: [str] statistic displayed
+
+    days, hours: [list] Labels of the columns and rows of `z`.
+    """
+    fig = go.Figure()
+
+    if z is not None:
+        fig.add_trace(go.Heatmap(
+            x = list(days),
+            y = list(hours),
+            z = z,
+            colorscale = heatmap_colorscale,
+            colorbar_title = 'Minutes',
+            hoverongaps = False
+        ))
+
+    fig.update_layout(
+        title = f'{stats.title()} Trip Duration by Hour and Day',
+        yaxis_title = 'Hour',
+        xaxis_title = 'Day',
+        title_x = title_x_pos,
+        title_xanchor = title_x_anchor,
+        template = 'plotly_white'
+    )
+
+    return fig
+
+
+### ROUTE CHOICE UTILS ###
+
+
+def create_signatures_df():
+    """
+    Returns
+    -------
+    [Pandas df] The route_signatures dictionary with columns signature_id and
+    signature, e.g. (1, 'L>G>E').
+    """
+    return create_df(route_signatures_select)
+
+
+def agg_route_choice(df, signatures, stats, top_n = 6):
+    """
+    Returns
+    -------
+    [Pandas df] `stats` of duration and number of trips for each
+    route_id and route signature, keeping the `top_n` most common
+    signatures of each route.
+
+    Parameters
+    ----------
+    df: [Pandas df] raw dataframe from SQL query
+
+    signatures: [Pandas df] Output of create_signatures_df()
+
+    stats: [str, list] Name of statistic(s) to compute. A single statistic
+    is named duration in the output.
+
+    top_n: [int] Number of signatures to keep per route.
+    """
+    # Grouping on the small integer id is cheap; labels are joined afterwards.
+    # Trips whose lines aren't known have a NULL id and drop out here.
+    grouped = df.groupby(['route_id', 'signature_id'])['duration']
+    if type(stats) == list:
+        choice_df = grouped.agg(stats + ['count']).reset_index()
+        choice_df.rename(columns = {'count': 'num_trips'}, inplace = True)
+    else:
+        choice_df = grouped.agg([stats, 'count']).reset_index()
+        choice_df.rename(columns = {stats: 'duration', 'count': 'num_trips'}, inplace = True)
+
+    choice_df = choice_df.sort_values(['route_id', 'num_trips'], ascending = [True, False])
+    choice_df = choice_df.groupby('route_id').head(top_n)
+
+    choice_df = choice_df.merge(signatures, on = 'signature_id', how = 'left')
+    choice_df['signature'] = choice_df['signature'].replace('', 'Walk only')
+
+    return choice_df
+
+
+def plot_route_choice(dfs, stats):
+    """
+    Returns
+    -------
+    Plotly graph objects fig with a bar chart of trip duration for each route
+    signature, labelled with the number of trips that took it.
+    """
+    fig = go.Figure()
+
+    for i, df in enumerate(dfs):
+
+        if df.empty:
+            continue
+
+        fig.add_trace(go.Bar(
+            x = df['signature'],
+            y = df.duration.astype(int),
+            text = df['num_trips'].map(lambda n: f'{n} trips'),
+            marker_color = route_color(i),
+            name = df['route_id'].values[0]
+        ))
+
+    fig.update_layout(
+        title = f'{stats.title()} Trip Duration by Route Choice',
+        yaxis_title = 'Duration (minutes)',
+        xaxis_title = 'Lines Taken',
+        title_x = title_x_pos,
+        title_xanchor = title_x_anchor,
+        legend_title = 'Route',
+        template = 'plotly_white'
+    )
+
+    return fig
+
+
+def route_choice_main(df, signatures, stats):
+    """
+    Returns
+    -------
+    Plotly figure comparing trip duration across route signatures.
+
+    Parameters
+    ----------
+    df: [Pandas df] raw dataframe from SQL query
+
+    signatures: [Pandas df] Output of create_signatures_df()
+
+    stats: [str] statistic to display
+    """
+    choice_df = agg_route_choice(df, signatures, stats)
+    choice_dfs = split_df(choice_df)
+
+    return plot_route_choice(choice_dfs, stats)
+
+
+### CLIENT-SIDE FIGURE UTILS ###
+
+
+def encode_array(values, dtype):
+    """
+    Returns
+    -------
+    [str] `values` as base64 of little-endian `dtype` numbers, e.g. '<i2',
+    which the browser reads back as a typed array (assets/dashboard.js).
+    """
+    return base64.b64encode(np.asarray(values).astype(dtype).tobytes()).decode()
+
+
+def figure_layout(fig):
+    """
+    Returns
+    -------
+    [dict] The JSON layout of `fig` without its template, which
+    stats_payload() sends only once.
+    """
+    layout = json.loads(fig.to_json())['layout']
+    layout.pop('template', None)
+    return layout
+
+
+@functools.lru_cache(maxsize = None)
+def payload_layouts():
+    """
+    Returns
+    -------
+    Tuple of the plotly_white template, for each figure in stats_payload()
+    and each statistic its layout without the template, and the style of
+    the heatmap trace. These never depend on the data, so they are built
+    once per process.
+    """
+    stats = [option['value'] for option in dropdown_options]
+    template = json.loads(go.Figure(layout = dict(template = 'plotly_white')).to_json())
+
+    plots = {
+        column: lambda stat, column = column: plot_stats([], column, stat)
+        for column in ['hour', 'day', 'is_weekday']
+    }
+    plots['route_choice'] = lambda stat: plot_route_choice([], stat)
+    plots['heatmap'] = lambda stat: plot_heatmap(None, stat)
+
+    layouts = {
+        name: {stat: figure_layout(plot(stat)) for stat in stats}
+        for name, plot in plots.items()
+    }
+
+    heatmap_trace = json.loads(plot_heatmap([[0]], 'mean').to_json())['data'][0]
+    for key in ['x', 'y', 'z']:
+        heatmap_trace.pop(key)
+
+    return template['layout']['template'], layouts, heatmap_trace
+
+
+def breakdown_figure(trips_cube, column, route_ids, stats, layouts):
+    """
+    Helper for stats_payload()
+
+    Returns
+    -------
+    [dict] Categories and, per statistic, layout and bars of the breakdown
+    figure by `column`, rolled up from `trips_cube`. Each route's bars are
+    ordered by the statistic.
+    """
+    aggregates = cube.slice_cube(trips_cube, ('route_id', column), route_ids)
+    counts = aggregates['count']
+    labels = aggregates['labels'][1]
+    if column == 'day':
+        labels = [convert_to_day(day) for day in labels]
+
+    present = [i for i in range(len(labels)) if counts[:, i].sum() > 0]
+    categories = sorted(labels[i] for i in present)
+    codes = np.array([
+        categories.index(label) if label in categories else 0 for label in labels
+    ])
+
+    figure = {'categories': categories, 'stats': {}}
+    for stat in stats:
+        values = cube.statistic(aggregates, stat)
+        bars = []
+        for i in range(len(route_ids)):
+            cells = np.flatnonzero(counts[i] > 0)
+            cells = cells[np.argsort(values[i, cells], kind = 'stable')]
+            bars.append({
+                'x': encode_array(codes[cells], '<u2'),
+                'y': encode_array(values[i, cells].astype(int), '<i2'),
+            })
+        figure['stats'][stat] = {'layout': layouts[column][stat], 'bars': bars}
+    return figure
+
+
+def heatmap_figure(trips_cube, route_ids, stats, layouts, trace):
+    """
+    Helper for stats_payload()
+
+    Returns
+    -------
+    [dict] Days (columns), hours (rows) and trace style of the heatmap and,
+    per statistic, its layout and z values for all of `route_ids` together:
+    one row per hour as base64 float32, NaN where there were no trips.
+    """
+    aggregates = cube.slice_cube(trips_cube, ('day', 'hour'), route_ids)
+    figure = {
+        'x': [convert_to_day(day) for day in aggregates['labels'][0]],
+        'y': aggregates['labels'][1],
+        'trace': trace,
+        'stats': {},
+    }
+    for stat in stats:
+        z = np.round(cube.statistic(aggregates, stat).T, 1)
+        figure['stats'][stat] = {'layout': layouts['heatmap'][stat], 'z': encode_array(z, '<f4')}
+    return figure
+
+
+def stats_payload(df, signatures, trips_cube = None):
+    """
+    Returns
+    -------
+    [dict] Everything the browser needs to draw the breakdown, heatmap and
+    route choice figures for every statistic in the dropdown, so changing
+    the statistic needs no request. For each bar figure there are its
+    categories (x values) and, per statistic, its layout and one set of bars
+    per route: x as indexes into the categories, y in whole minutes and, for
+    route choice, the number of trips, all as base64 typed arrays. The
+    plotly template they share is included once.
+
+    Parameters
+    ----------
+    df: [Pandas df] raw dataframe from SQL query
+
+    signatures: [Pandas df] Output of create_signatures_df()
+
+    trips_cube: [dict] cube.build() of data including `df`, whose cached
+    slices can serve the breakdowns. Built from `df` when None.
+    """
+    stats = [option['value'] for option in dropdown_options]
+    route_ids = sorted(df['route_id'].unique().tolist())
+    if trips_cube is None:
+        trips_cube = cube.build(df)
+
+    template, layouts, heatmap_trace = payload_layouts()
+    payload = {
+        'routes': route_ids,
+        'colors': [route_color(i) for i in range(len(route_ids))],
+        'template': template,
+        'figures': {},
+    }
 
-    figs = {}
     for column in ['hour', 'day', 'is_weekday']:
-        stats_df = agg_column(pro_df, column, stats)
-        stats_dfs = split_df(stats_df)
-        fig = plot_stats(stats_dfs, column, stats)
-        figs[column] = fig
+        payload['figures'][column] = breakdown_figure(
+            trips_cube, column, route_ids, stats, layouts
+        )
+    payload['figures']['heatmap'] = heatmap_figure(
+        trips_cube, route_ids, stats, layouts, heatmap_trace
+    )
+
+    # Route signatures aren't a dimension of the cube
+    choice_df = agg_route_choice(df, signatures, stats)
+    categories = sorted(choice_df['signature'].unique().tolist())
+    codes = choice_df['signature'].map({category: i for i, category in enumerate(categories)})
+    figure = {'categories': categories, 'stats': {}}
+    for stat in stats:
+        bars = []
+        for route_id in route_ids:
+            route_df = choice_df[choice_df['route_id'] == route_id]
+            bars.append({
+                'x': encode_array(codes[route_df.index], '<u2'),
+                'y': encode_array(route_df[stat].astype(int), '<i2'),
+                'trips': encode_array(route_df['num_trips'], '<i4'),
+            })
+        figure['stats'][stat] = {'layout': layouts['route_choice'][stat], 'bars': bars}
+    payload['figures']['route_choice'] = figure
+
+    return payload
+
+
+def create_departure_slots_df():
+    """
+    Returns
+    -------
+    [Pandas df] departure_slots, with route_id as the route code.
+    """
+    return create_df(departure_slots_select)
+
+
+def revalidate(response, version, request, max_age = 300):
+    """
+    Returns
+    -------
+    The Flask `response`, tagged with an ETag for `version` of the data and
+    the query string of `request` and cacheable for `max_age` seconds. It
+    is turned into an empty 304 if the request's If-None-Match already
+    holds that ETag.
+    """
+    response.set_etag(hashlib.md5(
+        (version + request.query_string.decode()).encode()
+    ).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+### DURATION PERCENTILE UTILS ###
+
+
+def create_sketches_df():
+    """
+    Returns
+    -------
+    [Pandas df] duration_sketches with columns route_id,
+    hour_of_week, num_trips and sketch (as a dict).
+    """
+    return create_df(duration_sketches_select)
+
+
+def sketch_percentiles(sketches_df, quantiles = (0.5, 0.9, 0.99)):
+    """
+    Returns
+    -------
+    [Pandas df] One row per route_id and hour_of_week with a column
+    per quantile, e.g. p50, p90, p99, read from the stored sketches.
+
+    Parameters
+    ----------
+    sketches_df: [Pandas df] Output of create_sketches_df()
+
+    quantiles: [tuple] Quantiles to compute, between 0 and 1.
+    """
+    records = []
+    for row in sketches_df.itertuples(index = False):
+        sketch = DDSketch.from_dict(row.sketch)
+        record = {
+            'route_id': row.route_id,
+            'hour_of_week': row.hour_of_week,
+            'num_trips': row.num_trips,
+        }
+        for q in quantiles:
+            record['p{}'.format(int(q * 100))] = sketch.quantile(q)
+        records.append(record)
+
+    return pd.DataFrame(records).sort_values(['route_id', 'hour_of_week'])
+
+
+def plot_percentiles(dfs):
+    """
+    Returns
+    -------
+    Plotly graph objects fig with the median trip duration for each hour of
+    the week, a shaded band up to the 90th percentile and a dotted line at
+    the 99th percentile. The width of the band is how much extra time to
+    allow to arrive on time 9 times out of 10.
+    """
+    fig = go.Figure()
+
+    for i, df in enumerate(dfs):
+
+        if df.empty:
+            continue
+
+        route_id = df['route_id'].values[0]
+
+        fig.add_trace(go.Scatter(
+            x = df.hour_of_week,
+            y = df.p50,
+            line_color = route_color(i),
+            name = f'{route_id} median',
+            legendgroup = route_id
+        ))
+        fig.add_trace(go.Scatter(
+            x = df.hour_of_week,
+            y = df.p90,
+            line_color = route_color(i),
+            line_width = 0,
+            fill = 'tonexty',
+            name = f'{route_id} 90th percentile',
+            legendgroup = route_id
+        ))
+        fig.add_trace(go.Scatter(
+            x = df.hour_of_week,
+            y = df.p99,
+            line_color = route_color(i),
+            line_dash = 'dot',
+            name = f'{route_id} 99th percentile',
+            legendgroup = route_id
+        ))
+
+    fig.update_layout(
+        title = 'Trip Duration Percentiles by Hour of Week',
+        yaxis_title = 'Duration (minutes)',
+        xaxis_title = 'Hour of Week',
+        xaxis = dict(
+            tickvals = [day * 24 for day in range(7)],
+            ticktext = [convert_to_day(day) for day in range(1, 8)]
+        ),
+        title_x = title_x_pos,
+        title_xanchor = title_x_anchor,
+        legend_title = 'Route',
+        template = 'plotly_white'
+    )
+
+    return fig
+
+
+def percentiles_main(sketches_df, route_ids = None):
+    """
+    Returns
+    -------
+    Plotly figure of duration percentiles per hour of the week, built from
+    the stored sketches alone.
+
+    Parameters
+    ----------
+    sketches_df: [Pandas df] Output of create_sketches_df()
+
+    route_ids: [list] Routes to show. None shows all.
+    """
+    if route_ids is not None:
+        sketches_df = sketches_df[sketches_df['route_id'].isin(route_ids)]
+    percentiles_df = sketch_percentiles(sketches_df)
+    percentiles_dfs = split_df(percentiles_df)
+
+    return plot_percentiles(percentiles_dfs)
+
+
+### ROUTE MAP UTILS ###
+
+
+def create_locations_df():
+    """
+    Returns
+    -------
+    [Pandas df] locations with columns location_code, latitude and longitude.
+    """
+    return create_df(locations_select)
+
+
+def build_location_index(locations, routes):
+    """
+    Returns
+    -------
+    [dict] spatial index of `locations` that answers which routes start
+    nearest to a point.
+
+    Parameters
+    ----------
+    locations: [list] Rows of create_locations_df().
+
+    routes: [list] Rows of create_routes_df().
+    """
+    index = spatial.new_index()
+    spatial.add_locations(index, locations)
+    spatial.add_routes(index, routes)
+    return index
+
+
+def plot_route_map(index, grid_size = 25, margin = 0.02):
+    """
+    Returns
+    -------
+    Plotly graph objects fig with a map of the tracked locations. An almost
+    transparent grid of points covers the area so that a click anywhere on
+    it reports where it landed.
 
-    return figs
+    Parameters
+    ----------
+    index: [dict] Output of build_location_index().
+
+    grid_size: [int] Number of clickable points along each side.
+
+    margin: [float] Degrees of map shown around the outermost locations.
+    """
+    fig = go.Figure()
+    if not index['coords']:
+        return fig
+
+    codes = list(index['coords'])
+    lats = [index['coords'][code][0] for code in codes]
+    lngs = [index['coords'][code][1] for code in codes]
+
+    min_lat, max_lat = min(lats) - margin, max(lats) + margin
+    min_lng, max_lng = min(lngs) - margin, max(lngs) + margin
+    steps = [i / (grid_size - 1) for i in range(grid_size)]
+    fig.add_trace(go.Scattermapbox(
+        lat = [min_lat + (max_lat - min_lat) * a for a in steps for b in steps],
+        lon = [min_lng + (max_lng - min_lng) * b for a in steps for b in steps],
+        mode = 'markers',
+        marker = dict(size = 30, opacity = 0.01, color = colors['blue']),
+        hoverinfo = 'none',
+        showlegend = False
+    ))
+
+    fig.add_trace(go.Scattermapbox(
+        lat = lats,
+        lon = lngs,
+        mode = 'markers+text',
+        marker = dict(size = 12, color = colors['red']),
+        text = codes,
+        textposition = 'top right',
+        hovertext = [
+            f'{code}: routes ' + ', '.join(index['routes'][code])
+            if code in index['routes'] else f'{code}: no routes start here'
+            for code in codes
+        ],
+        hoverinfo = 'text',
+        name = 'Locations'
+    ))
+
+    fig.update_layout(
+        title = 'Click the map to compare the routes starting nearest',
+        title_x = title_x_pos,
+        title_xanchor = title_x_anchor,
+        mapbox = dict(
+            style = 'open-street-map',
+            center = dict(lat = sum(lats) / len(lats), lon = sum(lngs) / len(lngs)),
+            zoom = 11
+        ),
+        margin = dict(l = 0, r = 0, b = 0),
+        showlegend = False
+    )
+
+    return fig
@@ -0,0 +1,83 @@
+/*
+ * Clientside callbacks for app.py. They run in the browser, so toggling the
+ * modal or switching the statistic of the breakdown, heatmap and route
+ * choice figures needs no request to the server.
+ */
+
+// Reads base64 from app_helpers.encode_array() back as an array of numbers
+function decodeArray(text, ArrayType) {
+    var binary = atob(text);
+    var bytes = new Uint8Array(binary.length);
+    for (var i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return Array.from(new ArrayType(bytes.buffer));
+}
+
+// Builds the plotly figure `name` of app_helpers.stats_payload() for `stat`
+function buildFigure(payload, name, stat) {
+    var figure = payload.figures[name];
+    var stats = figure.stats[stat];
+
+    var data = stats.bars.map(function(bar, i) {
+        var trace = {
+            type: 'bar',
+            x: decodeArray(bar.x, Uint16Array).map(function(code) {
+                return figure.categories[code];
+            }),
+            y: decodeArray(bar.y, Int16Array),
+            marker: {color: payload.colors[i]},
+            name: payload.routes[i]
+        };
+        if (bar.trips) {
+            trace.text = decodeArray(bar.trips, Int32Array).map(function(n) {
+                return n + ' trips';
+            });
+        }
+        return trace;
+    });
+
+    var layout = Object.assign({}, stats.layout, {template: payload.template});
+    return {data: data, layout: layout};
+}
+
+// Builds the heatmap of app_helpers.stats_payload() for `stat`
+function buildHeatmap(payload, stat) {
+    var figure = payload.figures.heatmap;
+    var stats = figure.stats[stat];
+    var values = decodeArray(stats.z, Float32Array);
+
+    // One row of z per hour; NaN cells had no trips and are left blank.
+    // Rounding drops the float32 noise, e.g. 57.79999923706055
+    var z = figure.y.map(function(hour, i) {
+        return values.slice(i * figure.x.length, (i + 1) * figure.x.length).map(function(value) {
+            return isNaN(value) ? null : Math.round(value * 10) / 10;
+        });
+    });
+
+    var trace = Object.assign({}, figure.trace, {x: figure.x, y: figure.y, z: z});
+    var layout = Object.assign({}, stats.layout, {template: payload.template});
+    return {data: [trace], layout: layout};
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    dashboard: {
+        toggle_modal: function(n1, n2, is_open) {
+            if (n1 || n2) {
+                return !is_open;
+            }
+            return is_open;
+        },
+
+        stats_figures: function(stat, payload) {
+            if (!payload) {
+                return [{}, {}, {}, {}, {}];
+            }
+            var figures = ['hour', 'day', 'is_weekday', 'route_choice'].map(function(name) {
+                return buildFigure(payload, name, stat);
+            });
+            figures.push(buildHeatmap(payload, stat));
+            return figures;
+        }
+    }
+});
@@ -0,0 +1,80 @@
+"""
+This module builds the snapshot the Dash app cold starts from: the trips_time
+data as memory-mapped columns, plus every figure of the default view already
+serialized to JSON. etl.py runs it at the end of each load; it can also be
+run by hand.
+
+Usage:
+    python src/app/build_snapshot.py
+"""
+
+import json
+import plotly
+import app_helpers
+import snapshot
+
+
+def build_figures(tod_df, signatures_df, sketches_df, disruptions_df):
+    """
+    Returns
+    -------
+    [dict] Every figure the app shows before the user filters anything:
+    the time series with its disruptions, the duration percentiles, and the
+    data the browser draws the breakdown, heatmap and route choice figures
+    from, all for the default routes.
+    """
+    route_ids = app_helpers.default_route_ids(tod_df['route_id'].unique().tolist())
+    tod_df = app_helpers.slice_df(tod_df, route_ids = route_ids)
+
+    return {
+        'time_series': app_helpers.add_disruptions(
+            app_helpers.time_series_main(tod_df), disruptions_df
+        ),
+        'percentiles': app_helpers.percentiles_main(sketches_df, route_ids),
+        'stats': app_helpers.stats_payload(tod_df, signatures_df),
+    }
+
+
+def build(folder = snapshot.default_folder):
+    """
+    Queries the database and writes a new snapshot to `folder`.
+
+    Returns
+    -------
+    [dict] Manifest of the new snapshot.
+    """
+    load_token = app_helpers.latest_load_token()
+    # Stored sorted so the app can binary search the mapped columns as is
+    tod_df = app_helpers.sort_df(app_helpers.create_df())
+    signatures_df = app_helpers.create_signatures_df()
+    sketches_df = app_helpers.create_sketches_df()
+    slots_df = app_helpers.create_departure_slots_df()
+    disruptions_df = app_helpers.create_disruptions_df()
+    routes_df = app_helpers.create_routes_df()
+    locations_df = app_helpers.create_locations_df()
+
+    figures_json = json.dumps(
+        build_figures(tod_df, signatures_df, sketches_df, disruptions_df),
+        cls = plotly.utils.PlotlyJSONEncoder
+    )
+
+    snapshot.write_snapshot(
+        tod_df,
+        folder,
+        extra = dict(
+            app_helpers.data_extent(tod_df),
+            load_token = load_token,
+            signatures = signatures_df.values.tolist(),
+            routes = routes_df.values.tolist(),
+            locations = locations_df.values.tolist(),
+            departure_slots = slots_df.values.tolist(),
+            disruptions = disruptions_df.values.tolist()
+        ),
+        figures_json = figures_json
+    )
+    return snapshot.read_manifest(folder)
+
+
+if __name__ == '__main__':
+    manifest = build()
+    print('Snapshot {} with {} trips'.format(manifest['path'], manifest['num_rows']))
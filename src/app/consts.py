@@ -11,7 +11,16 @@ colors = dict(
     green = 'rgb(15,157,88)'
 )
 
-graph_colors = [colors['blue'], colors['yellow']]
+# Cycled through when more routes are shown than there are colors
+graph_colors = [
+    colors['blue'], colors['yellow'], colors['red'], colors['green'],
+    'rgb(171,71,188)', 'rgb(0,172,193)', 'rgb(255,112,67)', 'rgb(158,157,36)'
+]
+
+### ROUTES ###
+
+# Routes selected when the dashboard opens, and in the snapshot's figures
+max_default_routes = 2
 
 ### DROPDOWN ###
 
@@ -23,8 +32,26 @@ dropdown_options = [
 ]
 dropdown_width = '50%'
 
+# Windows of the trend overlays on the time series, in seconds
+trend_windows = [
+    {'label': '1 hour', 'value': 3600},
+    {'label': '1 day', 'value': 86400},
+    {'label': '1 week', 'value': 604800},
+]
+trend_stat_options = [
+    {'label': 'Mean', 'value': 'mean'},
+    {'label': 'Median', 'value': 'median'},
+    {'label': '90th percentile', 'value': 'p90'},
+]
+
 
 ### GRAPH LAYOUTS ###
 
 title_x_pos = 0.5
 title_x_anchor = 'center'
+
+# Short trips light, long trips dark
+heatmap_colorscale = 'Blues'
+
+# Line style of each trend overlay; its color is the route's
+trend_dashes = {'mean': 'dot', 'median': 'dash', 'p90': 'dashdot'}
@@ -0,0 +1,393 @@
+"""
+Aggregates trip durations into a cube over route, month, weekday, hour and
+5-minute departure slot, for the dashboard's breakdowns and heatmap.
+
+The trips are scanned once, into the finest cells: the count, sum, min and
+max of the durations departing in each (route, month, day, hour, slot). Only
+the cells some trip falls in are kept, by their index into the full grid, so
+the cube grows with the trips rather than with routes times months. Any
+coarser slice, e.g. mean duration by hour for two routes, is rolled up from
+those cells, or from a finer slice already computed, rather than from the
+trips. Slices are dense arrays over just their own dimensions, and are kept
+in a small LRU cache on the cube. A cube belongs to one load of the data:
+the app builds a new one when a load lands, which drops every cached slice
+with it.
+
+Medians need more than those sums, so each (route, month, day, hour) also
+keeps a histogram of durations by whole minute, as counts of the minutes
+that occur. Medians are exact but can't be taken per slot.
+
+Direction is part of a route (route A goes from A to B, route B back), so
+the route dimension covers it.
+
+Examples
+--------
+>>> trips_cube = build(tod_df, version = load_token)
+>>> aggregates = slice_cube(trips_cube, ('hour', 'day'), route_ids = ['A'])
+>>> statistic(aggregates, 'median').shape
+(7, 24)
+"""
+
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+
+# Order of the dimensions in the cube and in every slice
+dims = ('route_id', 'month', 'day', 'is_weekday', 'hour', 'slot')
+
+# Dimensions the trips are binned by; is_weekday is rolled up from day
+base_dims = ('route_id', 'month', 'day', 'hour', 'slot')
+
+slot_minutes = 5
+
+# ISO weekdays, 1 (Monday) to 7 (Sunday), as in the time table
+weekend_days = (6, 7)
+
+stats = ('count', 'sum', 'min', 'max', 'mean', 'median')
+
+
+def build(df, version = None, max_slices = 64):
+    """
+    Returns
+    -------
+    [dict] Cube of the durations in `df`: for the base cells and for the
+    same cells without slots (with the duration histograms), the count, sum,
+    min and max of each cell that has trips, the labels along each
+    dimension and the slice cache.
+
+    Parameters
+    ----------
+    df: [Pandas df] trips_time rows, with route_id, year, month, day, hour,
+    minute and duration (in minutes).
+
+    version: Identifies the data, e.g. the load token. Kept on the cube so
+    callers can tell when it needs rebuilding.
+
+    max_slices: [int] Number of slices to keep cached.
+    """
+    route_codes, route_ids = pd.factorize(df['route_id'], sort = True)
+    months = df['year'].values * 12 + df['month'].values - 1
+    first_month = months.min() if len(df) else 0
+    num_months = int(months.max() - first_month + 1) if len(df) else 0
+
+    labels = {
+        'route_id': list(route_ids),
+        'month': [
+            '{}-{:02d}'.format(month // 12, month % 12 + 1)
+            for month in range(first_month, first_month + num_months)
+        ],
+        'day': list(range(1, 8)),
+        'is_weekday': [False, True],
+        'hour': list(range(24)),
+        'slot': list(range(0, 60, slot_minutes)),
+    }
+
+    durations = df['duration'].values.astype(float)
+    codes = (
+        route_codes,
+        months - first_month,
+        df['day'].values - 1,
+        df['hour'].values,
+        df['minute'].values // slot_minutes,
+    )
+    shape = tuple(len(labels[dim]) for dim in base_dims)
+    cells, _ = bin_cells(codes, shape, durations)
+    hours, hour_cells = bin_cells(codes[:-1], shape[:-1], durations)
+
+    # Durations are whole minutes, so one bin per minute makes medians exact
+    minutes = np.rint(durations).astype(int)
+    first_minute = minutes.min() if len(df) else 0
+    num_bins = int(minutes.max() - first_minute + 1) if len(df) else 1
+    hist_keys, hist_counts = np.unique(
+        hour_cells * num_bins + (minutes - first_minute), return_counts = True
+    )
+    hours['hist_cell'], hours['hist_bin'] = np.divmod(hist_keys, num_bins)
+    hours['hist_count'] = hist_counts
+
+    return {
+        'version': version,
+        'labels': labels,
+        'first_minute': first_minute,
+        'num_bins': num_bins,
+        'cells': cells,
+        'hours': hours,
+        'cache': OrderedDict(),
+        'max_slices': max_slices,
+        'num_rollups': 0,
+    }
+
+
+def bin_cells(codes, shape, durations):
+    """
+    Returns
+    -------
+    Tuple of the count, sum, min and max of `durations` in each cell of the
+    grid of `shape` that has any, with the cells' flat indexes into the grid
+    as 'key', and the position in those of each duration's cell.
+
+    Parameters
+    ----------
+    codes: [tuple] One array per dimension of each duration's position.
+    """
+    keys, positions = np.unique(
+        np.ravel_multi_index(codes, shape) if len(durations) else np.zeros(0, dtype = int),
+        return_inverse = True
+    )
+    cells = {
+        'key': keys,
+        'shape': shape,
+        'count': np.bincount(positions, minlength = len(keys)),
+        'sum': np.bincount(positions, weights = durations, minlength = len(keys)),
+        'min': np.full(len(keys), np.inf),
+        'max': np.full(len(keys), -np.inf),
+    }
+    np.minimum.at(cells['min'], positions, durations)
+    np.maximum.at(cells['max'], positions, durations)
+    return cells, positions
+
+
+def rollup_cells(cube, cells, from_dims, to_dims, route_ids = None):
+    """
+    Returns
+    -------
+    [dict] The count, sum, min and max of the cells of a cube (from
+    build()) rolled up into a dense slice over `to_dims`, plus the duration
+    histograms if `cells` has them. Day rolls up to is_weekday as in
+    rollup().
+
+    Parameters
+    ----------
+    cells: [dict] cube['cells'] or cube['hours'], over `from_dims`.
+
+    route_ids: [tuple] Sorted routes to keep, all of them if None. The
+    slice's route axis then has just these.
+    """
+    keys = cells['key']
+    lengths = {dim: len(cube['labels'][dim]) for dim in dims}
+
+    # Route is the first dimension, so each route's cells are one run of the
+    # sorted keys, found by binary search
+    if route_ids is None:
+        positions = None
+        runs = [(0, len(keys))]
+    else:
+        positions = [cube['labels']['route_id'].index(route_id) for route_id in route_ids]
+        lengths['route_id'] = len(positions)
+        stride = int(np.prod(cells['shape'][1:]))
+        runs = [
+            (keys.searchsorted(position * stride), keys.searchsorted((position + 1) * stride))
+            for position in positions
+        ]
+    rows = np.concatenate([np.arange(first, last) for first, last in runs] + [[]]).astype(int)
+
+    codes = dict(zip(from_dims, np.unravel_index(keys[rows], cells['shape'])))
+    if positions is not None:
+        codes['route_id'] = np.searchsorted(positions, codes['route_id'])
+    if 'is_weekday' in to_dims:
+        weekend = [day - 1 for day in weekend_days]
+        codes['is_weekday'] = (~np.isin(codes['day'], weekend)).astype(int)
+
+    shape = tuple(lengths[dim] for dim in to_dims)
+    size = int(np.prod(shape))
+    targets = np.ravel_multi_index(tuple(codes[dim] for dim in to_dims), shape) \
+        if to_dims else np.zeros(len(rows), dtype = int)
+
+    aggregates = {
+        'count': np.bincount(targets, weights = cells['count'][rows], minlength = size)
+        .astype(np.int64),
+        'sum': np.bincount(targets, weights = cells['sum'][rows], minlength = size),
+        'min': np.full(size, np.inf),
+        'max': np.full(size, -np.inf),
+    }
+    np.minimum.at(aggregates['min'], targets, cells['min'][rows])
+    np.maximum.at(aggregates['max'], targets, cells['max'][rows])
+    for name in ['count', 'sum', 'min', 'max']:
+        aggregates[name] = aggregates[name].reshape(shape)
+
+    if 'hist_cell' in cells:
+        # A cell's histogram entries are a run of them too, in the same order
+        num_bins = cube['num_bins']
+        hist_cell = cells['hist_cell']
+        hist_rows, hist_targets = [], []
+        offset = 0
+        for first, last in runs:
+            hist_first, hist_last = hist_cell.searchsorted(first), hist_cell.searchsorted(last)
+            hist_rows.append(np.arange(hist_first, hist_last))
+            hist_targets.append(targets[hist_cell[hist_first:hist_last] - first + offset])
+            offset += last - first
+        hist_rows = np.concatenate(hist_rows + [[]]).astype(int)
+        hist_targets = np.concatenate(hist_targets + [[]]).astype(int)
+        aggregates['hist'] = np.bincount(
+            hist_targets * num_bins + cells['hist_bin'][hist_rows],
+            weights = cells['hist_count'][hist_rows],
+            minlength = size * num_bins
+        ).astype(np.int64).reshape(shape + (num_bins,))
+
+    return aggregates
+
+
+def rollup(aggregates, from_dims, to_dims):
+    """
+    Returns
+    -------
+    [dict] `aggregates` over `from_dims` rolled up to `to_dims`, which
+    must be a subset of them, except that day rolls up to is_weekday.
+    Counts, sums and histograms add up; mins and maxes take the extremes.
+    """
+    aggregates = dict(aggregates)
+    from_dims = list(from_dims)
+
+    if 'is_weekday' in to_dims and 'is_weekday' not in from_dims:
+        axis = from_dims.index('day')
+        weekend = [day - 1 for day in weekend_days]
+        weekday = [day for day in range(7) if day not in weekend]
+        for name, values in aggregates.items():
+            reduce = reducer(name)
+            aggregates[name] = np.stack([
+                reduce(np.take(values, weekend, axis = axis), axis = axis),
+                reduce(np.take(values, weekday, axis = axis), axis = axis),
+            ], axis = axis)
+        from_dims[axis] = 'is_weekday'
+
+    axes = tuple(i for i, dim in enumerate(from_dims) if dim not in to_dims)
+    if axes:
+        aggregates = {
+            name: reducer(name)(values, axis = axes) for name, values in aggregates.items()
+        }
+    return aggregates
+
+
+def reducer(name):
+    """
+    Returns
+    -------
+    The numpy function that combines cells of the aggregate `name`.
+    """
+    if name == 'min':
+        return lambda values, axis: np.min(values, axis = axis, initial = np.inf)
+    if name == 'max':
+        return lambda values, axis: np.max(values, axis = axis, initial = -np.inf)
+    return np.sum
+
+
+def covers(from_dims, to_dims):
+    """
+    Returns
+    -------
+    [bool] Whether a slice over `from_dims` can be rolled up to `to_dims`.
+    """
+    return all(
+        dim in from_dims or (dim == 'is_weekday' and 'day' in from_dims)
+        for dim in to_dims
+    )
+
+
+def slice_cube(cube, slice_dims, route_ids = None):
+    """
+    Returns
+    -------
+    [dict] count, sum, min and max of the durations in each cell of the
+    slice, as arrays with one axis per dimension in `slice_dims` (in the
+    order of `dims`), plus the duration histograms unless the slice is by
+    slot. Also has the labels along each axis and the dims of the axes.
+
+    Parameters
+    ----------
+    cube: [dict] Output of build().
+
+    slice_dims: [tuple] Dimensions to keep; the others are rolled up.
+
+    route_ids: [list] Routes to include. None includes them all.
+    """
+    slice_dims = tuple(dim for dim in dims if dim in slice_dims)
+    if 'day' in slice_dims and 'is_weekday' in slice_dims:
+        raise ValueError('Slice by day or by is_weekday, not both')
+
+    if route_ids is not None:
+        known = set(cube['labels']['route_id'])
+        route_ids = tuple(sorted(route_id for route_id in set(route_ids) if route_id in known))
+
+    cache = cube['cache']
+    key = (slice_dims, route_ids)
+    if key in cache:
+        cache.move_to_end(key)
+        return cache[key]
+
+    # Roll up the smallest cached slice that has everything needed. Slices by
+    # slot have no histograms, so only they can serve other slices by slot.
+    by_slot = 'slot' in slice_dims
+    candidates = [
+        cached for (cached_dims, cached_routes), cached in cache.items()
+        if cached_routes == route_ids and ('slot' in cached_dims) == by_slot
+        and covers(cached_dims, slice_dims)
+    ]
+    if candidates:
+        source = min(candidates, key = lambda cached: cached['count'].size)
+        aggregates = {name: source[name] for name in aggregate_names(source)}
+        result = rollup(aggregates, source['dims'], slice_dims)
+    elif by_slot:
+        result = rollup_cells(cube, cube['cells'], base_dims, slice_dims, route_ids)
+    else:
+        result = rollup_cells(cube, cube['hours'], base_dims[:-1], slice_dims, route_ids)
+
+    result['dims'] = slice_dims
+    result['labels'] = [
+        list(route_ids) if dim == 'route_id' and route_ids is not None else cube['labels'][dim]
+        for dim in slice_dims
+    ]
+    result['first_minute'] = cube['first_minute']
+    cube['num_rollups'] += 1
+
+    cache[key] = result
+    if len(cache) > cube['max_slices']:
+        cache.popitem(last = False)
+    return result
+
+
+def aggregate_names(aggregates):
+    """
+    Returns
+    -------
+    [list] Names of the aggregate arrays in a slice.
+    """
+    return [name for name in ('count', 'sum', 'min', 'max', 'hist') if name in aggregates]
+
+
+def statistic(aggregates, stat):
+    """
+    Returns
+    -------
+    [numpy array] `stat` of the durations in each cell of a slice, NaN for
+    cells without trips. The median of an even number of trips is the mean
+    of the middle two, as in pandas.
+
+    Parameters
+    ----------
+    aggregates: [dict] Output of slice_cube().
+
+    stat: [str] One of `stats`.
+    """
+    count = aggregates['count']
+    empty = count == 0
+
+    if stat in ('count', 'sum'):
+        return aggregates[stat].astype(float)
+
+    if stat == 'mean':
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return np.where(empty, np.nan, aggregates['sum'] / count)
+
+    if stat in ('min', 'max'):
+        return np.where(empty, np.nan, aggregates[stat])
+
+    if stat == 'median':
+        if 'hist' not in aggregates:
+            raise ValueError('Medians are not kept per slot')
+        cumulative = np.cumsum(aggregates['hist'], axis = -1)
+        # 0-based ranks of the middle two trips, which are the same for odd counts
+        lower = np.argmax(cumulative > ((count - 1) // 2)[..., None], axis = -1)
+        upper = np.argmax(cumulative > (count // 2)[..., None], axis = -1)
+        return np.where(empty, np.nan, (lower + upper) / 2 + aggregates['first_minute'])
+
+    raise ValueError('Unknown statistic {}'.format(stat))
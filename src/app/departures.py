@@ -0,0 +1,202 @@
+"""
+Answers "when should I leave?" in constant time from the departure_slots
+table the ETL refreshes: trip duration percentiles for every route,
+weekday and 5-minute slot of the day.
+
+The table is held as dense NumPy arrays of shape (routes, 7, 288). For
+each statistic, a sparse table of argmins over power-of-two runs of slots is
+built once, so the quickest slot in any window is found by comparing two
+precomputed entries, however wide the window.
+
+Examples
+--------
+>>> table = build_table(slots_df)
+>>> best_slot(table, 'A', 1, parse_time('07:00'), parse_time('09:00'))
+{'route_id': 'A', 'day': 1, 'departure': '07:35', ...}
+"""
+
+import re
+import numpy as np
+
+
+slot_minutes = 5
+slots_per_day = 24 * 60 // slot_minutes
+stats = ['p50', 'p90']
+
+# H:MM or HH:MM
+time_pattern = re.compile('([0-9]{1,2}):([0-9]{2})')
+
+
+def parse_time(text):
+    """
+    Returns
+    -------
+    [int] Slot of the day holding the time `text`, e.g. 91 for '07:35'.
+
+    Raises ValueError('Invalid time ...') if `text` is not a valid HH:MM
+    time, whatever is wrong with it.
+    """
+    match = time_pattern.fullmatch(text)
+    if match is None:
+        raise ValueError('Invalid time {}'.format(text))
+    hour, minute = int(match.group(1)), int(match.group(2))
+    if not (hour < 24 and minute < 60):
+        raise ValueError('Invalid time {}'.format(text))
+    return (hour * 60 + minute) // slot_minutes
+
+
+def format_slot(slot):
+    """
+    Returns
+    -------
+    [str] Start time of `slot` as HH:MM.
+    """
+    minutes = slot * slot_minutes
+    return '{:02d}:{:02d}'.format(minutes // 60, minutes % 60)
+
+
+def build_sparse_table(values):
+    """
+    Returns
+    -------
+    [list] Level k holds, for every slot i, the index of the smallest value
+    in slots [i, i + 2**k) along the last axis of `values`. Runs that would
+    go past the end of the day are clipped to it.
+
+    Parameters
+    ----------
+    values: [np.ndarray] Shape (routes, 7, slots_per_day). Empty slots
+    are +inf so they are never picked.
+    """
+    num_slots = values.shape[-1]
+    levels = [np.broadcast_to(np.arange(num_slots), values.shape).copy()]
+
+    width = 1
+    while 2 * width <= num_slots:
+        prev = levels[-1]
+        # Right half of each run starts `width` slots later
+        right = np.concatenate([prev[..., width:], prev[..., -width:]], axis = -1)
+        left_values = np.take_along_axis(values, prev, axis = -1)
+        right_values = np.take_along_axis(values, right, axis = -1)
+        levels.append(np.where(right_values < left_values, right, prev))
+        width *= 2
+
+    return levels
+
+
+def build_table(slots_df):
+    """
+    Returns
+    -------
+    [dict] Dense arrays of num_trips, p50 and p90 indexed by
+    [route, day - 1, slot], the route_ids in axis order and a lookup of
+    their positions, and a sparse table per statistic.
+
+    Parameters
+    ----------
+    slots_df: [Pandas df] Rows of departure_slots, with route_id as the
+    route code.
+    """
+    route_ids = sorted(slots_df['route_id'].unique().tolist())
+    shape = (len(route_ids), 7, slots_per_day)
+
+    table = {
+        'route_ids': route_ids,
+        'route_index': {route_id: i for i, route_id in enumerate(route_ids)},
+        'num_trips': np.zeros(shape, dtype = np.int32),
+        'sparse': {},
+    }
+    index = (
+        slots_df['route_id'].map(table['route_index']).values,
+        slots_df['day'].values - 1,
+        slots_df['slot'].values
+    )
+    table['num_trips'][index] = slots_df['num_trips'].values
+
+    for stat in stats:
+        values = np.full(shape, np.inf)
+        values[index] = slots_df[stat].values
+        table[stat] = values
+        table['sparse'][stat] = build_sparse_table(values)
+
+    # floor(log2(n)) for every window length, so queries need no math calls
+    table['log2'] = np.zeros(slots_per_day + 1, dtype = np.int32)
+    for n in range(2, slots_per_day + 1):
+        table['log2'][n] = table['log2'][n // 2] + 1
+
+    return table
+
+
+def min_slot(table, stat, route, day, start, end):
+    """
+    Returns
+    -------
+    [int] Slot with the smallest `stat` in slots [start, end] of one day,
+    from two lookups in the sparse table.
+    """
+    k = table['log2'][end - start + 1]
+    level = table['sparse'][stat][k]
+    values = table[stat]
+
+    left = level[route, day, start]
+    right = level[route, day, end - (1 << k) + 1]
+    return left if values[route, day, left] <= values[route, day, right] else right
+
+
+def best_slot(table, route_id, day, start, end, stat = 'p50'):
+    """
+    Returns
+    -------
+    [dict] The departure slot within the window with the lowest `stat`, its
+    duration percentiles and how many trips they are based on, or None when
+    no trip was recorded in the window.
+
+    Parameters
+    ----------
+    table: [dict] Output of build_table().
+
+    route_id: [str] Route code, e.g. 'A'.
+
+    day: [int] ISO weekday, 1 being Monday.
+
+    start, end: [int] First and last slot of the window. When end is before
+    start, the window runs past midnight into the next day.
+
+    stat: [str] 'p50' for the quickest typical trip, 'p90' for the quickest
+    trip you can count on 9 times out of 10.
+
+    Raises KeyError for an unknown route and ValueError for a bad
+    weekday or statistic.
+    """
+    if stat not in stats:
+        raise ValueError('stat must be one of {}'.format(', '.join(stats)))
+    if not 1 <= day <= 7:
+        raise ValueError('day must be between 1 (Monday) and 7 (Sunday)')
+
+    route = table['route_index'][route_id]
+    day_index = day - 1
+
+    if start <= end:
+        windows = [(day_index, start, end)]
+    else:
+        windows = [(day_index, start, slots_per_day - 1), ((day_index + 1) % 7, 0, end)]
+
+    best = None
+    for window_day, first, last in windows:
+        slot = min_slot(table, stat, route, window_day, first, last)
+        value = table[stat][route, window_day, slot]
+        if best is None or value < best[2]:
+            best = (window_day, slot, value)
+
+    window_day, slot, value = best
+    if np.isinf(value):
+        return None
+
+    return {
+        'route_id': route_id,
+        'day': window_day + 1,
+        'departure': format_slot(slot),
+        'p50': float(table['p50'][route, window_day, slot]),
+        'p90': float(table['p90'][route, window_day, slot]),
+        'num_trips': int(table['num_trips'][route, window_day, slot]),
+    }
@@ -0,0 +1,225 @@
+"""
+Streams trips out of the database as CSV, NDJSON or Parquet for the app's
+/api/export endpoint.
+
+Rows are read through a server-side (named) cursor `batch_size` at a time
+and each batch is encoded and sent before the next is read, so memory stays
+bounded however many years are exported, and the first bytes go out as soon
+as postgres returns the first batch. Parquet is written one row group per
+batch, with the footer at the end.
+
+Examples
+--------
+>>> chunks = stream(open_connection, 'csv', route_ids = ['A'], start_ts = 1586736000)
+>>> b''.join(chunks)
+b'departure_ts,trip_id,route_id,...'
+"""
+
+import csv
+import importlib.util
+import io
+import json
+from sql_queries import trips_export_select, trips_steps_export_select, trips_export_filters
+
+
+batch_size = 5000
+
+# Column types, for Parquet; step columns only with steps
+columns = [
+    ('departure_ts', 'int'),
+    ('trip_id', 'int'),
+    ('route_id', 'str'),
+    ('start_location_id', 'str'),
+    ('duration', 'int'),
+    ('num_steps', 'int'),
+    ('signature', 'str'),
+    ('minute', 'int'),
+    ('hour', 'int'),
+    ('day', 'int'),
+    ('week_of_year', 'int'),
+    ('month', 'int'),
+    ('year', 'int'),
+    ('is_weekday', 'bool'),
+]
+step_columns = [
+    ('step_num', 'int'),
+    ('line_name', 'str'),
+]
+
+formats = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def where_clause(params):
+    """
+    Returns
+    -------
+    [str] WHERE clause of the export queries, ANDing the filter of every
+    parameter in `params`, or '' for none.
+
+    Parameters
+    ----------
+    params: [dict] Parameters of the query, leaving out filters not given.
+    """
+    if not params:
+        return ''
+    return 'WHERE\n      ' + '\n      AND '.join(
+        trips_export_filters[name] for name in trips_export_filters if name in params
+    )
+
+
+def read_batches(conn, query, params):
+    """
+    Yields lists of up to `batch_size` rows of `query` from a server-side
+    cursor, then closes `conn`.
+    """
+    try:
+        # A named cursor keeps the result on the server until it is fetched
+        cur = conn.cursor(name = 'trips_export')
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        cur.close()
+    finally:
+        conn.close()
+
+
+def encode_csv(batches, names):
+    """
+    Yields CSV bytes: the header, then one chunk per batch.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def encode_ndjson(batches, names):
+    """
+    Yields NDJSON bytes, one object per row, one chunk per batch.
+    """
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(names, row))) + '\n' for row in rows
+        ).encode()
+
+
+class ChunkSink:
+    """
+    File-like object Parquet is written to, whose bytes are taken out as
+    they are written so they can be sent straight away.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        """
+        Returns
+        -------
+        [bytes] Everything written since the last take().
+        """
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def encode_parquet(batches, names, types):
+    """
+    Yields Parquet bytes, one row group per batch.
+    """
+    # Only this format needs pyarrow, so the app starts without importing it
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {'int': pa.int64(), 'str': pa.string(), 'bool': pa.bool_()}
+    schema = pa.schema([(name, arrow_types[kind]) for name, kind in zip(names, types)])
+
+    sink = ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in batches:
+        arrays = [
+            pa.array([row[i] for row in rows], type = schema.field(i).type)
+            for i in range(len(names))
+        ]
+        writer.write_table(pa.Table.from_arrays(arrays, schema = schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+def stream(connect, fmt, route_ids = None, start_ts = None, end_ts = None, steps = False):
+    """
+    Returns
+    -------
+    Generator of the bytes of the export, in chunks.
+
+    Parameters
+    ----------
+    connect: Function returning a psycopg2 connection, e.g.
+    app_helpers.open_connection. It is called once the request is known to
+    be valid, and the connection is closed once the export is read.
+
+    fmt: [str] One of `formats`.
+
+    route_ids: [list] Route codes to export. None exports every route.
+
+    start_ts, end_ts: [int] Export departures at or after `start_ts` and
+    before `end_ts`. None leaves that end open.
+
+    steps: [bool] Whether to export one row per step of each trip, with its
+    line, rather than one row per trip.
+
+    Raises ValueError for an unknown format, or for Parquet without pyarrow.
+    """
+    if fmt not in formats:
+        raise ValueError('Unknown format {}; use one of {}'.format(fmt, ', '.join(formats)))
+    if fmt == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise ValueError('Parquet export needs pyarrow installed')
+
+    export_columns = columns + step_columns if steps else columns
+    names = [name for name, _ in export_columns]
+    filters = {
+        'route_ids': list(route_ids) if route_ids else None,
+        'start_ts': start_ts,
+        'end_ts': end_ts,
+    }
+    params = {name: value for name, value in filters.items() if value is not None}
+    query = (trips_steps_export_select if steps else trips_export_select).format(
+        where = where_clause(params)
+    )
+    batches = read_batches(connect(), query, params)
+
+    if fmt == 'csv':
+        return encode_csv(batches, names)
+    if fmt == 'ndjson':
+        return encode_ndjson(batches, names)
+    return encode_parquet(batches, names, [kind for _, kind in export_columns])
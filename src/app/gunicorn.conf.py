@@ -0,0 +1,30 @@
+"""
+gunicorn settings for serving the Dash app in production. Every setting can
+be overridden with an environment variable of the same name in upper case
+prefixed with GUNICORN_, e.g. GUNICORN_WORKERS=8.
+"""
+
+import multiprocessing
+import os
+
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 2))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+
+# Import the app (and load its data) once in the master, then fork
+preload_app = True
+
+# Recycle workers now and then to bound memory growth; recycled workers are
+# forked from the master again so they start with the shared data
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = 100
+
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    # Each worker listens for streamed trips itself (LIVE_UPDATES=1)
+    import app
+    app.start_live_updates()
@@ -0,0 +1,91 @@
+"""
+Listens for trips streamed into the database while the app runs, by
+`data_collection.py --stream` (see src/etl/stream.py), so the dashboard
+shows them within seconds instead of after the next restart.
+
+stream.py sends a notification on the trips_loaded channel in the same
+transaction that loads the trips, with their routes and range of
+departures. A background thread LISTENs on its own connection and hands
+each batch of notifications to a callback, which in app.py fetches just the
+new trips and drops the caches built from the old ones: for each route
+notified, every trip after the last one the app has of it. If the database
+goes away, the thread reconnects, and once listening again hands the
+callback an empty batch, for which app.py fetches every route's trips
+loaded meanwhile.
+
+Examples
+--------
+>>> start(lambda payloads: print(payloads))
+[]
+[{'route_ids': ['A', 'B'], 'min_departure_ts': 1586809354, ...}]
+"""
+
+import json
+import select
+import threading
+import psycopg2
+import app_helpers
+
+
+# Same channel as src/etl/stream.py notifies
+channel = 'trips_loaded'
+
+# Seconds between attempts to reconnect
+retry_seconds = 5
+
+
+def apply(on_notify, payloads):
+    """
+    Calls on_notify(payloads), reporting rather than raising its errors so
+    the listener keeps running.
+    """
+    try:
+        on_notify(payloads)
+    except Exception as e:
+        print('Could not apply streamed trips: {!r}'.format(e))
+
+
+def listen(on_notify, stop = None):
+    """
+    Passes the payloads of the notifications on `channel` to `on_notify`,
+    as a list of dicts, all those that arrived together at once, and an
+    empty list each time it starts listening, as notifications sent before
+    then are lost. Runs until `stop` is set, reconnecting whenever the
+    connection drops.
+    """
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        try:
+            conn = app_helpers.open_connection()
+            conn.set_session(autocommit = True)
+            conn.cursor().execute('LISTEN {}'.format(channel))
+            print('Listening for streamed trips on {}'.format(channel))
+            apply(on_notify, [])
+
+            while not stop.is_set():
+                # Wakes up now and then to check `stop`
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                payloads = [json.loads(notify.payload) for notify in conn.notifies]
+                conn.notifies.clear()
+                if payloads:
+                    apply(on_notify, payloads)
+            conn.close()
+        except psycopg2.Error as e:
+            print('Not listening for streamed trips: {}'.format(str(e).strip()))
+            stop.wait(retry_seconds)
+
+
+def start(on_notify):
+    """
+    Starts listen() in a daemon thread.
+
+    Returns
+    -------
+    [threading.Event] Set it to stop listening.
+    """
+    stop = threading.Event()
+    thread = threading.Thread(target = listen, args = (on_notify, stop), daemon = True)
+    thread.start()
+    return stop
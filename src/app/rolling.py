@@ -0,0 +1,280 @@
+"""
+Rolling statistics of trip durations for the trend overlays on the
+dashboard's time series.
+
+For each route and window, e.g. the last day, the mean, median and 90th
+percentile of the durations departing in the window are kept at every trip.
+They are maintained incrementally: a new trip evicts the trips that have
+left its window and adds itself, so feeding it costs O(log m), where m is
+the longest duration in minutes, however long the window. Trips are kept in
+a deque for eviction, with a running sum for the mean and a Fenwick tree of
+counts by whole minute for the quantiles. Durations are whole minutes, so
+the quantiles are exact, interpolated as pandas does:
+
+    df.rolling('1D', on = 'departure_time')['duration'].quantile(0.9)
+
+A RollingSeries keeps the statistics of every trip it was fed, so trips
+loaded later only need the new trips fed in, not the history recomputed.
+They are kept in buffers that double when full, so feeding trips a few at
+a time, as they stream in, doesn't copy the history each time.
+
+Examples
+--------
+>>> series = RollingSeries(window = 86400)
+>>> series.extend(departure_ts, durations)
+>>> series.slice(start_ts, end_ts)['p90']
+array([46., 46., 47.2, ...])
+"""
+
+from collections import deque
+import numpy as np
+
+
+# Statistics kept at every trip, and the quantile each is
+quantiles = {'median': 0.5, 'p90': 0.9}
+stats = ('mean',) + tuple(quantiles)
+
+
+class MinuteCounts:
+    """
+    Counts of durations by whole minute in a Fenwick (binary indexed) tree,
+    so adding, removing and finding the k-th smallest take O(log m). It
+    grows to fit the longest duration added.
+    """
+
+    def __init__(self, size = 256):
+        self.tree = [0] * (size + 1)
+        self.size = size
+
+    def grow(self, value):
+        """
+        Doubles the tree until it holds `value`, re-adding the counts.
+        """
+        counts = [self.count_of(i) for i in range(self.size)]
+        while value >= self.size:
+            self.size *= 2
+        self.tree = [0] * (self.size + 1)
+        for minute, count in enumerate(counts):
+            if count:
+                self.add(minute, count)
+
+    def count_of(self, minute):
+        """
+        Returns
+        -------
+        [int] How many durations of exactly `minute` are counted.
+        """
+        return self.prefix(minute + 1) - self.prefix(minute)
+
+    def prefix(self, end):
+        """
+        Returns
+        -------
+        [int] How many durations are below `end` minutes.
+        """
+        total = 0
+        while end > 0:
+            total += self.tree[end]
+            end -= end & -end
+        return total
+
+    def add(self, minute, count = 1):
+        """
+        Counts the duration `minute` `count` more times; negative to remove.
+        """
+        if minute >= self.size:
+            self.grow(minute)
+        i = minute + 1
+        while i <= self.size:
+            self.tree[i] += count
+            i += i & -i
+
+    def kth(self, k):
+        """
+        Returns
+        -------
+        [int] The `k`th smallest duration counted, from 0.
+        """
+        # Walks down the tree, keeping the last position with at most k below it
+        position = 0
+        step = 1 << (self.size.bit_length() - 1)
+        while step:
+            following = position + step
+            if following <= self.size and self.tree[following] <= k:
+                position = following
+                k -= self.tree[following]
+            step >>= 1
+        return position
+
+
+class RollingWindow:
+    """
+    The durations departing in the last `window` seconds, as of the latest
+    trip added. Trips must be added in order of departure.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.trips = deque()
+        self.total = 0
+        self.counts = MinuteCounts()
+
+    def add(self, departure_ts, duration):
+        """
+        Adds a trip and evicts those that departed `window` seconds or more
+        before it.
+        """
+        trips = self.trips
+        while trips and trips[0][0] <= departure_ts - self.window:
+            _, old_duration = trips.popleft()
+            self.total -= old_duration
+            self.counts.add(old_duration, -1)
+
+        trips.append((departure_ts, duration))
+        self.total += duration
+        self.counts.add(duration)
+
+    def quantile(self, q):
+        """
+        Returns
+        -------
+        [float] The `q` quantile of the durations in the window, linearly
+        interpolated between the two nearest trips.
+        """
+        position = q * (len(self.trips) - 1)
+        lower = int(position)
+        low = self.counts.kth(lower)
+        if position == lower:
+            return float(low)
+        high = self.counts.kth(lower + 1)
+        return low + (high - low) * (position - lower)
+
+    def mean(self):
+        """
+        Returns
+        -------
+        [float] The mean duration in the window.
+        """
+        return self.total / len(self.trips)
+
+
+class RollingSeries:
+    """
+    Rolling statistics over a `window` of seconds at every trip of one
+    route, grown as trips are fed in with extend().
+    """
+
+    def __init__(self, window, capacity = 1024):
+        self.rolling = RollingWindow(window)
+        self.length = 0
+        self.ts_buffer = np.empty(capacity, dtype = np.int64)
+        self.value_buffers = {stat: np.empty(capacity) for stat in stats}
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def departure_ts(self):
+        """
+        [numpy array] Departure time of every trip fed in.
+        """
+        return self.ts_buffer[:self.length]
+
+    @property
+    def values(self):
+        """
+        [dict] Each statistic at every trip fed in.
+        """
+        return {stat: buffer[:self.length] for stat, buffer in self.value_buffers.items()}
+
+    def reserve(self, length):
+        """
+        Doubles the buffers until they hold `length` trips, copying the trips
+        fed in so far.
+        """
+        capacity = len(self.ts_buffer)
+        if length <= capacity:
+            return
+        while capacity < length:
+            capacity *= 2
+        ts_buffer = np.empty(capacity, dtype = np.int64)
+        ts_buffer[:self.length] = self.departure_ts
+        self.ts_buffer = ts_buffer
+        for stat, buffer in self.value_buffers.items():
+            self.value_buffers[stat] = np.empty(capacity)
+            self.value_buffers[stat][:self.length] = buffer[:self.length]
+
+    def last_ts(self):
+        """
+        Returns
+        -------
+        [int] Departure time of the last trip fed in, or None.
+        """
+        return int(self.departure_ts[-1]) if len(self) else None
+
+    def extend(self, departure_ts, durations):
+        """
+        Feeds in trips departing after every trip fed in so far, and keeps
+        the statistics at each.
+
+        Parameters
+        ----------
+        departure_ts, durations: [numpy array] Unix departure times, in
+        order, and durations in whole minutes.
+        """
+        if len(departure_ts) == 0:
+            return
+        if len(self) and departure_ts[0] < self.departure_ts[-1]:
+            raise ValueError('Trips must be fed in order of departure')
+
+        start = self.length
+        self.reserve(start + len(departure_ts))
+
+        # Written past the end, so slices already taken are left as they were
+        rolling = self.rolling
+        means = self.value_buffers['mean']
+        for i, (ts, duration) in enumerate(zip(departure_ts.tolist(), durations.tolist()), start):
+            rolling.add(ts, duration)
+            means[i] = rolling.mean()
+            for stat, q in quantiles.items():
+                self.value_buffers[stat][i] = rolling.quantile(q)
+
+        self.ts_buffer[start:start + len(departure_ts)] = departure_ts
+        self.length = start + len(departure_ts)
+
+    def slice(self, start_ts = None, end_ts = None):
+        """
+        Returns
+        -------
+        [dict] 'departure_ts' and every statistic of the trips departing in
+        [start_ts, end_ts), found by binary search. None means unbounded.
+        """
+        start = 0 if start_ts is None else self.departure_ts.searchsorted(start_ts, side = 'left')
+        end = len(self) if end_ts is None else self.departure_ts.searchsorted(end_ts, side = 'left')
+        sliced = {stat: self.values[stat][start:end] for stat in stats}
+        sliced['departure_ts'] = self.departure_ts[start:end]
+        return sliced
+
+
+def update(series, departure_ts, durations):
+    """
+    Feeds the trips of one route that `series` hasn't seen into it.
+
+    Returns
+    -------
+    [RollingSeries] `series`, or a new one fed every trip if the trips it
+    was fed are no longer the first ones, e.g. after a reload.
+
+    Parameters
+    ----------
+    series: [RollingSeries] Series of the route so far.
+
+    departure_ts, durations: [numpy array] Every trip of the route, in
+    order of departure, e.g. its block of app_helpers.sort_df().
+    """
+    seen = len(series)
+    if seen > len(departure_ts) or (seen and departure_ts[seen - 1] != series.last_ts()):
+        series = RollingSeries(series.rolling.window)
+        seen = 0
+    series.extend(departure_ts[seen:], durations[seen:])
+    return series
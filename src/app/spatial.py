@@ -0,0 +1,238 @@
+"""
+Finds the tracked routes that start nearest to a point, for picking routes by
+clicking the dashboard's map.
+
+Locations are bucketed into a grid of square cells `cell_degrees` on a side.
+A lookup scans the cells in rings around the point's cell and stops as soon
+as the next ring is farther away than the nearest locations found so far, so
+it reads a handful of cells however many locations are tracked. Locations are
+added one at a time, so a grown locations table only costs the new rows.
+
+Examples
+--------
+>>> index = new_index()
+>>> add_locations(index, locations_df.values.tolist())
+>>> add_routes(index, routes_df.values.tolist())
+>>> nearest_routes(index, 40.71, -73.94)
+[{'route_id': 'A', 'origin': 'A', 'distance': 212.4}]
+"""
+
+import math
+
+
+# About 1.1 km of latitude, the scale of a walk to the station
+cell_degrees = 0.01
+
+earth_radius = 6371000
+
+
+def new_index():
+    """
+    Returns
+    -------
+    [dict] Empty index: grid cells of location codes, the range of cells in
+    use, each location's coordinates, and the routes starting at each
+    location along with a grid of just those origins.
+    """
+    return {'cells': {}, 'bounds': None, 'coords': {}, 'routes': {}, 'origins': None}
+
+
+def cell_of(lat, lng):
+    """
+    Returns
+    -------
+    [tuple] Grid cell holding the point.
+    """
+    return (math.floor(lat / cell_degrees), math.floor(lng / cell_degrees))
+
+
+def distance_meters(lat1, lng1, lat2, lng2):
+    """
+    Returns
+    -------
+    [float] Distance between two points, treating the earth as flat around
+    them. Within a city this is off by well under 1%.
+    """
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return earth_radius * math.sqrt(x * x + y * y)
+
+
+def add_locations(index, locations):
+    """
+    Adds every location not yet in `index`.
+
+    Returns
+    -------
+    [int] Number of locations added.
+
+    Parameters
+    ----------
+    index: [dict] Output of new_index().
+
+    locations: [list] (location_code, latitude, longitude) rows.
+    """
+    num_added = 0
+    for location_code, lat, lng in locations:
+        if location_code in index['coords']:
+            continue
+        index['coords'][location_code] = (float(lat), float(lng))
+
+        cell = cell_of(lat, lng)
+        index['cells'].setdefault(cell, []).append(location_code)
+        if index['bounds'] is None:
+            index['bounds'] = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            bounds = index['bounds']
+            index['bounds'] = [
+                min(bounds[0], cell[0]), max(bounds[1], cell[0]),
+                min(bounds[2], cell[1]), max(bounds[3], cell[1])
+            ]
+        num_added += 1
+    return num_added
+
+
+def add_routes(index, routes):
+    """
+    Records which routes start at each location. Routes whose origin has not
+    been added with add_locations() are skipped.
+
+    Returns
+    -------
+    [int] Number of routes added.
+
+    Parameters
+    ----------
+    index: [dict] Output of new_index().
+
+    routes: [list] (route_id, origin, destination, mode) rows, as in the
+    app's routes_select.
+    """
+    if index['origins'] is None:
+        index['origins'] = new_index()
+
+    num_added = 0
+    for route_id, origin, destination, mode in routes:
+        if origin not in index['coords']:
+            continue
+        origin_routes = index['routes'].setdefault(origin, [])
+        if route_id in origin_routes:
+            continue
+        origin_routes.append(route_id)
+        lat, lng = index['coords'][origin]
+        add_locations(index['origins'], [(origin, lat, lng)])
+        num_added += 1
+    return num_added
+
+
+def ring(center, radius):
+    """
+    Yields the cells at Chebyshev distance `radius` from `center`.
+    """
+    i, j = center
+    if radius == 0:
+        yield center
+        return
+    for dj in range(-radius, radius + 1):
+        yield (i - radius, j + dj)
+        yield (i + radius, j + dj)
+    for di in range(-radius + 1, radius):
+        yield (i + di, j - radius)
+        yield (i + di, j + radius)
+
+
+def measure(index, lat, lng, location_codes, max_distance):
+    """
+    Returns
+    -------
+    [list] (distance in meters, location_code) for each of `location_codes`
+    within `max_distance` of the point.
+    """
+    found = []
+    for location_code in location_codes:
+        location_lat, location_lng = index['coords'][location_code]
+        distance = distance_meters(lat, lng, location_lat, location_lng)
+        if max_distance is None or distance <= max_distance:
+            found.append((distance, location_code))
+    return found
+
+
+def nearest_locations(index, lat, lng, k = 1, max_distance = None):
+    """
+    Returns
+    -------
+    [list] Up to `k` (distance in meters, location_code) tuples, nearest
+    first.
+
+    Parameters
+    ----------
+    index: [dict] Output of new_index().
+
+    lat, lng: [float] Point to search from.
+
+    k: [int] Number of locations to return.
+
+    max_distance: [float] Ignore locations farther than this, in meters.
+    None searches the whole index.
+    """
+    if not index['coords']:
+        return []
+
+    center = cell_of(lat, lng)
+    # No cell is farther from the center than this
+    min_i, max_i, min_j, max_j = index['bounds']
+    max_radius = max(
+        abs(center[0] - min_i), abs(center[0] - max_i),
+        abs(center[1] - min_j), abs(center[1] - max_j)
+    )
+
+    # With fewer locations than cells to visit, measuring them all is cheaper
+    if (2 * max_radius + 1) ** 2 > 4 * len(index['coords']):
+        return sorted(measure(index, lat, lng, index['coords'], max_distance))[:k]
+
+    # Shortest side of a cell here, so ring r is at least (r - 1) of them away
+    cell_meters = math.radians(cell_degrees) * earth_radius \
+        * math.cos(math.radians(min(abs(lat) + cell_degrees, 90)))
+
+    found = []
+    for radius in range(max_radius + 1):
+        bound = (radius - 1) * cell_meters
+        if len(found) >= k and found[k - 1][0] <= bound:
+            break
+        if max_distance is not None and bound > max_distance:
+            break
+        for cell in ring(center, radius):
+            if cell in index['cells']:
+                found += measure(index, lat, lng, index['cells'][cell], max_distance)
+        found.sort()
+
+    return found[:k]
+
+
+def nearest_routes(index, lat, lng, k = 1, max_distance = None):
+    """
+    Returns
+    -------
+    [list] Routes starting at the `k` tracked origins nearest to the point,
+    nearest first, as dicts with route_id, origin and distance in meters.
+
+    Parameters
+    ----------
+    index: [dict] Output of new_index(), with routes added.
+
+    lat, lng: [float] Point to search from.
+
+    k: [int] Number of origins to consider.
+
+    max_distance: [float] Ignore origins farther than this, in meters.
+    """
+    if index['origins'] is None:
+        return []
+
+    return [
+        {'route_id': route_id, 'origin': location_code, 'distance': round(distance, 1)}
+        for distance, location_code in nearest_locations(
+            index['origins'], lat, lng, k, max_distance
+        )
+        for route_id in index['routes'][location_code]
+    ]
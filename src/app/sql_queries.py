@@ -11,3 +11,199 @@ trips_time_select = """
     FROM
       trips_time
 """
+
+# Trips streamed in while the app runs (see live.py): those of each route
+# departing after the last one the app has of it
+trips_time_since_select = """
+    SELECT
+      new_trips.*
+    FROM
+      unnest(%(route_ids)s::VARCHAR[], %(since)s::BIGINT[]) AS since (route_id, departure_ts)
+    CROSS JOIN LATERAL (
+      SELECT
+        *
+      FROM
+        trips_time
+      WHERE
+        trips_time.route_id = since.route_id
+        AND trips_time.departure_ts > since.departure_ts
+    ) AS new_trips
+"""
+
+
+route_signatures_select = """
+    SELECT
+      signature_id,
+      signature
+    FROM
+      route_signatures
+"""
+
+latest_load_select = """
+    SELECT
+      load_token
+    FROM
+      loads
+    ORDER BY
+      load_id DESC
+    LIMIT 1
+"""
+
+duration_sketches_select = """
+    SELECT
+      routes.route_code AS route_id,
+      duration_sketches.hour_of_week,
+      duration_sketches.num_trips,
+      duration_sketches.sketch
+    FROM
+      duration_sketches
+    JOIN
+      routes
+    ON
+      routes.route_id = duration_sketches.route_id
+"""
+
+departure_slots_select = """
+    SELECT
+      routes.route_code AS route_id,
+      departure_slots.day,
+      departure_slots.slot,
+      departure_slots.num_trips,
+      departure_slots.p50,
+      departure_slots.p90
+    FROM
+      departure_slots
+    JOIN
+      routes
+    ON
+      routes.route_id = departure_slots.route_id
+"""
+
+# Disruptions flagged by the ETL (see src/etl/disruptions.py), marked on the
+# time series at their worst trip
+disruptions_select = """
+    SELECT
+      routes.route_code AS route_id,
+      disruptions.kind,
+      disruptions.started_ts,
+      disruptions.ended_ts,
+      disruptions.num_trips,
+      disruptions.peak_ts,
+      disruptions.duration,
+      disruptions.expected,
+      disruptions.signature
+    FROM
+      disruptions
+    JOIN
+      routes
+    ON
+      routes.route_id = disruptions.route_id
+    ORDER BY
+      disruptions.peak_ts
+"""
+
+routes_select = """
+    SELECT
+      routes.route_code AS route_id,
+      origins.location_code AS origin,
+      destinations.location_code AS destination,
+      routes.mode
+    FROM
+      routes
+    JOIN
+      locations AS origins
+    ON
+      origins.location_id = routes.origin_id
+    LEFT JOIN
+      locations AS destinations
+    ON
+      destinations.location_id = routes.destination_id
+    ORDER BY
+      routes.route_code
+"""
+
+locations_select = """
+    SELECT
+      location_code,
+      latitude,
+      longitude
+    FROM
+      locations
+    ORDER BY
+      location_id
+"""
+
+# Conditions of the export queries' WHERE clause, by parameter. Only those of
+# the parameters given are put in (see export.where_clause()), so postgres
+# plans for the filters used, e.g. pruning partitions and using the
+# (route_id, departure_ts) index, rather than for a filter that may be NULL.
+trips_export_filters = {
+    'route_ids': 'trips_time.route_id = ANY(%(route_ids)s)',
+    'start_ts': 'trips_time.departure_ts >= %(start_ts)s',
+    'end_ts': 'trips_time.departure_ts < %(end_ts)s',
+}
+
+# Streamed by the export endpoint in load order, so the first rows go out
+# before the rest have been read. {where} is filled in by
+# export.where_clause(). Distance Matrix trips have no signature, so it is
+# NULL for them.
+trips_export_select = """
+    SELECT
+      trips_time.departure_ts,
+      trips_time.trip_id,
+      trips_time.route_id,
+      trips_time.start_location_id,
+      trips_time.duration,
+      trips_time.num_steps,
+      route_signatures.signature,
+      trips_time.minute,
+      trips_time.hour,
+      trips_time.day,
+      trips_time.week_of_year,
+      trips_time.month,
+      trips_time.year,
+      trips_time.is_weekday
+    FROM
+      trips_time
+    LEFT JOIN
+      route_signatures
+    USING
+      (signature_id)
+    {where}
+"""
+
+# One row per step. The steps come from the trip's route signature rather
+# than the steps table, which has no rows for the repeated trips (see
+# src/etl/dedup.py) loaded before etl.py wrote steps for each of them; trips
+# without transit steps get one row of NULLs.
+trips_steps_export_select = """
+    SELECT
+      trips_time.departure_ts,
+      trips_time.trip_id,
+      trips_time.route_id,
+      trips_time.start_location_id,
+      trips_time.duration,
+      trips_time.num_steps,
+      route_signatures.signature,
+      trips_time.minute,
+      trips_time.hour,
+      trips_time.day,
+      trips_time.week_of_year,
+      trips_time.month,
+      trips_time.year,
+      trips_time.is_weekday,
+      step.step_num,
+      step.line_name
+    FROM
+      trips_time
+    LEFT JOIN
+      route_signatures
+    USING
+      (signature_id)
+    LEFT JOIN LATERAL
+      unnest(string_to_array(NULLIF(route_signatures.signature, ''), '>'))
+      WITH ORDINALITY AS step(line_name, step_num)
+    ON
+      TRUE
+    {where}
+"""
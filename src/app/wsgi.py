@@ -0,0 +1,31 @@
+"""
+Production entry point for the Dash app.
+
+    cd src/app
+    gunicorn -c gunicorn.conf.py wsgi:server
+
+The gunicorn master makes sure the snapshot built by the last ETL load is
+present (building it from the database if it is missing or stale), so the
+trips_time data lives in one memory-mapped columnar snapshot (see
+src/common/snapshot.py). With preload_app the app is then imported once in
+the master, which maps the trips and builds the cube from them before
+forking the workers, so every worker shares the same read-only data instead
+of querying and processing the whole dataset itself.
+"""
+
+import gc
+import app_helpers
+import build_snapshot
+
+if app_helpers.fresh_snapshot() is None:
+    manifest = build_snapshot.build()
+    print('Snapshot {} with {} trips'.format(manifest['path'], manifest['num_rows']))
+
+import app as dashboard
+
+dashboard.preload()
+# Objects made so far live as long as the workers, so the collector leaves
+# them, and the pages they are on, untouched after the fork
+gc.freeze()
+
+server = dashboard.app.server
@@ -0,0 +1,360 @@
+"""
+This module benchmarks the ETL pipeline and the Dash app helpers on a corpus
+of trip JSON files, records the timings as JSON, and flags regressions against
+a stored baseline.
+
+Stages timed:
+  - extract: etl.extract_json() over every file
+  - transform: etl.transform_*() over every record
+  - load_<table>: inserts into each table (only with --db)
+  - create_df: app_helpers.create_df() (only with --db)
+  - process_df, time_series_main, stats_<stat>: app_helpers on the trips_time
+    frame, built from the transformed records when --db is not given
+
+Usage:
+    python src/bench/benchmark.py --routes 2 --months 12 --output results.json
+    python src/bench/benchmark.py --data data --baseline baseline.json
+
+Passing --db recreates the google_maps database on 127.0.0.1, so never point
+it at a database you care about.
+"""
+
+import argparse
+from datetime import datetime
+import glob
+import importlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import generate_data
+
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+etl_dir = os.path.join(src_dir, 'etl')
+app_dir = os.path.join(src_dir, 'app')
+
+# Columns of the trips_time view, in the order SELECT * returns them
+trips_time_columns = [
+    'departure_ts', 'trip_id', 'route_id', 'start_location_id', 'duration', 'num_steps',
+    'signature_id', 'minute', 'hour', 'day', 'week_of_year', 'month', 'year',
+    'is_weekday'
+]
+
+
+def import_from(directory, name):
+    """
+    Returns
+    -------
+    The module `name` imported from `directory`.
+
+    Both src/etl and src/app contain a sql_queries.py, so the cached copy is
+    dropped before each import to make sure every module picks up its own.
+    """
+    for shared in ['sql_queries', 'consts']:
+        sys.modules.pop(shared, None)
+    sys.path.insert(0, directory)
+    try:
+        module = importlib.import_module(name)
+    finally:
+        sys.path.remove(directory)
+    return module
+
+
+def timed(func, *args, repeat=1):
+    """
+    Returns
+    -------
+    Tuple of the best wall time in seconds over `repeat` calls of
+    func(*args) and the result of the last call.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def find_files(folder):
+    """
+    Returns
+    -------
+    [list] Sorted absolute paths of every JSON file under `folder`, found the
+    same way as etl.process_data().
+    """
+    all_files = []
+    for root, dirs, files in os.walk(folder):
+        for f in glob.glob(os.path.join(root, '*.json')):
+            all_files.append(os.path.abspath(f))
+    return sorted(all_files)
+
+
+def extract_all(etl, files):
+    """
+    Returns
+    -------
+    [list] Parsed records for every file that is valid JSON.
+    """
+    records = []
+    for datafile in files:
+        try:
+            records.append(etl.extract_json(datafile))
+        except json.decoder.JSONDecodeError:
+            pass
+    return records
+
+
+def transform_all(etl, records):
+    """
+    Returns
+    -------
+    Dict of table name to list of row tuples ready for insertion.
+    """
+    rows = {
+        'route_signatures': [], 'trips': [], 'locations': [], 'routes': [],
+        'time': [], 'steps': []
+    }
+    # Intern dimensions locally in first-seen order, which matches the
+    # SERIAL ids postgres hands out when they are inserted in the same order
+    location_ids = {}
+    route_ids = {}
+    signature_ids = {}
+    for data in records:
+        location = etl.transform_location(data)
+        if location[0] not in location_ids:
+            location_ids[location[0]] = len(location_ids) + 1
+            rows['locations'].append(location)
+
+        route_code, mode = etl.transform_route(data)
+        if route_code not in route_ids:
+            route_ids[route_code] = len(route_ids) + 1
+            rows['routes'].append((route_code, location_ids[location[0]], None, mode))
+
+        signature = etl.transform_signature(data)
+        # Distance Matrix trips have none, and get a NULL signature_id
+        if signature is not None and signature not in signature_ids:
+            signature_ids[signature] = len(signature_ids) + 1
+            rows['route_signatures'].append(
+                (etl.encode_signature(signature), len(signature))
+            )
+
+        route_id = route_ids[route_code]
+        # Runs of repeated trips (etl.dedup) are one trip per repeat
+        for trip in etl.dedup.expand(data):
+            rows['trips'].append(etl.transform_trip(
+                trip, route_id, location_ids[location[0]], signature_ids.get(signature)
+            ))
+            rows['time'].append(etl.transform_time(trip))
+            rows['steps'].extend(etl.transform_steps(trip, route_id))
+    return rows
+
+
+def load_table(cur, query, rows):
+    """
+    Inserts every tuple in `rows` with `query`, one statement per row as
+    etl.load_data() does.
+    """
+    for row in rows:
+        cur.execute(query, row)
+
+
+def build_trips_time(rows):
+    """
+    Returns
+    -------
+    [Pandas df] Equivalent of SELECT * FROM trips_time built in memory from
+    transformed rows, for benchmarking the app without a database.
+    """
+    import pandas as pd
+
+    time_rows = {row[0]: row[1:] for row in rows['time']}
+    location_codes = {
+        location_id: location[0]
+        for location_id, location in enumerate(rows['locations'], 1)
+    }
+    route_codes = {
+        route_id: route[0] for route_id, route in enumerate(rows['routes'], 1)
+    }
+    records = [
+        (ts, trip_id, route_codes[route_id], location_codes[location_id])
+        + tuple(trip) + time_rows[ts]
+        for trip_id, (ts, route_id, location_id, *trip) in enumerate(rows['trips'], 1)
+    ]
+    return pd.DataFrame.from_records(records, columns=trips_time_columns)
+
+
+def run(folder, use_db=False, repeat=1):
+    """
+    Returns
+    -------
+    Dict with metadata and the timing in seconds of each stage.
+
+    Parameters
+    ----------
+    folder: [str] Directory of trip JSON files.
+
+    use_db: [bool] Whether to time loading into and reading from postgres.
+
+    repeat: [int] Number of runs of each in-memory stage; the best is kept.
+    """
+    timings = {}
+
+    etl = import_from(etl_dir, 'etl')
+
+    files = find_files(folder)
+    print('{} files found in {}'.format(len(files), folder))
+
+    timings['extract'], records = timed(extract_all, etl, files, repeat=repeat)
+    timings['transform'], rows = timed(transform_all, etl, records, repeat=repeat)
+
+    if use_db:
+        create_tables = import_from(etl_dir, 'create_tables')
+        cur, conn = create_tables.create_database()
+        create_tables.drop_tables(cur)
+        create_tables.create_tables(cur)
+        create_tables.create_view(cur)
+
+        for route_id in range(1, len(rows['routes']) + 1):
+            cur.execute(etl.trips_partition_create.format(route_id))
+            cur.execute(etl.steps_partition_create.format(route_id))
+
+        for table, query in [
+            ('locations', etl.locations_table_insert),
+            ('routes', etl.routes_table_insert),
+            ('route_signatures', etl.route_signatures_table_insert),
+            ('time', etl.time_table_insert),
+            ('trips', etl.trips_table_insert),
+            ('steps', etl.steps_table_insert),
+        ]:
+            timings['load_' + table], _ = timed(
+                load_table, cur, query, rows[table]
+            )
+        conn.close()
+
+    app_helpers = import_from(app_dir, 'app_helpers')
+
+    if use_db:
+        timings['create_df'], tod_df = timed(app_helpers.create_df, repeat=repeat)
+    else:
+        tod_df = build_trips_time(rows)
+
+    timings['process_df'], _ = timed(
+        app_helpers.process_df, tod_df, repeat=repeat
+    )
+    timings['time_series_main'], _ = timed(
+        app_helpers.time_series_main, tod_df, repeat=repeat
+    )
+    for option in app_helpers.dropdown_options:
+        stat = option['value']
+        timings['stats_' + stat], _ = timed(
+            app_helpers.stats_main, tod_df, stat, repeat=repeat
+        )
+
+    return {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'num_files': len(files),
+            'num_records': len(records),
+            'num_steps': len(rows['steps']),
+            'db': use_db,
+            'repeat': repeat,
+        },
+        'timings': timings
+    }
+
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Returns
+    -------
+    [list] Names of stages that are slower than the baseline by more than
+    `tolerance` (a fraction) and by more than `min_seconds` in absolute terms.
+
+    Prints a table comparing every stage that appears in both runs.
+    """
+    regressions = []
+    print('{:<24}{:>12}{:>12}{:>10}'.format('stage', 'baseline', 'current', 'ratio'))
+    for stage, current in results['timings'].items():
+        previous = baseline['timings'].get(stage)
+        if previous is None:
+            continue
+        ratio = current / previous if previous else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance and current - previous > min_seconds:
+            regressions.append(stage)
+            flag = '  REGRESSION'
+        print('{:<24}{:>12.4f}{:>12.4f}{:>10.2f}{}'.format(
+            stage, previous, current, ratio, flag
+        ))
+    return regressions
+
+
+def main():
+    """
+    Parses command line arguments, generates a corpus if needed, runs the
+    benchmark and compares against a baseline. Exits with status 1 when a
+    regression is found.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark ETL and app helpers on a trip corpus.'
+    )
+    parser.add_argument('--data',
+                        help='existing corpus; generated when omitted')
+    parser.add_argument('--routes', type=int, default=2)
+    parser.add_argument('--months', type=int, default=1)
+    parser.add_argument('--db', action='store_true',
+                        help='also time loading into postgres (DROPS google_maps)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline',
+                        help='JSON results of a previous run to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write results to --baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.20,
+                        help='allowed slowdown as a fraction of the baseline')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='ignore slowdowns smaller than this')
+    args = parser.parse_args()
+
+    if args.data:
+        results = run(args.data, args.db, args.repeat)
+    else:
+        with tempfile.TemporaryDirectory() as folder:
+            generate_data.generate(folder, args.routes, args.months)
+            results = run(folder, args.db, args.repeat)
+        results['meta']['routes'] = args.routes
+        results['meta']['months'] = args.months
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+    if not args.baseline:
+        return
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Baseline written to {}'.format(args.baseline))
+        return
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+    if regressions:
+        print('{} stage(s) regressed: {}'.format(
+            len(regressions), ', '.join(regressions)
+        ))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+This module checks data collection end to end against the fake Google Maps
+server in fake_maps.py: one round in the default mode, one in Distance Matrix
+batch mode, and one in batch mode with trip A still getting full directions.
+Every trip file written must be in the format etl.py consumes, and both
+modes must agree on the trip durations. It then compares how many API
+requests each mode needs as the number of routes grows, and how many
+Distance Matrix elements, which are what it is billed by, batch mode pays
+for.
+
+Usage:
+    python src/bench/collection_check.py --locations 2 5 10 20
+
+Exits with status 1 if any check fails.
+"""
+
+import argparse
+from datetime import datetime
+import glob
+import json
+import os
+import sys
+import tempfile
+import fake_maps
+
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+etl_dir = os.path.join(src_dir, 'etl')
+
+trip_keys = {
+    'start_location', 'start_location_id', 'departure_time', 'arrival_time',
+    'duration', 'steps', 'route_id', 'end_location', 'end_location_id', 'mode'
+}
+
+# Only Distance Matrix trips have it
+optional_keys = {'source'}
+
+config_template = """
+api_key = 'AIzaFakeKeyForTheLocalFakeServer'
+location_A = 'One World Trade Center'
+location_B = '476 5th Ave, New York, NY 10018'
+base_url = '{}'
+"""
+
+
+def request_counts(base_url):
+    """
+    Returns
+    -------
+    [dict] Requests served so far by the fake server, per endpoint.
+    """
+    import urllib.request
+    with urllib.request.urlopen(base_url + '/stats') as response:
+        return json.load(response)
+
+
+def read_trips(folder):
+    """
+    Returns
+    -------
+    [list] Every trip JSON written under `folder`/data.
+    """
+    trips = []
+    for path in sorted(glob.glob(os.path.join(folder, 'data', '*', '*.json'))):
+        with open(path, 'r') as f:
+            trips.append(json.load(f))
+    return trips
+
+
+def check_trip(etl, trip):
+    """
+    Returns
+    -------
+    [list] Problems with `trip` as input to etl.py. Empty if there are none.
+    """
+    problems = []
+    if set(trip) - optional_keys != trip_keys:
+        problems.append('keys {} instead of {}'.format(sorted(trip), sorted(trip_keys)))
+        return problems
+    reason = etl.validation.validate_trip(trip)
+    if reason is not None:
+        problems.append('etl.py would reject it: {}'.format(reason))
+        return problems
+    try:
+        etl.transform_location(trip)
+        etl.transform_time(trip)
+        etl.transform_signature(trip)
+        etl.transform_end_location(trip)
+        etl.transform_route(trip)
+        etl.transform_trip(trip, 1, 1, 1)
+        etl.transform_steps(trip, 1)
+    except Exception as e:
+        problems.append('etl.py cannot transform it: {!r}'.format(e))
+    return problems
+
+
+def run_round(data_collection, folder, batch, detail_ids):
+    """
+    Runs one round of data_collection.main() inside `folder`.
+    """
+    os.makedirs(folder)
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        data_collection.main(batch, detail_ids)
+    finally:
+        os.chdir(cwd)
+
+
+def scaling(data_collection, base_url, location_counts):
+    """
+    Prints the number of API requests needed to collect every route between
+    `n` locations, for each n in `location_counts`, with one Directions
+    call per route and with batched Distance Matrix calls.
+    """
+    gmaps_client = data_collection.create_client(
+        'AIzaFakeKeyForTheLocalFakeServer', base_url
+    )
+    start_time = datetime.now()
+
+    print('{:>10}{:>10}{:>14}{:>10}{:>10}'.format(
+        'locations', 'routes', 'directions', 'matrix', 'elements'
+    ))
+    for n in location_counts:
+        coords = [fake_maps.geocode('location {}'.format(i)) for i in range(n)]
+        trips = [
+            {
+                'route_id': '{}-{}'.format(i, j),
+                'start_location_id': str(i),
+                'end_location_id': str(j),
+                'coords': [coords[i], coords[j]],
+                'mode': 'transit',
+            }
+            for i in range(n) for j in range(n) if i != j
+        ]
+        before = request_counts(base_url)
+        data_collection.collect_matrix(gmaps_client, trips, start_time)
+        after = request_counts(base_url)
+        print('{:>10}{:>10}{:>14}{:>10}{:>10}'.format(
+            n,
+            len(trips),
+            len(trips),
+            after['distancematrix'] - before.get('distancematrix', 0),
+            after['distancematrix_elements'] - before.get('distancematrix_elements', 0)
+        ))
+
+
+def main():
+    """
+    Starts the fake server, runs the checks and prints the results.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Check data collection against a fake Google Maps server.'
+    )
+    parser.add_argument('--locations', type = int, nargs = '*', default = [2, 5, 10, 20])
+    args = parser.parse_args()
+
+    server, base_url = fake_maps.start()
+
+    with tempfile.TemporaryDirectory() as folder:
+        # data_collection.py reads its settings from config.py
+        with open(os.path.join(folder, 'config.py'), 'w') as f:
+            f.write(config_template.format(base_url))
+        sys.path.insert(0, folder)
+        sys.path.insert(0, etl_dir)
+        import data_collection
+        import etl
+
+        rounds = [
+            ('directions', False, []),
+            ('batch', True, []),
+            ('batch --detail A', True, ['A']),
+        ]
+        trips = {}
+        failures = []
+        print('{:<20}{:>8}{:>14}{:>10}{:>10}{:>8}'.format(
+            'mode', 'trips', 'directions', 'matrix', 'elements', 'steps'
+        ))
+        for name, batch, detail_ids in rounds:
+            before = request_counts(base_url)
+            run_round(data_collection, os.path.join(folder, name), batch, detail_ids)
+            after = request_counts(base_url)
+
+            trips[name] = read_trips(os.path.join(folder, name))
+            for trip in trips[name]:
+                for problem in check_trip(etl, trip):
+                    failures.append('{} {}: {}'.format(name, trip['route_id'], problem))
+
+            print('{:<20}{:>8}{:>14}{:>10}{:>10}{:>8}'.format(
+                name,
+                len(trips[name]),
+                after.get('directions', 0) - before.get('directions', 0),
+                after.get('distancematrix', 0) - before.get('distancematrix', 0),
+                after.get('distancematrix_elements', 0) - before.get('distancematrix_elements', 0),
+                sum(len(trip['steps']) for trip in trips[name])
+            ))
+
+        # Same routes at the same time must take the same time in every mode
+        durations = {
+            name: {trip['route_id']: trip['duration'] for trip in mode_trips}
+            for name, mode_trips in trips.items()
+        }
+        for name in durations:
+            if durations[name] != durations['directions']:
+                failures.append('{} durations {} differ from directions {}'.format(
+                    name, durations[name], durations['directions']
+                ))
+
+        print()
+        scaling(data_collection, base_url, args.locations)
+
+    server.shutdown()
+
+    if failures:
+        print()
+        print('\n'.join(failures))
+        sys.exit(1)
+    print()
+    print('All trips are in the format etl.py consumes.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+This module measures what deduplicating repeated trips (src/etl/dedup.py)
+saves on a corpus: the files and bytes the collector writes and uploads,
+the rows the ETL inserts, and the time to extract, transform and, with --db,
+load them. The corpus is read one file per trip, re-encoded into runs as
+the collector would have written it with --dedup, and both are put through
+the ETL. Both must give the same trips and times, or this exits with
+status 1.
+
+Usage:
+    python src/bench/dedup_check.py
+    python src/bench/dedup_check.py --data data --db
+
+Passing --db recreates the google_maps database on 127.0.0.1, so never point
+it at a database you care about.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import zipfile
+import benchmark
+
+
+repo_dir = os.path.dirname(benchmark.src_dir)
+
+
+def folder_size(folder):
+    """
+    Returns
+    -------
+    Tuple of the number of JSON files under `folder` and their total bytes.
+    """
+    files = benchmark.find_files(folder)
+    return len(files), sum(os.path.getsize(f) for f in files)
+
+
+def load_all(etl, rows):
+    """
+    Inserts `rows` into freshly created tables.
+
+    Returns
+    -------
+    [float] Seconds the inserts took.
+    """
+    create_tables = benchmark.import_from(benchmark.etl_dir, 'create_tables')
+    cur, conn = create_tables.create_database()
+    create_tables.drop_tables(cur)
+    create_tables.create_tables(cur)
+    create_tables.create_view(cur)
+    for route_id in range(1, len(rows['routes']) + 1):
+        cur.execute(etl.trips_partition_create.format(route_id))
+        cur.execute(etl.steps_partition_create.format(route_id))
+
+    seconds = 0
+    for table, query in [
+        ('locations', etl.locations_table_insert),
+        ('routes', etl.routes_table_insert),
+        ('route_signatures', etl.route_signatures_table_insert),
+        ('time', etl.time_table_insert),
+        ('trips', etl.trips_table_insert),
+        ('steps', etl.steps_table_insert),
+    ]:
+        elapsed, _ = benchmark.timed(benchmark.load_table, cur, query, rows[table])
+        seconds += elapsed
+    conn.close()
+    return seconds
+
+
+def measure(etl, folder, use_db, repeat):
+    """
+    Returns
+    -------
+    Tuple of a dict of measurements of the corpus in `folder` and its
+    transformed rows.
+    """
+    num_files, num_bytes = folder_size(folder)
+    files = benchmark.find_files(folder)
+    extract, records = benchmark.timed(benchmark.extract_all, etl, files, repeat=repeat)
+    transform, rows = benchmark.timed(benchmark.transform_all, etl, records, repeat=repeat)
+
+    results = {
+        'files': num_files,
+        'bytes': num_bytes,
+        'trips': len(rows['trips']),
+        'rows': sum(len(table_rows) for table_rows in rows.values()),
+        'extract ms': extract * 1000,
+        'transform ms': transform * 1000,
+    }
+    if use_db:
+        results['load ms'] = load_all(etl, rows) * 1000
+    return results, rows
+
+
+def main():
+    """
+    Parses command line arguments and prints the corpus measured as one
+    file per trip and as runs.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Measure what deduplicating repeated trips saves.'
+    )
+    parser.add_argument('--data', default = os.path.join(repo_dir, 'data.zip'),
+                        help = 'folder of route subdirectories, or a zip of one')
+    parser.add_argument('--db', action = 'store_true',
+                        help = 'also time loading into postgres (DROPS google_maps)')
+    parser.add_argument('--repeat', type = int, default = 3)
+    args = parser.parse_args()
+
+    etl = benchmark.import_from(benchmark.etl_dir, 'etl')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = args.data
+        if zipfile.is_zipfile(source):
+            with zipfile.ZipFile(source) as archive:
+                archive.extractall(tmp)
+            source = os.path.join(tmp, 'data')
+
+        encoded = os.path.join(tmp, 'runs')
+        etl.dedup.encode_folder(source, encoded)
+
+        plain, plain_rows = measure(etl, source, args.db, args.repeat)
+        runs, runs_rows = measure(etl, encoded, args.db, args.repeat)
+
+    print('{:<16}{:>14}{:>14}{:>10}'.format('', 'per trip', 'runs', 'saved'))
+    for name in plain:
+        saved = 1 - runs[name] / plain[name] if plain[name] else 0
+        print('{:<16}{:>14.0f}{:>14.0f}{:>10.1%}'.format(name, plain[name], runs[name], saved))
+
+    # Runs keep the files in order, so dimension ids come out the same
+    if sorted(plain_rows['time']) != sorted(runs_rows['time']) \
+            or sorted(plain_rows['trips']) != sorted(runs_rows['trips']):
+        print('Runs do not expand back to the same trips')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+This module replays recorded trips through the disruption detector
+(src/etl/disruptions.py), to measure what it costs per trip, that its state
+stays the same size however long it runs, and how well it flags
+disruptions.
+
+The recording, usually a week, is replayed --weeks times back to back, one
+week later each time, like a route that behaves the same every week. It is
+replayed once as is, where anything flagged is either a real disruption in
+the recording or a false alarm, and once with disruptions injected after
+the first week: --inject per route, each --length minutes long, half of
+them slow (every trip takes --delay minutes longer) and half detours (every
+trip rides a line the route never takes). An injected disruption counts as
+detected if one of its kind opens during it, and the delay is from its
+first trip to the start of the first one flagged. Detours are dated from
+their first trip off route, though only flagged once there are
+disruptions.min_run of them.
+
+Usage:
+    python src/bench/disruption_check.py
+    python src/bench/disruption_check.py --data data --weeks 8 --inject 30 --delay 10
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+import benchmark
+import fake_maps
+from load_test import percentile
+
+
+repo_dir = os.path.dirname(benchmark.src_dir)
+
+week_seconds = 7 * 24 * 3600
+
+# Line ridden by the n-th injected detour, a new one each time
+detour_line = 'SHUTTLE{}'
+
+
+def read_trips(etl, path):
+    """
+    Returns
+    -------
+    [dict] Trips recorded under `path` by route code, each a list of
+    (departure_ts, duration, signature, hour_of_week) in order of departure.
+    """
+    routes = {}
+    for data in fake_maps.read_recorded_files(path):
+        route_code = etl.transform_route(data)[0]
+        signature = etl.transform_signature(data)
+        if signature is not None:
+            signature = etl.encode_signature(signature)
+        for trip in etl.dedup.expand(data):
+            time_data = etl.transform_time(trip)
+            routes.setdefault(route_code, []).append((
+                trip['departure_time'],
+                trip['duration'],
+                signature,
+                etl.hour_of_week(time_data[3], time_data[2])
+            ))
+    return {route_code: sorted(trips) for route_code, trips in routes.items()}
+
+
+def repeat_weeks(routes, weeks):
+    """
+    Returns
+    -------
+    [dict] The trips of `routes` repeated `weeks` times, a week apart.
+    """
+    return {
+        route_code: [
+            (departure_ts + week * week_seconds, duration, signature, week_hour)
+            for week in range(weeks)
+            for departure_ts, duration, signature, week_hour in trips
+        ]
+        for route_code, trips in routes.items()
+    }
+
+
+def inject(routes, count, length, delay, rng):
+    """
+    Returns
+    -------
+    Tuple of a copy of `routes` with `count` disruptions injected per route
+    after its first week, and a list of them as (route_code, kind,
+    first_ts, last_ts) of the trips they changed.
+    """
+    injected = []
+    changed = {}
+    for route_code, trips in routes.items():
+        trips = list(trips)
+        first_week = trips[0][0] + week_seconds
+        candidates = [i for i, trip in enumerate(trips) if trip[0] >= first_week]
+        starts = sorted(rng.sample(candidates, min(count, len(candidates))))
+
+        taken_until = 0
+        for n, start in enumerate(starts):
+            # Disruptions don't overlap, and leave an hour between them
+            if trips[start][0] < taken_until:
+                continue
+            kind = 'slow' if n % 2 == 0 else 'detour'
+            end_ts = trips[start][0] + length * 60
+            i = start
+            while i < len(trips) and trips[i][0] < end_ts:
+                departure_ts, duration, signature, week_hour = trips[i]
+                if kind == 'slow':
+                    trips[i] = (departure_ts, duration + delay, signature, week_hour)
+                else:
+                    trips[i] = (departure_ts, duration, detour_line.format(n), week_hour)
+                i += 1
+            injected.append((route_code, kind, trips[start][0], trips[i - 1][0]))
+            taken_until = end_ts + 3600
+        changed[route_code] = trips
+    return changed, injected
+
+
+def run(disruptions, routes):
+    """
+    Feeds every trip of `routes` through a detector per route, in order of
+    departure, as the ETL would.
+
+    Returns
+    -------
+    [dict] Every disruption flagged, as (route_code, disruption) by their
+    start ('flagged'), the seconds spent in observe() ('seconds'), the trips
+    fed ('trips') and the mean size in bytes of a route's state as JSON at
+    the end of each week ('state_bytes').
+    """
+    states = {route_code: disruptions.new_route() for route_code in routes}
+    # Interleaved by departure across routes, as they are collected
+    trips = sorted(
+        (trip, route_code) for route_code, route_trips in routes.items() for trip in route_trips
+    )
+    flagged = {}
+    state_bytes = []
+    week_end = trips[0][0][0] + week_seconds
+
+    seconds = 0
+    for (departure_ts, duration, signature, week_hour), route_code in trips:
+        if departure_ts >= week_end:
+            state_bytes.append(
+                sum(len(json.dumps(state)) for state in states.values()) / len(states)
+            )
+            week_end += week_seconds
+        started = time.perf_counter()
+        changed = disruptions.observe(
+            states[route_code], week_hour, departure_ts, duration, signature
+        )
+        seconds += time.perf_counter() - started
+        for disruption in changed:
+            flagged[(route_code, disruption['kind'], disruption['started_ts'])] = disruption
+    state_bytes.append(sum(len(json.dumps(state)) for state in states.values()) / len(states))
+
+    return {
+        'flagged': [(key[0], disruption) for key, disruption in sorted(flagged.items())],
+        'seconds': seconds,
+        'trips': len(trips),
+        'state_bytes': state_bytes,
+    }
+
+
+def match(flagged, injected, grace):
+    """
+    Returns
+    -------
+    Tuple of a dict by kind of the delays, in minutes, of the injected
+    disruptions detected, and the number of disruptions flagged that don't
+    overlap any injected one, allowing `grace` seconds after each.
+    """
+    delays = {'slow': [], 'detour': []}
+    for route_code, kind, first_ts, last_ts in injected:
+        starts = [
+            disruption['started_ts'] for flagged_route, disruption in flagged
+            if flagged_route == route_code and disruption['kind'] == kind
+            and first_ts <= disruption['started_ts'] <= last_ts
+        ]
+        if starts:
+            delays[kind].append((min(starts) - first_ts) / 60)
+
+    false_alarms = sum(
+        1 for flagged_route, disruption in flagged
+        if not any(
+            flagged_route == route_code and first_ts <= disruption['started_ts'] <= last_ts + grace
+            for route_code, _, first_ts, last_ts in injected
+        )
+    )
+    return delays, false_alarms
+
+
+def main():
+    """
+    Parses command line arguments, replays the recording clean and with
+    disruptions injected, and prints the cost and accuracy of the detector.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Replay recorded trips through the disruption detector.'
+    )
+    parser.add_argument('--data', default = os.path.join(repo_dir, 'data.zip'),
+                        help = 'folder of route subdirectories, or a zip of one')
+    parser.add_argument('--weeks', type = int, default = 4,
+                        help = 'times to replay the recording, a week apart')
+    parser.add_argument('--inject', type = int, default = 20,
+                        help = 'disruptions to inject per route')
+    parser.add_argument('--length', type = int, default = 60,
+                        help = 'minutes each injected disruption lasts')
+    parser.add_argument('--delay', type = int, default = 15,
+                        help = 'minutes an injected slow disruption adds to each trip')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--verbose', action = 'store_true',
+                        help = 'list the disruptions flagged in the clean replay')
+    args = parser.parse_args()
+
+    etl = benchmark.import_from(benchmark.etl_dir, 'etl')
+    disruptions = etl.disruptions
+
+    routes = repeat_weeks(read_trips(etl, args.data), args.weeks)
+    dirty, injected = inject(routes, args.inject, args.length, args.delay,
+                             random.Random(args.seed))
+
+    clean = run(disruptions, routes)
+    results = run(disruptions, dirty)
+
+    print('Replayed {} weeks of {} routes: {} trips, {:.1f} us per trip'.format(
+        args.weeks, len(routes), clean['trips'], clean['seconds'] / clean['trips'] * 1e6
+    ))
+    print('State per route, weekly: {} KB'.format(
+        ', '.join('{:.1f}'.format(size / 1024) for size in clean['state_bytes'])
+    ))
+
+    print()
+    print('Clean replay: {} disruptions flagged ({:.1f} per route-week)'.format(
+        len(clean['flagged']), len(clean['flagged']) / len(routes) / args.weeks
+    ))
+    if args.verbose:
+        for route_code, disruption in clean['flagged']:
+            print('  {} {:<6} {} trips from {}, worst {} min for {} expected'.format(
+                route_code, disruption['kind'], disruption['num_trips'],
+                time.strftime('%a %Y-%m-%d %H:%M', time.localtime(disruption['started_ts'])),
+                disruption['duration'], disruption['expected']
+            ))
+
+    delays, false_alarms = match(results['flagged'], injected, args.length * 60)
+    print()
+    print('Injected after week 1: {} min long, slow ones +{} min'.format(args.length, args.delay))
+    print('{:<10}{:>10}{:>10}{:>10}{:>14}{:>14}'.format(
+        '', 'injected', 'detected', 'recall', 'delay p50', 'delay max'
+    ))
+    for kind in ['slow', 'detour']:
+        num_injected = sum(1 for _, injected_kind, _, _ in injected if injected_kind == kind)
+        kind_delays = delays[kind]
+        print('{:<10}{:>10}{:>10}{:>10.0%}{:>14}{:>14}'.format(
+            kind, num_injected, len(kind_delays),
+            len(kind_delays) / num_injected if num_injected else 0,
+            '{:.0f} min'.format(percentile(kind_delays, 50)) if kind_delays else 'n/a',
+            '{:.0f} min'.format(max(kind_delays)) if kind_delays else 'n/a'
+        ))
+    print('Flagged outside injected disruptions: {}'.format(false_alarms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,483 @@
+"""
+This module runs a local stand-in for the Google Maps Geocoding, Directions
+and Distance Matrix APIs, so data collection can be exercised without an API
+key, network access or cost.
+
+Responses follow the shape of the real APIs, with only the fields
+data_collection.py reads filled in realistically. Trip durations depend on
+the distance between the two points and on the hour of departure (slower at
+rush hour), and Directions and Distance Matrix agree on them. Every request
+is counted per endpoint; GET /stats returns the counts.
+
+It can also replay recorded trips instead: with --recorded, a folder of
+route subdirectories or a zip of one (e.g. data.zip), every address geocodes
+to one of the recorded origins, in the order they are first asked for, and
+each trip takes as long and rides the same lines as the recorded trip from
+that origin nearest in time of week.
+
+To exercise the collector's retries, responses can be slowed down by
+--latency milliseconds (give or take --jitter), a fraction --error-rate of
+requests fail with HTTP 503, and requests beyond --qps per second get the
+OVER_QUERY_LIMIT status the real APIs answer with. The googlemaps client
+retries both, backing off as it would against Google.
+
+Point data_collection.py at it by adding to config.py:
+
+    base_url = 'http://127.0.0.1:8099'
+
+The API key must still look like a real one (start with 'AIza'), since the
+googlemaps client checks it before sending anything.
+
+Usage:
+    python src/bench/fake_maps.py --port 8099
+    python src/bench/fake_maps.py --recorded data.zip --latency 200 --jitter 100 --error-rate 0.02 --qps 10
+"""
+
+import argparse
+import bisect
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import zipfile
+
+
+# Lines a trip rides, chosen by hour so route signatures vary over the day
+lines_by_hour = [
+    ['L', 'G', 'E'] if 7 <= hour < 10 or 16 <= hour < 19 else ['L', 'A']
+    for hour in range(24)
+]
+
+
+def geocode(address):
+    """
+    Returns
+    -------
+    [dict] Deterministic coordinates in New York City for `address`.
+    """
+    digest = hashlib.md5(address.encode()).digest()
+    return {
+        'lat': 40.65 + digest[0] / 255 * 0.15,
+        'lng': -74.02 + digest[1] / 255 * 0.15,
+    }
+
+
+def parse_location(text):
+    """
+    Returns
+    -------
+    [dict] Coordinates of a 'lat,lng' query parameter.
+    """
+    lat, lng = text.split(',')
+    return {'lat': float(lat), 'lng': float(lng)}
+
+
+def distance_meters(origin, destination):
+    """
+    Returns
+    -------
+    [int] Great circle distance between two coordinates.
+    """
+    lat1, lng1 = math.radians(origin['lat']), math.radians(origin['lng'])
+    lat2, lng2 = math.radians(destination['lat']), math.radians(destination['lng'])
+    a = math.sin((lat2 - lat1) / 2) ** 2 \
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return int(6371000 * 2 * math.asin(math.sqrt(a)))
+
+
+def trip_seconds(origin, destination, departure_time):
+    """
+    Returns
+    -------
+    [int] Transit trip duration: about 4 minutes per km plus 10 minutes of
+    walking and waiting, up to 30% longer at rush hour.
+    """
+    hour = datetime.fromtimestamp(departure_time).hour
+    rush = 1.3 if 7 <= hour < 10 or 16 <= hour < 19 else 1.0
+    return int((distance_meters(origin, destination) * 0.24 + 600) * rush)
+
+
+def week_seconds(timestamp):
+    """
+    Returns
+    -------
+    [int] Seconds since Monday 00:00 at `timestamp`, in local time.
+    """
+    when = datetime.fromtimestamp(timestamp)
+    return when.weekday() * 86400 + when.hour * 3600 + when.minute * 60 + when.second
+
+
+def read_recorded_files(path):
+    """
+    Yields the JSON of every trip file in the route subdirectories of the
+    folder `path`, or of the folder a zip at `path` holds.
+    """
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in sorted(archive.namelist()):
+                if name.endswith('.json'):
+                    yield json.loads(archive.read(name))
+        return
+
+    for sub_dir in sorted(os.listdir(path)):
+        folder = os.path.join(path, sub_dir)
+        if os.path.isdir(folder):
+            for name in sorted(os.listdir(folder)):
+                if name.endswith('.json'):
+                    with open(os.path.join(folder, name), 'r') as f:
+                        yield json.load(f)
+
+
+def load_recording(path):
+    """
+    Returns
+    -------
+    [dict] The trips recorded under `path` (see read_recorded_files()), by
+    origin: 'origins' holds the coordinates of each, and 'trips' a list per
+    origin of (seconds since Monday, duration in seconds, lines ridden),
+    sorted. Runs of repeated trips (src/etl/dedup.py) count once per repeat.
+    """
+    by_origin = {}
+    for data in read_recorded_files(path):
+        origin = by_origin.setdefault(
+            data['start_location_id'], {'coords': data['start_location'], 'trips': []}
+        )
+        lines = [step['line_name'] for step in data['steps']]
+        times = [(data['departure_time'], data['arrival_time'])]
+        times += [
+            (data['departure_time'] + departure_offset, data['arrival_time'] + arrival_offset)
+            for departure_offset, arrival_offset in data.get('repeats', [])
+        ]
+        for departure_time, arrival_time in times:
+            origin['trips'].append(
+                (week_seconds(departure_time), arrival_time - departure_time, lines)
+            )
+
+    origin_ids = sorted(by_origin)
+    return {
+        'origins': [by_origin[origin_id]['coords'] for origin_id in origin_ids],
+        'trips': [sorted(by_origin[origin_id]['trips']) for origin_id in origin_ids],
+    }
+
+
+def recorded_trip(recording, origin, departure_time):
+    """
+    Returns
+    -------
+    Tuple of the duration in seconds and the lines of the trip recorded from
+    the origin nearest `origin` whose time of week is nearest that of
+    `departure_time`.
+    """
+    nearest = min(
+        range(len(recording['origins'])),
+        key = lambda i: distance_meters(recording['origins'][i], origin)
+    )
+    trips = recording['trips'][nearest]
+
+    # The week wraps around, so Sunday night is next to Monday morning
+    when = week_seconds(departure_time)
+    i = bisect.bisect_left(trips, (when,))
+    candidates = [trips[i % len(trips)], trips[i - 1]]
+    _, duration, lines = min(
+        candidates,
+        key = lambda trip: min(abs(trip[0] - when), 7 * 86400 - abs(trip[0] - when))
+    )
+    return duration, lines
+
+
+def route_seconds(origin, destination, departure_time, recording = None):
+    """
+    Returns
+    -------
+    [int] Trip duration, recorded if there is a `recording`, else modelled
+    by trip_seconds().
+    """
+    if recording is None:
+        return trip_seconds(origin, destination, departure_time)
+    return recorded_trip(recording, origin, departure_time)[0]
+
+
+def directions_route(origin, destination, departure_time, recording = None):
+    """
+    Returns
+    -------
+    [dict] One Directions route with a walking step, a transit step per line
+    and a final walking step. With a `recording` (see load_recording()),
+    the duration and lines are those of the nearest recorded trip.
+    """
+    if recording is None:
+        duration = trip_seconds(origin, destination, departure_time)
+        lines = lines_by_hour[datetime.fromtimestamp(departure_time).hour]
+    else:
+        duration, lines = recorded_trip(recording, origin, departure_time)
+    distance = distance_meters(origin, destination)
+
+    steps = [{
+        'travel_mode': 'WALKING',
+        'distance': {'text': '0.2 mi', 'value': 300},
+        'duration': {'text': '4 mins', 'value': 240},
+        'html_instructions': 'Walk to station',
+    }]
+    for line in lines:
+        steps.append({
+            'travel_mode': 'TRANSIT',
+            'distance': {'text': '', 'value': distance // len(lines)},
+            'duration': {'text': '', 'value': max(duration - 480, 0) // len(lines)},
+            'html_instructions': 'Subway towards {} terminal'.format(line),
+            'transit_details': {
+                'line': {'short_name': line, 'name': line + ' Line',
+                         'vehicle': {'type': 'SUBWAY'}},
+                'headsign': line + ' terminal',
+                'num_stops': 5,
+            },
+        })
+    steps.append({
+        'travel_mode': 'WALKING',
+        'distance': {'text': '0.2 mi', 'value': 300},
+        'duration': {'text': '4 mins', 'value': 240},
+        'html_instructions': 'Walk to destination',
+    })
+
+    return {
+        'summary': '',
+        'legs': [{
+            'start_location': origin,
+            'end_location': destination,
+            'departure_time': {'text': '', 'value': departure_time},
+            'arrival_time': {'text': '', 'value': departure_time + duration},
+            'duration': {'text': '', 'value': duration},
+            'distance': {'text': '', 'value': distance},
+            'steps': steps,
+        }],
+        'warnings': [],
+    }
+
+
+class FakeMapsHandler(BaseHTTPRequestHandler):
+    """
+    Serves /maps/api/{geocode,directions,distancematrix}/json and /stats,
+    the requests served per endpoint and the Distance Matrix elements billed.
+
+    The class attributes are the server's settings and state; start() sets
+    them.
+    """
+
+    counts = {}
+    lock = threading.Lock()
+
+    # Seconds each response is held back, give or take `jitter`
+    latency = 0
+    jitter = 0
+    # Fraction of requests answered with HTTP 503
+    error_rate = 0
+    # Requests allowed per second, or None for no limit
+    qps = None
+    # load_recording() of the trips to replay, or None to model them
+    recording = None
+
+    rng = random.Random()
+    tokens = 0
+    refilled_at = 0
+    addresses = {}
+
+    def count(self, key, amount = 1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def over_limit(self):
+        """
+        Returns
+        -------
+        [bool] Whether this request exceeds `qps`, by a token bucket holding
+        one second's worth of requests.
+        """
+        if self.qps is None:
+            return False
+        with self.lock:
+            cls = type(self)
+            now = time.monotonic()
+            cls.tokens = min(self.qps, cls.tokens + (now - cls.refilled_at) * self.qps)
+            cls.refilled_at = now
+            if cls.tokens < 1:
+                return True
+            cls.tokens -= 1
+            return False
+
+    def geocode(self, address):
+        """
+        Returns
+        -------
+        [dict] Coordinates of `address`: made up from its hash, or with a
+        recording, those of the next recorded origin not yet given out.
+        """
+        if self.recording is None:
+            return geocode(address)
+        with self.lock:
+            index = self.addresses.setdefault(address, len(self.addresses))
+        origins = self.recording['origins']
+        return origins[index % len(origins)]
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        endpoint = url.path.strip('/').split('/')[-2] if url.path.startswith('/maps/api/') else url.path
+
+        self.count(endpoint)
+
+        if url.path == '/stats':
+            return self.send_json(self.counts)
+
+        if self.latency or self.jitter:
+            time.sleep(max(self.latency + self.rng.uniform(-self.jitter, self.jitter), 0))
+        if self.rng.random() < self.error_rate:
+            self.count('error')
+            self.send_error(503)
+            return
+        if self.over_limit():
+            self.count('over_query_limit')
+            return self.send_json({
+                'status': 'OVER_QUERY_LIMIT',
+                'error_message': 'You have exceeded your rate-limit for this API.',
+            })
+
+        departure_time = int(params.get('departure_time', datetime.now().timestamp()))
+
+        if endpoint == 'geocode':
+            body = {'status': 'OK', 'results': [
+                {'geometry': {'location': self.geocode(params['address'])}}
+            ]}
+        elif endpoint == 'directions':
+            body = {'status': 'OK', 'routes': [directions_route(
+                parse_location(params['origin']),
+                parse_location(params['destination']),
+                departure_time,
+                self.recording
+            )]}
+        elif endpoint == 'distancematrix':
+            origins = [parse_location(o) for o in params['origins'].split('|')]
+            destinations = [parse_location(d) for d in params['destinations'].split('|')]
+            self.count('distancematrix_elements', len(origins) * len(destinations))
+            body = {'status': 'OK', 'rows': [
+                {'elements': [{
+                    'status': 'OK',
+                    'duration': {'text': '', 'value': route_seconds(o, d, departure_time, self.recording)},
+                    'distance': {'text': '', 'value': distance_meters(o, d)},
+                } for d in destinations]}
+                for o in origins
+            ]}
+        else:
+            self.send_error(404)
+            return
+
+        self.send_json(body)
+
+    def send_json(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def configure(latency = 0, jitter = 0, error_rate = 0, qps = None, recording = None,
+              seed = None):
+    """
+    Resets the counts and sets how the server behaves.
+
+    Parameters
+    ----------
+    latency, jitter: [float] Seconds each response is held back, give or
+    take up to `jitter`.
+
+    error_rate: [float] Fraction of requests answered with HTTP 503.
+
+    qps: [float] Requests allowed per second before OVER_QUERY_LIMIT, or
+    None for no limit.
+
+    recording: [dict] load_recording() of the trips to replay, or None to
+    model them.
+
+    seed: [int] Seed for the latency and errors, to make runs repeatable.
+    """
+    FakeMapsHandler.counts = {}
+    FakeMapsHandler.latency = latency
+    FakeMapsHandler.jitter = jitter
+    FakeMapsHandler.error_rate = error_rate
+    FakeMapsHandler.qps = qps
+    FakeMapsHandler.recording = recording
+    FakeMapsHandler.rng = random.Random(seed)
+    FakeMapsHandler.tokens = qps or 0
+    FakeMapsHandler.refilled_at = time.monotonic()
+    FakeMapsHandler.addresses = {}
+
+
+def start(port = 0, **settings):
+    """
+    Starts the fake server in a background thread, with any `settings` of
+    configure().
+
+    Returns
+    -------
+    Tuple of the server, which has shutdown(), and its base URL.
+    """
+    configure(**settings)
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeMapsHandler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def add_arguments(parser):
+    """
+    Adds the options of configure() to the argparse `parser`.
+    """
+    parser.add_argument('--recorded', metavar = 'PATH',
+                        help = 'replay the trips in this folder or zip of route subdirectories')
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = 'milliseconds each response is held back')
+    parser.add_argument('--jitter', type = float, default = 0,
+                        help = 'milliseconds the latency varies by, either way')
+    parser.add_argument('--error-rate', type = float, default = 0,
+                        help = 'fraction of requests answered with HTTP 503')
+    parser.add_argument('--qps', type = float,
+                        help = 'requests per second allowed before OVER_QUERY_LIMIT')
+    parser.add_argument('--seed', type = int)
+
+
+def settings(args):
+    """
+    Returns
+    -------
+    [dict] Keyword arguments of configure() from arguments parsed with
+    add_arguments().
+    """
+    return {
+        'latency': args.latency / 1000,
+        'jitter': args.jitter / 1000,
+        'error_rate': args.error_rate,
+        'qps': args.qps,
+        'recording': load_recording(args.recorded) if args.recorded else None,
+        'seed': args.seed,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Fake Google Maps APIs.')
+    parser.add_argument('--port', type = int, default = 8099)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    configure(**settings(args))
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), FakeMapsHandler)
+    print('Fake Google Maps APIs on http://127.0.0.1:{}'.format(args.port))
+    server.serve_forever()
@@ -0,0 +1,166 @@
+"""
+This module measures what building the time series and breakdown figures
+as plain dicts (app_helpers.time_series_figure() and stats_figure()) saves
+over building them as plotly graph objects, as plot_time_series() and
+plot_stats() do, for trips_time frames of 10k, 100k and 1M trips.
+
+Each figure is built both ways from the same synthetic frame and
+serialized with plotly's JSON encoder, as Dash does before sending it to
+the browser. Both must serialize to the same JSON, or this exits with
+status 1.
+
+Usage:
+    python src/bench/figure_check.py
+    python src/bench/figure_check.py --points 10000 100000 1000000 --routes 4 --repeat 3
+"""
+
+import argparse
+import json
+import sys
+import numpy as np
+import pandas as pd
+import plotly
+import benchmark
+
+
+# First departure of the synthetic trips, Monday April 13, 2020
+start_ts = 1586736000
+
+# Seconds between departures of a route
+interval = 120
+
+
+def synthetic_trips_time(points, routes, rng):
+    """
+    Returns
+    -------
+    [Pandas df] A trips_time frame of `points` trips split evenly over
+    `routes` routes, ordered by route and departure as the app holds it.
+    """
+    per_route = points // routes
+    departure_ts = np.tile(start_ts + np.arange(per_route) * interval, routes)
+    route_ids = np.repeat([chr(ord('A') + i) for i in range(routes)], per_route).astype(object)
+    departures = pd.to_datetime(departure_ts, unit = 's')
+    day = departures.dayofweek.values + 1
+
+    df = pd.DataFrame(0, index = np.arange(len(departure_ts)),
+                      columns = benchmark.trips_time_columns)
+    df['departure_ts'] = departure_ts
+    df['trip_id'] = np.arange(1, len(departure_ts) + 1)
+    df['route_id'] = route_ids
+    df['duration'] = rng.integers(25, 90, len(departure_ts))
+    df['minute'] = departures.minute.values
+    df['hour'] = departures.hour.values
+    df['day'] = day
+    df['week_of_year'] = departures.isocalendar().week.values.astype(int)
+    df['month'] = departures.month.values
+    df['year'] = departures.year.values
+    df['is_weekday'] = day <= 5
+    return df
+
+
+def plotly_time_series(app_helpers, df):
+    """
+    Returns
+    -------
+    The time series figure of `df` built with plotly graph objects.
+    """
+    return app_helpers.plot_time_series(app_helpers.split_df(app_helpers.process_df(df)))
+
+
+def plotly_stats(app_helpers, df, stats):
+    """
+    Returns
+    -------
+    [dict] The breakdown figures of `df` built with plotly graph objects.
+    """
+    pro_df = app_helpers.process_df(df)
+    return {
+        column: app_helpers.plot_stats(
+            app_helpers.split_df(app_helpers.agg_column(pro_df, column, stats)), column, stats
+        )
+        for column in ['hour', 'day', 'is_weekday']
+    }
+
+
+def to_json(fig):
+    """
+    Returns
+    -------
+    [str] `fig` serialized as Dash serializes callback outputs.
+    """
+    return json.dumps(fig, cls = plotly.utils.PlotlyJSONEncoder)
+
+
+def measure(build, args, repeat):
+    """
+    Returns
+    -------
+    Tuple of the best seconds to build a figure with build(*args), to
+    serialize it, and its JSON.
+    """
+    build_seconds, fig = benchmark.timed(build, *args, repeat=repeat)
+    json_seconds, fig_json = benchmark.timed(to_json, fig, repeat=repeat)
+    return build_seconds, json_seconds, fig_json
+
+
+def main():
+    """
+    Parses command line arguments, builds each figure both ways for each
+    number of points and prints how long each took.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Time building figures with plotly graph objects and as dicts.'
+    )
+    parser.add_argument('--points', type = int, nargs = '+',
+                        default = [10000, 100000, 1000000],
+                        help = 'trips in each synthetic frame')
+    parser.add_argument('--routes', type = int, default = 2)
+    parser.add_argument('--stats', default = 'median',
+                        help = 'statistic of the breakdown figures')
+    parser.add_argument('--repeat', type = int, default = 1,
+                        help = 'builds of each figure, keeping the fastest')
+    parser.add_argument('--seed', type = int, default = 0)
+    args = parser.parse_args()
+
+    app_helpers = benchmark.import_from(benchmark.app_dir, 'app_helpers')
+    rng = np.random.default_rng(args.seed)
+
+    # Validated layouts are cached once per process, so build them first
+    app_helpers.time_series_figure(synthetic_trips_time(args.routes, args.routes, rng))
+    app_helpers.stats_main(synthetic_trips_time(args.routes, args.routes, rng), args.stats)
+
+    print('{:>9}  {:<12}{:>14}{:>14}{:>14}{:>14}{:>10}'.format(
+        'points', 'figure', 'plotly build', 'dict build', 'plotly json', 'dict json', 'speedup'
+    ))
+    mismatches = []
+    for points in args.points:
+        df = synthetic_trips_time(points, args.routes, rng)
+        figures = [
+            ('time_series', plotly_time_series, app_helpers.time_series_figure, ()),
+            ('stats', plotly_stats, app_helpers.stats_main, (args.stats,)),
+        ]
+        for name, plotly_build, dict_build, extra in figures:
+            plotly_seconds, plotly_json_seconds, plotly_json = measure(
+                plotly_build, (app_helpers, df) + extra, args.repeat
+            )
+            dict_seconds, dict_json_seconds, dict_json = measure(
+                dict_build, (df,) + extra, args.repeat
+            )
+            if dict_json != plotly_json:
+                mismatches.append((points, name))
+            print('{:>9}  {:<12}{:>11.1f} ms{:>11.1f} ms{:>11.1f} ms{:>11.1f} ms{:>9.1f}x'.format(
+                points, name, plotly_seconds * 1e3, dict_seconds * 1e3,
+                plotly_json_seconds * 1e3, dict_json_seconds * 1e3,
+                (plotly_seconds + plotly_json_seconds) / (dict_seconds + dict_json_seconds)
+            ))
+
+    if mismatches:
+        for points, name in mismatches:
+            print('{} of {} points serializes differently as a dict'.format(name, points))
+        sys.exit(1)
+    print('Every figure serializes to the same JSON both ways')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""
+This module generates a synthetic corpus of trip JSON files in the same schema
+produced by data_collection.parse_directions(). It is used to benchmark the
+ETL pipeline and the app at many times the size of data.zip.
+
+Files are written to '{folder}/{start_location_id}/{%Y-%m-%d_%H-%M-%S}.json',
+exactly like data_collection.to_json(), so etl.process_data() can read them
+without modification.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import math
+import os
+import random
+
+
+### ROUTE PROFILES ###
+
+# Line sequences observed in data.zip, most common first. Each generated
+# route draws its itineraries from one of these pools.
+itinerary_pools = [
+    [('L', 'G', 'E'), ('L', 'E'), ('L', 'F'), ('L', 'G', 'F')],
+    [('E', 'G', 'L'), ('F', 'L'), ('E', 'L'), ('F', 'G', 'L')],
+    [('E', 'Q59'), ('R', 'Q59'), ('Q23', 'Q54'), ('E', 'Q54')],
+    [('Q59', 'E'), ('Q59', 'F'), ('Q59', 'R'), ('Q54', 'Q23')],
+]
+
+headsigns = {
+    'E': 'Jamaica Center - Parsons/Archer',
+    'F': 'Jamaica - 179 St',
+    'G': 'Court Sq - 23 St',
+    'L': '8 Av',
+    'R': 'Forest Hills - 71 Av',
+    'Q23': 'Forest Hills',
+    'Q54': 'Jamaica',
+    'Q59': 'Williamsburg',
+}
+
+# Base coordinates for route origins (lower Manhattan / north Brooklyn)
+base_lat = 40.7087015
+base_lng = -73.9416712
+
+location_ids = [chr(i) for i in range(ord('A'), ord('Z') + 1)] + \
+               [chr(i) for i in range(ord('a'), ord('z') + 1)]
+
+
+def route_profile(route_num, rng):
+    """
+    Returns
+    -------
+    A dict describing one synthetic route: its start location, typical
+    duration and itineraries.
+
+    Parameters
+    ----------
+    route_num: [int] Index of the route, 0-based.
+
+    rng: [random.Random] Seeded random number generator.
+    """
+    return {
+        'start_location_id': location_ids[route_num],
+        'start_location': {
+            'lat': round(base_lat + rng.uniform(-0.05, 0.05), 7),
+            'lng': round(base_lng + rng.uniform(-0.05, 0.05), 7),
+        },
+        'base_duration': rng.uniform(35, 60),
+        'itineraries': itinerary_pools[route_num % len(itinerary_pools)],
+    }
+
+
+def rush_hour_factor(date):
+    """
+    Returns
+    -------
+    [float] Multiplier applied to a route's base duration at `date`. Weekday
+    rush hours are slower, late nights are slower because of lower frequency.
+    """
+    hour = date.hour + date.minute / 60
+    factor = 1.0
+    if date.isoweekday() < 6:
+        factor += 0.20 * math.exp(-((hour - 8.5) ** 2) / 2)
+        factor += 0.15 * math.exp(-((hour - 17.5) ** 2) / 2)
+    if hour < 5:
+        factor += 0.30
+    return factor
+
+
+def make_trip(profile, date, rng):
+    """
+    Returns
+    -------
+    A dict in the schema of data_collection.parse_directions() for one trip
+    on `profile` departing at `date`.
+    """
+    duration = int(
+        profile['base_duration'] * rush_hour_factor(date) + rng.gauss(0, 3)
+    )
+    duration = max(duration, 10)
+
+    # Most trips use the route's preferred itinerary
+    itineraries = profile['itineraries']
+    if rng.random() < 0.6:
+        lines = itineraries[0]
+    else:
+        lines = rng.choice(itineraries)
+
+    steps = [
+        {
+            'step': i,
+            'distance': rng.randint(800, 10000),
+            'html_instructions': '{} towards {}'.format(
+                'Bus' if line.startswith('Q') else 'Subway',
+                headsigns[line]
+            ),
+            'line_name': line
+        }
+        for i, line in enumerate(lines, 1)
+    ]
+
+    departure_time = int(date.timestamp())
+
+    return {
+        'start_location': profile['start_location'],
+        'start_location_id': profile['start_location_id'],
+        'departure_time': departure_time,
+        'arrival_time': departure_time + duration * 60,
+        'duration': duration,
+        'steps': steps
+    }
+
+
+def generate(folder, num_routes=2, num_months=1, interval=5,
+             start=datetime(2020, 4, 13), seed=0):
+    """
+    Writes a synthetic corpus to `folder`.
+
+    Returns
+    -------
+    [int] Number of files written.
+
+    Parameters
+    ----------
+    folder: [str] Directory to write into. Subdirectories are created per
+    start_location_id.
+
+    num_routes: [int] Number of routes (start locations) to generate.
+
+    num_months: [int] Number of 30-day months to cover.
+
+    interval: [int] Minutes between samples on each route.
+
+    start: [datetime] Departure time of the first sample.
+
+    seed: [int] Seed so runs are reproducible.
+    """
+    if num_routes > len(location_ids):
+        raise ValueError(
+            'At most {} routes are supported'.format(len(location_ids))
+        )
+
+    rng = random.Random(seed)
+    profiles = [route_profile(i, rng) for i in range(num_routes)]
+
+    for profile in profiles:
+        os.makedirs(
+            os.path.join(folder, profile['start_location_id']), exist_ok=True
+        )
+
+    end = start + timedelta(days=30 * num_months)
+    step = timedelta(minutes=interval)
+
+    num_files = 0
+    date = start
+    while date < end:
+        for profile in profiles:
+            trip = make_trip(profile, date, rng)
+            filename = os.path.join(
+                folder,
+                profile['start_location_id'],
+                date.strftime('%Y-%m-%d_%H-%M-%S') + '.json'
+            )
+            with open(filename, 'w') as f:
+                json.dump(trip, f)
+            num_files += 1
+        date += step
+
+    return num_files
+
+
+def main():
+    """
+    Parses command line arguments and generates the corpus.
+    """
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic corpus of trip JSON files.'
+    )
+    parser.add_argument('folder', help='output directory, e.g. bench_data')
+    parser.add_argument('--routes', type=int, default=2)
+    parser.add_argument('--months', type=int, default=1)
+    parser.add_argument('--interval', type=int, default=5,
+                        help='minutes between samples')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    num_files = generate(
+        args.folder, args.routes, args.months, args.interval, seed=args.seed
+    )
+    print('{} files written to {}'.format(num_files, args.folder))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+This module load tests a running Dash app by replaying the callback that
+sends the breakdown statistics when the route filter changes, from N
+concurrent clients, and reports callback latency percentiles. Switching the
+statistic itself runs in the browser and costs no request.
+
+Usage:
+    python src/bench/load_test.py --url http://127.0.0.1:8050 --clients 16 --requests 50 --routes A B
+"""
+
+import argparse
+import itertools
+import json
+import threading
+import time
+import urllib.request
+
+
+def route_selections(route_ids):
+    """
+    Returns
+    -------
+    [list] Route filter values to cycle through: each route on its own, then
+    all of them.
+    """
+    return [[route_id] for route_id in route_ids] + [list(route_ids)]
+
+
+def callback_payload(route_ids):
+    """
+    Returns
+    -------
+    [bytes] Body of the POST Dash sends to /_dash-update-component when the
+    route filter changes to `route_ids`.
+    """
+    return json.dumps({
+        'output': 'stats_store.data',
+        'outputs': {'id': 'stats_store', 'property': 'data'},
+        'inputs': [
+            {'id': 'date_range', 'property': 'start_date', 'value': None},
+            {'id': 'date_range', 'property': 'end_date', 'value': None},
+            {'id': 'route_filter', 'property': 'value', 'value': route_ids},
+        ],
+        'changedPropIds': ['route_filter.value'],
+    }).encode()
+
+
+def client(url, num_requests, latencies, errors, offset, selections):
+    """
+    Sends `num_requests` callback requests one after the other, appending
+    each latency in seconds to `latencies` and each failure to `errors`.
+    """
+    selections = itertools.islice(
+        itertools.cycle(selections), offset, offset + num_requests
+    )
+    for route_ids in selections:
+        request = urllib.request.Request(
+            url + '/_dash-update-component',
+            data = callback_payload(route_ids),
+            headers = {'Content-Type': 'application/json'}
+        )
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout = 60) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(repr(e))
+
+
+def percentile(values, q):
+    """
+    Returns
+    -------
+    [float] The `q`th percentile (0-100) of `values` by nearest rank.
+    """
+    values = sorted(values)
+    rank = max(int(round(q / 100 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def run(url, num_clients, num_requests, route_ids = ('A', 'B')):
+    """
+    Returns
+    -------
+    [dict] Latency percentiles in milliseconds, throughput and error count
+    for `num_clients` clients each sending `num_requests` requests.
+    """
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(
+            target = client,
+            args = (url, num_requests, latencies, errors, i, route_selections(route_ids))
+        )
+        for i in range(num_clients)
+    ]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    results = {
+        'clients': num_clients,
+        'requests': len(latencies) + len(errors),
+        'errors': len(errors),
+        'elapsed_seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0,
+    }
+    if latencies:
+        results['p50_ms'] = percentile(latencies, 50) * 1000
+        results['p99_ms'] = percentile(latencies, 99) * 1000
+        results['max_ms'] = max(latencies) * 1000
+    if errors:
+        results['first_error'] = errors[0]
+
+    return results
+
+
+def main():
+    """
+    Parses command line arguments, runs the load test and prints the results
+    as JSON.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Load test the Dash app stats callback.'
+    )
+    parser.add_argument('--url', default = 'http://127.0.0.1:8050')
+    parser.add_argument('--clients', type = int, default = 8)
+    parser.add_argument('--requests', type = int, default = 25,
+                        help = 'requests per client')
+    parser.add_argument('--routes', nargs = '*', default = ['A', 'B'],
+                        help = 'route_ids to filter on')
+    args = parser.parse_args()
+
+    results = run(args.url.rstrip('/'), args.clients, args.requests, args.routes)
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == '__main__':
+    main()
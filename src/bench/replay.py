@@ -0,0 +1,367 @@
+"""
+This module replays data collection against the fake Google Maps server in
+fake_maps.py faster than real time, to measure the whole pipeline on one
+machine: how many trips a second the collector sustains and, with --etl, how
+long a trip takes to reach the database and, with --app, the app.
+
+A virtual clock starts at --start and moves on --tick minutes per round, as
+cron would run data_collection.py, but --speed times faster: at the default
+100x, a 5 minute tick is 3 seconds. Each round runs data_collection.main()
+for the virtual time in a scratch folder, so the fake server answers for
+that time of day. Rounds that can't keep up start late; the report shows by
+how much.
+
+With --etl, create_tables.py and etl.py --blue-green reload the scratch
+folder's trips into google_maps over and over while the replay runs, and a
+trip counts as fresh once a reload that read it is swapped in. With --app,
+fresh means the app's /api/export serves it instead, which reads the live
+schema on every request (the dashboard's figures stay cached until the app
+restarts). Freshness lag is reported in real seconds and in virtual minutes.
+
+Usage:
+    python src/bench/replay.py --hours 6 --locations 3 --latency 150 --error-rate 0.02 --qps 20
+    python src/bench/replay.py --recorded data.zip --etl --app http://127.0.0.1:8050
+
+--etl replaces the data in the google_maps database on 127.0.0.1 with the
+replayed trips, so never point it at a database you care about.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import fake_maps
+from load_test import percentile
+
+
+src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+etl_dir = os.path.join(src_dir, 'etl')
+
+config_template = """
+api_key = 'AIzaFakeKeyForTheLocalFakeServer'
+base_url = '{}'
+locations = {!r}
+routes = {!r}
+"""
+
+
+def write_config(folder, base_url, num_locations):
+    """
+    Writes the config.py data_collection.py reads, with `num_locations`
+    locations A, B, ... and a transit route between every ordered pair,
+    named after its ends, e.g. AB.
+    """
+    location_ids = string.ascii_uppercase[:num_locations]
+    locations = {
+        location_id: 'Location {}'.format(location_id) for location_id in location_ids
+    }
+    routes = [
+        (origin + destination, origin, destination, 'transit')
+        for origin in location_ids for destination in location_ids
+        if origin != destination
+    ]
+    with open(os.path.join(folder, 'config.py'), 'w') as f:
+        f.write(config_template.format(base_url, locations, routes))
+
+
+def counter_total(registry, name):
+    """
+    Returns
+    -------
+    [float] Sum of the counter `name` in the metrics `registry` over all of
+    its labels.
+    """
+    with registry.lock:
+        return sum(
+            value for (key_name, _), value in registry.counters.items() if key_name == name
+        )
+
+
+class Freshness:
+    """
+    When each round's trips were written, and when they became visible
+    downstream. All times are time.monotonic().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (departure_ts, written_at) of each round not yet seen
+        self.pending = []
+        self.lags = []
+
+    def written(self, departure_ts, written_at):
+        with self.lock:
+            self.pending.append((departure_ts, written_at))
+
+    def newest_written(self):
+        """
+        Returns
+        -------
+        [int] Departure time of the last round written, or None.
+        """
+        with self.lock:
+            return self.pending[-1][0] if self.pending else None
+
+    def seen(self, newest_ts, seen_at):
+        """
+        Records that every round departing at or before `newest_ts` was
+        visible at `seen_at`.
+        """
+        with self.lock:
+            while self.pending and self.pending[0][0] <= newest_ts:
+                _, written_at = self.pending.pop(0)
+                self.lags.append(seen_at - written_at)
+
+
+def run_etl(folder, log):
+    """
+    Reloads the trips in `folder` into google_maps with a blue/green swap.
+
+    Returns
+    -------
+    [bool] Whether the new load was swapped in.
+    """
+    for command in [
+        ['create_tables.py', '--blue-green'],
+        ['etl.py', '--blue-green', '--min-ratio', '0', '--no-snapshot'],
+    ]:
+        result = subprocess.run(
+            [sys.executable, os.path.join(etl_dir, command[0])] + command[1:],
+            cwd = folder, stdout = log, stderr = subprocess.STDOUT
+        )
+        if result.returncode != 0:
+            return False
+    return True
+
+
+def etl_loop(folder, freshness, stop, etl_seconds, mark_seen):
+    """
+    Runs run_etl() back to back until `stop` is set, appending how long each
+    took to `etl_seconds`. With `mark_seen`, the rounds written before a
+    reload started are marked fresh when it finishes.
+    """
+    with open(os.path.join(folder, 'etl.log'), 'a') as log:
+        while not stop.is_set():
+            newest_ts = freshness.newest_written()
+            if newest_ts is None:
+                stop.wait(0.1)
+                continue
+            started = time.monotonic()
+            if run_etl(folder, log):
+                finished = time.monotonic()
+                etl_seconds.append(finished - started)
+                if mark_seen:
+                    freshness.seen(newest_ts, finished)
+            else:
+                print('etl.py failed; see {}'.format(os.path.join(folder, 'etl.log')))
+                stop.wait(1)
+
+
+def newest_served(app_url, start_date):
+    """
+    Returns
+    -------
+    [int] Latest departure_ts the app's export serves from `start_date` on,
+    or None if it serves none.
+    """
+    url = '{}/api/export?format=ndjson&start={}'.format(app_url, start_date)
+    newest = None
+    with urllib.request.urlopen(url, timeout = 30) as response:
+        for line in response:
+            departure_ts = json.loads(line)['departure_ts']
+            if newest is None or departure_ts > newest:
+                newest = departure_ts
+    return newest
+
+
+def app_loop(app_url, start_date, freshness, stop, interval):
+    """
+    Polls the app every `interval` seconds until `stop` is set and marks the
+    rounds it serves fresh.
+    """
+    while not stop.wait(interval):
+        try:
+            newest_ts = newest_served(app_url, start_date)
+        except Exception as e:
+            print('Could not poll the app: {!r}'.format(e))
+            continue
+        if newest_ts is not None:
+            freshness.seen(newest_ts, time.monotonic())
+
+
+def replay(data_collection, folder, start, num_ticks, tick, speed, batch, deduplicate,
+           freshness):
+    """
+    Runs `num_ticks` rounds of data_collection.main(), `tick` virtual
+    minutes apart, `speed` times faster than real time, in `folder`. Each
+    round is recorded in `freshness` once its trips are written.
+
+    Returns
+    -------
+    [dict] Lists of the real seconds each round took ('collect') and how
+    late it started ('late'), and the number of failed rounds ('failed').
+    """
+    interval = tick * 60 / speed
+    results = {'collect': [], 'late': [], 'failed': 0}
+
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        started = time.monotonic()
+        for i in range(num_ticks):
+            scheduled = started + i * interval
+            wait = scheduled - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            results['late'].append(max(-wait, 0))
+
+            virtual_now = start + timedelta(minutes = tick * i)
+            round_started = time.monotonic()
+            try:
+                data_collection.main(
+                    batch, deduplicate = deduplicate, start_time = virtual_now
+                )
+            except Exception as e:
+                results['failed'] += 1
+                print('{} round failed: {!r}'.format(virtual_now, e))
+                continue
+            written_at = time.monotonic()
+            results['collect'].append(written_at - round_started)
+            freshness.written(int(virtual_now.timestamp()), written_at)
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def print_seconds(name, values, scale = 1, unit = 's'):
+    """
+    Prints the median, 90th percentile and maximum of `values` times
+    `scale`.
+    """
+    if not values:
+        print('{:<24}{:>10}'.format(name, 'n/a'))
+        return
+    print('{:<24}{:>10.2f}{:>10.2f}{:>10.2f}  {}'.format(
+        name,
+        percentile(values, 50) * scale,
+        percentile(values, 90) * scale,
+        max(values) * scale,
+        unit
+    ))
+
+
+def main():
+    """
+    Parses command line arguments, starts the fake server, replays the
+    rounds and prints throughput and freshness.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Replay data collection faster than real time against a fake Google Maps.'
+    )
+    parser.add_argument('--start', default = '2020-04-13T06:00',
+                        help = 'virtual time of the first round, as YYYY-MM-DDTHH:MM')
+    parser.add_argument('--hours', type = float, default = 6,
+                        help = 'virtual hours to replay')
+    parser.add_argument('--tick', type = int, default = 5,
+                        help = 'virtual minutes between rounds')
+    parser.add_argument('--speed', type = float, default = 100,
+                        help = 'how many times faster than real time to run')
+    parser.add_argument('--locations', type = int, default = 2,
+                        help = 'locations to collect every route between (at most 26)')
+    parser.add_argument('--batch', action = 'store_true',
+                        help = 'collect with batched Distance Matrix calls')
+    parser.add_argument('--dedup', action = 'store_true',
+                        help = 'record repeated trips as runs')
+    parser.add_argument('--etl', action = 'store_true',
+                        help = 'reload google_maps with the replayed trips as they come (REPLACES its data)')
+    parser.add_argument('--app', metavar = 'URL',
+                        help = 'measure freshness by polling this running app, e.g. http://127.0.0.1:8050')
+    parser.add_argument('--poll', type = float, default = 0.5,
+                        help = 'seconds between polls of --app')
+    fake_maps.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not 2 <= args.locations <= 26:
+        parser.error('--locations must be between 2 and 26')
+
+    start = datetime.strptime(args.start, '%Y-%m-%dT%H:%M')
+    num_ticks = int(args.hours * 60 / args.tick)
+    server, base_url = fake_maps.start(**fake_maps.settings(args))
+
+    with tempfile.TemporaryDirectory() as folder:
+        write_config(folder, base_url, args.locations)
+        sys.path.insert(0, folder)
+        sys.path.insert(0, etl_dir)
+        import data_collection
+
+        freshness = Freshness()
+        stop = threading.Event()
+        etl_seconds = []
+        threads = []
+        if args.etl:
+            threads.append(threading.Thread(
+                target = etl_loop,
+                args = (folder, freshness, stop, etl_seconds, args.app is None)
+            ))
+        if args.app:
+            threads.append(threading.Thread(
+                target = app_loop,
+                args = (args.app, start.date().isoformat(), freshness, stop, args.poll)
+            ))
+
+        for thread in threads:
+            thread.start()
+
+        started = time.monotonic()
+        results = replay(
+            data_collection, folder, start, num_ticks, args.tick, args.speed,
+            args.batch, args.dedup, freshness
+        )
+        elapsed = time.monotonic() - started
+
+        # Give the last rounds one reload or poll to show up
+        if threads:
+            deadline = time.monotonic() + max(etl_seconds + [0]) * 2 + 10
+            while freshness.pending and time.monotonic() < deadline:
+                time.sleep(0.1)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        num_trips = counter_total(data_collection.metrics.registry, 'collector_trips_total')
+
+    counts = fake_maps.FakeMapsHandler.counts
+    server.shutdown()
+
+    print('{} rounds of {} routes, {} virtual minutes apart, at {:g}x: {:.1f} s'.format(
+        num_ticks, args.locations * (args.locations - 1), args.tick, args.speed, elapsed
+    ))
+    # What the collector could sustain if rounds ran back to back
+    busy = sum(results['collect'])
+    print('Trips collected: {:.0f} ({:.1f}/s, {:.1f}/s while collecting); failed rounds: {}'.format(
+        num_trips, num_trips / elapsed, num_trips / busy if busy else 0, results['failed']
+    ))
+    print('API requests: {}'.format(json.dumps(counts, sort_keys = True)))
+    print()
+    print('{:<24}{:>10}{:>10}{:>10}'.format('', 'p50', 'p90', 'max'))
+    print_seconds('collector round', results['collect'])
+    print_seconds('round started late', results['late'])
+    if args.etl:
+        print_seconds('etl reload', etl_seconds)
+    if threads:
+        print_seconds('freshness lag', freshness.lags)
+        print_seconds('freshness lag', freshness.lags, args.speed / 60, 'virtual min')
+        if freshness.pending:
+            print('{} rounds never showed up'.format(len(freshness.pending)))
+
+
+if __name__ == '__main__':
+    main()
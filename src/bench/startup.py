@@ -0,0 +1,88 @@
+"""
+This module measures how long the Dash app takes to become ready to serve,
+i.e. to import app.py, with and without a fresh snapshot. Each run happens in
+a new interpreter so nothing is cached between runs.
+
+Usage:
+    python src/bench/startup.py --runs 5
+
+The snapshot case uses the snapshot in $SNAPSHOT_DIR (default ./snapshot),
+so run etl.py or src/app/build_snapshot.py first. The database case points
+SNAPSHOT_DIR at an empty directory, which forces the app to query postgres.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+
+app_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'
+)
+
+# Run in the child: time importing app.py, then report it with the app's own
+# per-stage timings on the last line of stdout
+probe = """
+import json
+import time
+start = time.perf_counter()
+import app
+ready = time.perf_counter() - start
+import metrics
+print(json.dumps({'ready': ready, 'stages': metrics.summary()['histograms']}))
+"""
+
+
+def measure(env, runs):
+    """
+    Returns
+    -------
+    [dict] Best and mean seconds to import app.py over `runs` fresh
+    interpreters, plus the app's own per-stage timings from the last run.
+    """
+    times = []
+    stages = None
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-c', probe],
+            cwd = app_dir, env = env,
+            stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+            universal_newlines = True
+        )
+        if result.returncode != 0:
+            return {'error': result.stderr.strip().splitlines()[-1]}
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(report['ready'])
+        stages = report['stages']
+
+    return {
+        'best_seconds': min(times),
+        'mean_seconds': sum(times) / len(times),
+        'stages': stages,
+    }
+
+
+def main():
+    """
+    Parses command line arguments and prints startup timings as JSON.
+    """
+    parser = argparse.ArgumentParser(description = 'Measure Dash app startup time.')
+    parser.add_argument('--runs', type = int, default = 5)
+    args = parser.parse_args()
+
+    results = {}
+
+    results['snapshot'] = measure(dict(os.environ), args.runs)
+
+    with tempfile.TemporaryDirectory() as empty:
+        env = dict(os.environ, SNAPSHOT_DIR = empty)
+        results['database'] = measure(env, args.runs)
+
+    print(json.dumps(results, indent = 2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Checks that the Distance Matrix requests of src/etl/data_collection.py
+stay within the API limits and are billed only for the trips collected.
+
+data_collection.py reads its settings from config.py, so one is written
+for it as collection_check.py does.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import random
+import pytest
+import benchmark
+from collection_check import config_template
+
+
+@pytest.fixture
+def data_collection(tmp_path, monkeypatch):
+    (tmp_path / 'config.py').write_text(config_template.format('http://127.0.0.1:1'))
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return benchmark.import_from(benchmark.etl_dir, 'data_collection')
+
+
+def requested(data_collection, pairs):
+    """
+    Returns
+    -------
+    [list] Every (origin, destination) element the batches of `pairs`
+    request, checking each batch is within the API limits.
+    """
+    elements = []
+    for origins, destinations in data_collection.matrix_batches(pairs):
+        assert len(origins) <= data_collection.max_matrix_side
+        assert len(destinations) <= data_collection.max_matrix_side
+        assert len(origins) * len(destinations) <= data_collection.max_matrix_elements
+        elements += [(origin, destination) for origin in origins for destination in destinations]
+    return elements
+
+
+def test_only_pairs_requested(data_collection):
+    # A to B and back: two elements, not the 2 x 2 grid
+    assert sorted(requested(data_collection, [(0, 1), (1, 0)])) == [(0, 1), (1, 0)]
+
+    rng = random.Random(0)
+    pairs = [(rng.randrange(40), rng.randrange(40)) for _ in range(500)]
+    elements = requested(data_collection, pairs)
+    assert sorted(elements) == sorted(set(pairs))
+
+
+def test_shared_destinations_batched(data_collection):
+    # 30 origins to the same 3 destinations fit in two requests
+    pairs = [(origin, destination) for origin in range(30) for destination in range(3)]
+    assert len(list(data_collection.matrix_batches(pairs))) == 2
+    assert sorted(requested(data_collection, pairs)) == pairs
+
+    # One origin to 60 destinations takes three
+    pairs = [(0, destination) for destination in range(60)]
+    assert len(list(data_collection.matrix_batches(pairs))) == 3
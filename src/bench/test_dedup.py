@@ -0,0 +1,141 @@
+"""
+Checks that run-length encoding trips (src/etl/dedup.py) loses none of them,
+and that etl.load_data() loads every trip of a run with its steps.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import json
+import os
+import random
+from datetime import datetime, timedelta
+import benchmark
+import generate_data
+
+
+dedup = benchmark.import_from(benchmark.etl_dir, 'dedup')
+etl = benchmark.import_from(benchmark.etl_dir, 'etl')
+
+
+def route_trips(route_num, num_trips, rng):
+    """
+    Returns
+    -------
+    [list] `num_trips` trips of a synthetic route, 5 minutes apart, in runs
+    of up to four that differ only in their times.
+    """
+    profile = generate_data.route_profile(route_num, rng)
+    start = datetime(2020, 4, 13)
+    trips = []
+    for i in range(num_trips):
+        date = start + timedelta(minutes = 5 * i)
+        if trips and rng.random() < 0.75:
+            trip = dict(trips[-1])
+            trip['departure_time'] = int(date.timestamp())
+            trip['arrival_time'] = trip['departure_time'] + trip['duration'] * 60 + rng.randint(0, 59)
+        else:
+            trip = generate_data.make_trip(profile, date, rng)
+        trips.append(trip)
+    return trips
+
+
+def write_folder(folder, trips_by_route):
+    """
+    Writes each trip to a file of its own in its route's subdirectory of
+    `folder`, as the collector does without deduplication.
+    """
+    for route, trips in trips_by_route.items():
+        os.makedirs(os.path.join(folder, route))
+        for trip in trips:
+            with open(os.path.join(folder, route, '{}.json'.format(trip['departure_time'])), 'w') as f:
+                json.dump(trip, f)
+
+
+def read_folder(folder):
+    """
+    Returns
+    -------
+    [dict] The trips of each route subdirectory of `folder`, expanded and
+    in order of departure.
+    """
+    trips_by_route = {}
+    for route in sorted(os.listdir(folder)):
+        trips = []
+        for path in benchmark.find_files(os.path.join(folder, route)):
+            with open(path, 'r') as f:
+                trips.extend(dedup.expand(json.load(f)))
+        trips_by_route[route] = sorted(trips, key = lambda trip: trip['departure_time'])
+    return trips_by_route
+
+
+def test_encode_folder_round_trip(tmp_path):
+    rng = random.Random(0)
+    trips_by_route = {'A': route_trips(0, 200, rng), 'B': route_trips(1, 150, rng)}
+    write_folder(str(tmp_path / 'trips'), trips_by_route)
+
+    num_trips, num_files = dedup.encode_folder(str(tmp_path / 'trips'), str(tmp_path / 'runs'))
+
+    assert num_trips == 350
+    assert num_files < num_trips
+    assert len(benchmark.find_files(str(tmp_path / 'runs'))) == num_files
+    assert read_folder(str(tmp_path / 'runs')) == trips_by_route
+
+
+def test_encode_folder_caps_runs(tmp_path):
+    trip = route_trips(0, 1, random.Random(0))[0]
+    trips = []
+    for i in range(dedup.max_repeats + 5):
+        trips.append(dict(
+            trip,
+            departure_time = trip['departure_time'] + 300 * i,
+            arrival_time = trip['arrival_time'] + 300 * i
+        ))
+    write_folder(str(tmp_path / 'trips'), {'A': trips})
+
+    num_trips, num_files = dedup.encode_folder(str(tmp_path / 'trips'), str(tmp_path / 'runs'))
+
+    assert (num_trips, num_files) == (len(trips), 2)
+    assert read_folder(str(tmp_path / 'runs')) == {'A': trips}
+
+
+def test_expand_without_repeats():
+    trip = route_trips(0, 1, random.Random(0))[0]
+    assert dedup.expand(trip) == [trip]
+    assert dedup.expand(dict(trip, repeats = [])) == [trip]
+
+
+class RecordingCursor:
+    """
+    Cursor that records the statements it is given instead of running them,
+    and hands out a new id for each row inserted with RETURNING.
+    """
+
+    def __init__(self):
+        self.executed = []
+        self.row = None
+
+    def execute(self, query, params = None):
+        self.executed.append((query, params))
+        self.row = (len(self.executed),) if 'RETURNING' in query else None
+
+    def fetchone(self):
+        return self.row
+
+
+def test_load_data_steps_every_trip(tmp_path):
+    trip = route_trips(0, 1, random.Random(0))[0]
+    run = dict(trip, repeats = [[300, 290], [600, 610]])
+    path = str(tmp_path / 'run.json')
+    with open(path, 'w') as f:
+        json.dump(run, f)
+
+    cur = RecordingCursor()
+    staged = etl.load_data(path, cur)
+
+    departures = [t['departure_time'] for t in dedup.expand(run)]
+    steps = [params for query, params in cur.executed if query == etl.steps_table_insert]
+    assert len(staged['trips']) == 3
+    assert sorted((step[0], step[2]) for step in steps) == [
+        (departure, step['step']) for departure in departures for step in trip['steps']
+    ]
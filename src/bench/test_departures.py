@@ -0,0 +1,147 @@
+"""
+Checks the departure lookups of src/app/departures.py against a brute-force
+search over the same slots, and the revalidation of the endpoint serving
+them.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import flask
+import numpy as np
+import pandas as pd
+import pytest
+import benchmark
+
+
+app_helpers = benchmark.import_from(benchmark.app_dir, 'app_helpers')
+departures = benchmark.import_from(benchmark.app_dir, 'departures')
+
+
+def slots_frame(rng, routes = ('A', 'B'), fill = 0.7):
+    """
+    Returns
+    -------
+    [Pandas df] departure_slots rows with random percentiles for about
+    `fill` of the slots of every route and weekday.
+    """
+    rows = []
+    for route_id in routes:
+        for day in range(1, 8):
+            for slot in np.flatnonzero(rng.random(departures.slots_per_day) < fill):
+                p50 = float(rng.integers(20, 90))
+                rows.append((route_id, day, int(slot), int(rng.integers(1, 30)),
+                             p50, p50 + float(rng.integers(0, 20))))
+    return pd.DataFrame(rows, columns = ['route_id', 'day', 'slot', 'num_trips', 'p50', 'p90'])
+
+
+def brute_force(slots_df, route_id, day, start, end, stat):
+    """
+    Returns
+    -------
+    [float] Lowest `stat` of the route in the window, or None if the window
+    has no trips.
+    """
+    if start <= end:
+        windows = [(day, range(start, end + 1))]
+    else:
+        windows = [(day, range(start, departures.slots_per_day)), (day % 7 + 1, range(0, end + 1))]
+    values = pd.concat([
+        slots_df.loc[(slots_df['route_id'] == route_id) & (slots_df['day'] == window_day)
+                     & slots_df['slot'].isin(slots), stat]
+        for window_day, slots in windows
+    ])
+    return None if values.empty else values.min()
+
+
+def test_parse_time():
+    assert departures.parse_time('07:35') == 91
+    assert departures.parse_time('7:35') == 91
+    assert departures.parse_time('00:00') == 0
+    assert departures.parse_time('23:59') == departures.slots_per_day - 1
+
+
+@pytest.mark.parametrize('text', ['7', '07:35:00', 'ab:cd', '24:00', '07:60', '', ' 7:35', '07:5',
+                                  '07:35\n', '-1:30'])
+def test_parse_time_invalid(text):
+    with pytest.raises(ValueError, match = '^Invalid time '):
+        departures.parse_time(text)
+
+
+def test_format_slot():
+    assert departures.format_slot(91) == '07:35'
+    assert departures.format_slot(departures.parse_time('23:55')) == '23:55'
+
+
+def test_best_slot_matches_brute_force():
+    rng = np.random.default_rng(0)
+    slots_df = slots_frame(rng)
+    table = departures.build_table(slots_df)
+
+    for _ in range(300):
+        route_id = 'AB'[rng.integers(2)]
+        day = int(rng.integers(1, 8))
+        start, end = (int(slot) for slot in rng.integers(0, departures.slots_per_day, 2))
+        stat = departures.stats[rng.integers(2)]
+        best = departures.best_slot(table, route_id, day, start, end, stat)
+        expected = brute_force(slots_df, route_id, day, start, end, stat)
+        assert (None if best is None else best[stat]) == expected
+
+
+def test_window_wraps_past_midnight():
+    slots_df = pd.DataFrame([
+        ('A', 7, 286, 5, 40.0, 50.0),
+        ('A', 1, 2, 5, 30.0, 60.0),
+        ('A', 1, 200, 5, 10.0, 20.0),
+    ], columns = ['route_id', 'day', 'slot', 'num_trips', 'p50', 'p90'])
+    table = departures.build_table(slots_df)
+
+    # Sunday 23:00 to Monday 00:30 reaches Monday's 00:10 slot
+    best = departures.best_slot(table, 'A', 7, departures.parse_time('23:00'),
+                                departures.parse_time('00:30'))
+    assert (best['day'], best['departure'], best['p50']) == (1, '00:10', 30.0)
+
+    best = departures.best_slot(table, 'A', 7, departures.parse_time('23:00'),
+                                departures.parse_time('00:30'), 'p90')
+    assert (best['day'], best['departure']) == (7, '23:50')
+
+    assert departures.best_slot(table, 'A', 2, 0, 100) is None
+
+
+def test_best_slot_rejects_bad_arguments():
+    table = departures.build_table(slots_frame(np.random.default_rng(1), routes = ('A',)))
+    with pytest.raises(KeyError):
+        departures.best_slot(table, 'Z', 1, 0, 10)
+    with pytest.raises(ValueError):
+        departures.best_slot(table, 'A', 8, 0, 10)
+    with pytest.raises(ValueError):
+        departures.best_slot(table, 'A', 1, 0, 10, 'p99')
+
+
+def test_revalidate():
+    server = flask.Flask(__name__)
+    served = {'version': 'load-1'}
+
+    @server.route('/api/departures')
+    def advice():
+        return app_helpers.revalidate(flask.jsonify(departure = '07:35'), served['version'],
+                                      flask.request)
+
+    client = server.test_client()
+    first = client.get('/api/departures?route=A&day=1')
+    etag = first.headers['ETag']
+    assert first.status_code == 200
+    assert first.headers['Cache-Control'] in ('public, max-age=300', 'max-age=300, public')
+
+    again = client.get('/api/departures?route=A&day=1', headers = {'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+
+    other = client.get('/api/departures?route=B&day=1', headers = {'If-None-Match': etag})
+    assert other.status_code == 200
+    assert other.headers['ETag'] != etag
+
+    served['version'] = 'load-2'
+    reloaded = client.get('/api/departures?route=A&day=1', headers = {'If-None-Match': etag})
+    assert reloaded.status_code == 200
+    assert reloaded.headers['ETag'] != etag
@@ -0,0 +1,160 @@
+"""
+Checks that the disruption detector (src/etl/disruptions.py) stays quiet on
+a steady route and flags, then closes, a slowdown and a detour on it.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import random
+import benchmark
+
+
+disruptions = benchmark.import_from(benchmark.etl_dir, 'disruptions')
+
+week_seconds = 7 * 24 * 3600
+
+# Monday 2020-04-13 08:00 UTC
+monday = 1586764800
+
+
+def steady_trips(weeks, rng, signature = 'L>G'):
+    """
+    Returns
+    -------
+    [list] (departure_ts, week_hour, duration, signature) of a route with a
+    trip every 10 minutes of Monday 08:00-08:59 for `weeks` weeks, taking
+    38 to 42 minutes.
+    """
+    return [
+        (monday + week * week_seconds + 600 * i, 8, rng.randint(38, 42), signature)
+        for week in range(weeks)
+        for i in range(6)
+    ]
+
+
+def replay(route, trips):
+    """
+    Returns
+    -------
+    [dict] Disruptions the `trips` opened, added to or closed, the latest
+    state of each, by (kind, started_ts).
+    """
+    flagged = {}
+    for departure_ts, week_hour, duration, signature in trips:
+        for disruption in disruptions.observe(route, week_hour, departure_ts, duration, signature):
+            flagged[(disruption['kind'], disruption['started_ts'])] = dict(disruption)
+    return flagged
+
+
+def test_steady_route_not_flagged():
+    route = disruptions.new_route()
+    assert replay(route, steady_trips(20, random.Random(0))) == {}
+
+    mean, deviation, n = route['baselines']['8']
+    assert 38 <= mean <= 42
+    assert deviation < 2
+    assert n == 120
+    assert route['open'] == {}
+
+
+def test_score_trip():
+    assert disruptions.score_trip([40.0, 2.0, disruptions.min_samples - 1], 60) is None
+    assert disruptions.score_trip([40.0, 2.0, disruptions.min_samples], 45) == 2.0
+    # A steady hour's spread is floored at min_deviation
+    assert disruptions.score_trip([40.0, 0.0, 50], 42) == 2.0
+
+
+def test_outlier_is_clipped():
+    baseline = [40.0, 2.0, 50]
+    clipped = disruptions.update_baseline(baseline, 400)
+    limit = disruptions.update_baseline(baseline, 40 + disruptions.clip * 2.0 * disruptions.mad_to_std)
+    assert clipped == limit
+    assert clipped[0] < 41
+
+    # The first trips of an hour are averaged evenly
+    baseline = None
+    for duration in [30, 40, 50]:
+        baseline = disruptions.update_baseline(baseline, duration)
+    assert baseline[0] == 40.0
+    assert baseline[2] == 3
+
+
+def test_slowdown_opens_and_closes():
+    rng = random.Random(1)
+    route = disruptions.new_route()
+    replay(route, steady_trips(10, rng))
+
+    start = monday + 10 * week_seconds
+    slow_trips = [(start + 600 * i, 8, 60, 'L>G') for i in range(4)]
+    # Normal again, a trip every 2 minutes for the rest of the hour
+    recovered = [(start + 2400 + 120 * i, 8, 40, 'L>G') for i in range(10)]
+    flagged = replay(route, slow_trips)
+
+    assert list(flagged) == [('slow', start)]
+    slow = flagged[('slow', start)]
+    assert slow['ended_ts'] is None
+    assert slow['num_trips'] == 4
+    assert 38 <= slow['expected'] <= 42
+    assert route['open']['slow'] is not None
+
+    # The score decays by 1 - score_alpha a trip until it is below exit_score
+    flagged = replay(route, recovered)
+    ended_ts = flagged[('slow', start)]['ended_ts']
+    assert ended_ts in [ts for ts, _, _, _ in recovered[1:]]
+    assert route['score'] < disruptions.exit_score
+    assert route['open'] == {}
+
+
+def test_gap_restarts_score():
+    route = disruptions.new_route()
+    replay(route, steady_trips(10, random.Random(2)))
+    disruptions.observe(route, 8, monday + 10 * week_seconds, 60, 'L>G')
+    assert route['score'] > 0
+
+    # The next trip is hours later, so the slow one before it no longer counts
+    z = disruptions.score_trip(route['baselines']['8'], 40)
+    disruptions.observe(route, 8, monday + 10 * week_seconds + disruptions.max_gap + 1, 40, 'L>G')
+    assert abs(route['score'] - disruptions.score_alpha * z) < 1e-9
+
+
+def test_detour_opens_after_run_and_closes():
+    route = disruptions.new_route()
+    replay(route, steady_trips(20, random.Random(3)))
+
+    start = monday + 20 * week_seconds
+    detour = [(start + 600 * i, 8, 45, 'L>SHUTTLE') for i in range(4)]
+
+    assert replay(route, detour[:disruptions.min_run - 1]) == {}
+    flagged = replay(route, detour[disruptions.min_run - 1:])
+    assert list(flagged) == [('detour', start)]
+    assert flagged[('detour', start)]['lines'] == ['SHUTTLE']
+    assert flagged[('detour', start)]['num_trips'] == 4
+
+    flagged = replay(route, [(start + 600 * 4, 8, 40, 'L>G')])
+    assert flagged[('detour', start)]['ended_ts'] == start + 600 * 4
+    assert 'detour' not in route['open']
+
+
+def test_unknown_lines_never_detour():
+    route = disruptions.new_route()
+    replay(route, steady_trips(20, random.Random(4)))
+    start = monday + 20 * week_seconds
+    assert replay(route, [(start + 600 * i, 8, 40, None) for i in range(5)]) == {}
+    assert route['rare_trips'] == 0
+
+
+def test_earlier_trips_ignored():
+    route = disruptions.new_route()
+    replay(route, steady_trips(2, random.Random(5)))
+    state = repr(route)
+    assert disruptions.observe(route, 8, monday, 90, 'X') == []
+    assert repr(route) == state
+
+
+def test_line_counts_bounded():
+    route = disruptions.new_route()
+    for i in range(200):
+        disruptions.count_lines(route, ['LINE{}'.format(i)])
+    assert len(route['lines']) == disruptions.max_lines
+    assert 'LINE199' in route['lines']
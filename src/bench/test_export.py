@@ -0,0 +1,95 @@
+"""
+Checks the queries src/app/export.py runs and the bytes it streams, against
+a connection that returns canned rows.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import csv
+import io
+import json
+import pytest
+import benchmark
+
+
+export = benchmark.import_from(benchmark.app_dir, 'export')
+
+rows = [
+    (1586736000, 1, 'A', 'A', 41, 3, 'L>G>E', 0, 0, 1, 16, 4, 2020, True),
+    (1586736300, 2, 'A', 'A', 44, 0, None, 5, 0, 1, 16, 4, 2020, True),
+]
+
+
+class CannedConnection:
+    """
+    Connection whose named cursor records the query it runs and returns
+    `rows` a batch at a time.
+    """
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.queries = []
+        self.closed = False
+
+    def cursor(self, name = None):
+        return self
+
+    def execute(self, query, params):
+        self.queries.append((query, params))
+
+    def fetchmany(self, size):
+        batch, self.rows = self.rows[:size], self.rows[size:]
+        return batch
+
+    def close(self):
+        self.closed = True
+
+
+def test_where_clause():
+    assert export.where_clause({}) == ''
+    assert export.where_clause({'end_ts': 5, 'route_ids': ['A']}) == (
+        'WHERE\n'
+        '      trips_time.route_id = ANY(%(route_ids)s)\n'
+        '      AND trips_time.departure_ts < %(end_ts)s'
+    )
+
+
+def test_only_given_filters_are_sent():
+    conn = CannedConnection([])
+    b''.join(export.stream(lambda: conn, 'csv', route_ids = ['A'], start_ts = 10))
+
+    query, params = conn.queries[0]
+    assert params == {'route_ids': ['A'], 'start_ts': 10}
+    assert 'IS NULL' not in query
+    assert 'trips_time.departure_ts >= %(start_ts)s' in query
+    assert 'end_ts' not in query
+    assert conn.closed
+
+
+def test_csv_and_ndjson(monkeypatch):
+    monkeypatch.setattr(export, 'batch_size', 1)
+    names = [name for name, _ in export.columns]
+
+    body = b''.join(export.stream(lambda: CannedConnection(rows), 'csv')).decode()
+    lines = list(csv.reader(io.StringIO(body)))
+    assert lines[0] == names
+    assert lines[1][:7] == ['1586736000', '1', 'A', 'A', '41', '3', 'L>G>E']
+    assert lines[2][6] == ''
+
+    body = b''.join(export.stream(lambda: CannedConnection(rows), 'ndjson')).decode()
+    records = [json.loads(line) for line in body.splitlines()]
+    assert records == [dict(zip(names, row)) for row in rows]
+
+
+def test_parquet():
+    pq = pytest.importorskip('pyarrow.parquet')
+    body = b''.join(export.stream(lambda: CannedConnection(rows), 'parquet'))
+    table = pq.read_table(io.BytesIO(body))
+    assert table.column('signature').to_pylist() == ['L>G>E', None]
+    assert table.num_rows == 2
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        export.stream(lambda: CannedConnection(rows), 'xlsx')
@@ -0,0 +1,129 @@
+"""
+Checks what src/etl/migrate.py reports and runs, without a database: the
+stages it picks for a database in each earlier schema, and the sizes it
+prints.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import benchmark
+
+
+migrate = benchmark.import_from(benchmark.etl_dir, 'migrate')
+
+
+class ScriptedConnection:
+    """
+    Connection whose cursor records the statements it is given, and
+    answers each query in `results` with its rows.
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.executed = []
+        self.rows = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params = None):
+        self.executed.append(query)
+        self.rows = self.results.get(query, [])
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def run_migrate(compact, has_routes, signature_nullable):
+    """
+    Returns
+    -------
+    Tuple of the stages migrate() ran on a database in the given schema,
+    with routes 1 and 2, and the statements it executed.
+    """
+    conn = ScriptedConnection({
+        migrate.migrated_check: [(1,)] if compact else [],
+        migrate.routes_check: [(1,)] if has_routes else [],
+        migrate.signature_nullable_check: [(1,)] if signature_nullable else [],
+        migrate.route_ids_select: [(1,), (2,)],
+    })
+    return migrate.migrate(conn), conn.executed
+
+
+def ran(queries, executed):
+    """
+    Returns
+    -------
+    [bool] Whether any of a stage's `queries` was executed, leaving out those
+    run by other stages too, e.g. DROP VIEW trips_time, or on every migration.
+    """
+    others = [migrate.routes_migration, migrate.compact_types_migration,
+              migrate.create_table_queries, [migrate.trips_time_create]]
+    shared = set(query for other in others if other is not queries for query in other)
+    return any(query in executed for query in queries if query not in shared)
+
+
+def test_format_bytes():
+    assert migrate.format_bytes(512) == '512.0 B'
+    assert migrate.format_bytes(1536) == '1.5 kB'
+    assert migrate.format_bytes(3 * 1024 ** 3) == '3.0 GB'
+
+
+def test_print_sizes(capsys):
+    before = {'trips': 4096 * 3, 'steps': 4096, 'time': 2048}
+    after = {'trips': 4096, 'steps': 2048, 'time': 1024, 'routes': 8192}
+
+    migrate.print_sizes(before, after)
+
+    lines = [line.split() for line in capsys.readouterr().out.splitlines()]
+    assert lines == [
+        ['table', 'before', 'after'],
+        ['steps', '4.0', 'kB', '2.0', 'kB'],
+        ['time', '2.0', 'kB', '1.0', 'kB'],
+        ['trips', '12.0', 'kB', '4.0', 'kB'],
+        ['routes', '-', '8.0', 'kB'],
+        ['trips', '+', 'steps', '16.0', 'kB', '6.0', 'kB'],
+        ['existing', 'tables', '18.0', 'kB', '7.0', 'kB'],
+    ]
+
+
+def test_current_schema_not_migrated():
+    stages, executed = run_migrate(True, True, True)
+    assert stages == []
+    assert executed == [migrate.migrated_check, migrate.routes_check,
+                        migrate.signature_nullable_check]
+
+
+def test_original_schema_runs_every_stage():
+    stages, executed = run_migrate(False, False, False)
+    assert stages == ['compact', 'routes', 'signatures']
+    assert executed[3:3 + len(migrate.compact_types_migration)] == migrate.compact_types_migration
+    assert migrate.trips_partition_create.format(2) in executed
+    assert migrate.steps_partition_create.format(2) in executed
+    assert executed.index(migrate.routes_backfill[0]) > executed.index(migrate.route_ids_select)
+    assert executed[-1] == migrate.trips_time_create
+
+
+def test_partitioned_schema_only_drops_not_null():
+    stages, executed = run_migrate(True, True, False)
+    assert stages == ['signatures']
+    assert migrate.signature_nullable_migration in executed
+    assert not ran(migrate.routes_migration, executed)
+    assert not ran(migrate.compact_types_migration, executed)
+
+
+def test_compact_schema_gets_routes():
+    stages, executed = run_migrate(True, False, False)
+    assert stages == ['routes', 'signatures']
+    assert not ran(migrate.compact_types_migration, executed)
+    assert ran(migrate.routes_migration, executed)
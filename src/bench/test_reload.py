@@ -0,0 +1,115 @@
+"""
+Checks the statements a blue/green reload (etl.swap_schema() and
+etl.validate_reload()) runs, against a connection that records them.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import benchmark
+
+
+etl = benchmark.import_from(benchmark.etl_dir, 'etl')
+
+
+class ScriptedCursor:
+    """
+    Cursor that records the statements it is given, and answers each query
+    in `results` with its rows.
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.executed = []
+        self.rows = []
+        self.description = None
+
+    def execute(self, query, params = None):
+        self.executed.append(query)
+        self.rows = self.results.get((query, params), self.results.get(query, []))
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self):
+        return self.rows
+
+
+class ScriptedConnection:
+    """
+    Connection with a single ScriptedCursor.
+    """
+
+    def __init__(self, results):
+        self.cur = ScriptedCursor(results)
+
+    def cursor(self):
+        return self.cur
+
+    def set_session(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_first_swap_retires_public():
+    conn = ScriptedConnection({
+        etl.public_relations_select: [('trips', 'TABLE'), ('trips_route_1', 'TABLE'),
+                                      ('trips_time', 'VIEW')],
+    })
+
+    etl.swap_schema(conn)
+
+    assert conn.cur.executed[1:] == [
+        'DROP SCHEMA IF EXISTS retired CASCADE',
+        'CREATE SCHEMA retired',
+        etl.public_relations_select,
+        'ALTER TABLE public.trips SET SCHEMA retired',
+        'ALTER TABLE public.trips_route_1 SET SCHEMA retired',
+        'ALTER VIEW public.trips_time SET SCHEMA retired',
+        'ALTER SCHEMA next RENAME TO live',
+        'ALTER DATABASE google_maps SET search_path = live',
+        'DROP SCHEMA IF EXISTS retired CASCADE',
+    ]
+
+
+def test_later_swap_renames_live():
+    conn = ScriptedConnection({(etl.schema_exists_select, ('live',)): [(1,)]})
+
+    etl.swap_schema(conn)
+
+    assert conn.cur.executed[1:] == [
+        'DROP SCHEMA IF EXISTS retired CASCADE',
+        'ALTER SCHEMA live RENAME TO retired',
+        'ALTER SCHEMA next RENAME TO live',
+        'ALTER DATABASE google_maps SET search_path = live',
+        'DROP SCHEMA IF EXISTS retired CASCADE',
+    ]
+
+
+def shadow_counts(**counts):
+    """
+    Returns
+    -------
+    ScriptedCursor answering row_counts_select with `counts`, every table
+    having 10 rows otherwise.
+    """
+    tables = ['trips', 'time', 'locations', 'routes', 'steps', 'route_signatures']
+    row = tuple(counts.get(table, 10) for table in tables)
+    cur = ScriptedCursor({etl.row_counts_select: [row]})
+    cur.description = [(table,) for table in tables]
+    return cur
+
+
+def test_validate_reload():
+    assert etl.validate_reload(shadow_counts(), 10, 10, 0.9) == []
+    assert etl.validate_reload(shadow_counts(), 10, None, 0.9) == []
+    assert etl.validate_reload(shadow_counts(trips = 8), 10, None, 0.9) == ['8 trips for 10 loaded']
+    assert etl.validate_reload(shadow_counts(routes = 0), 10, None, 0.9) == ['routes is empty']
+    assert etl.validate_reload(shadow_counts(), 10, 12, 0.9) == [
+        '10 trips is less than 90% of the 12 being served'
+    ]
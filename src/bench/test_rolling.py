@@ -0,0 +1,115 @@
+"""
+Checks the rolling statistics of src/app/rolling.py against pandas'
+time-based rolling windows over the same trips.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+import benchmark
+
+
+rolling = benchmark.import_from(benchmark.app_dir, 'rolling')
+
+
+def make_trips(num_trips, rng):
+    """
+    Returns
+    -------
+    Tuple of increasing departure times, 1 to 30 minutes apart, and whole
+    minute durations, a few of them past the MinuteCounts' initial size.
+    """
+    departure_ts = 1586736000 + np.cumsum(rng.integers(60, 1800, num_trips))
+    durations = rng.integers(20, 90, num_trips)
+    durations[rng.integers(0, num_trips, 5)] = 400
+    return departure_ts.astype(np.int64), durations.astype(np.int64)
+
+
+def pandas_stats(departure_ts, durations, window):
+    """
+    Returns
+    -------
+    [dict] Each statistic at every trip, as computed by pandas.
+    """
+    df = pd.DataFrame({
+        'departure_time': pd.to_datetime(departure_ts, unit = 's'),
+        'duration': durations.astype(float),
+    })
+    windowed = df.rolling('{}s'.format(window), on = 'departure_time')['duration']
+    return {
+        'mean': windowed.mean().values,
+        'median': windowed.median().values,
+        'p90': windowed.quantile(0.9).values,
+    }
+
+
+def test_minute_counts():
+    counts = rolling.MinuteCounts(size = 4)
+    for minute in [3, 1, 7, 3, 20]:
+        counts.add(minute)
+    counts.add(7, -1)
+
+    assert counts.size == 32
+    assert [counts.kth(k) for k in range(4)] == [1, 3, 3, 20]
+    assert counts.count_of(3) == 2
+    assert counts.prefix(4) == 3
+
+
+@pytest.mark.parametrize('window', [3600, 86400, 7 * 86400])
+def test_matches_pandas(window):
+    departure_ts, durations = make_trips(3000, np.random.default_rng(0))
+
+    series = rolling.RollingSeries(window, capacity = 16)
+    series.extend(departure_ts, durations)
+
+    expected = pandas_stats(departure_ts, durations, window)
+    for stat in rolling.stats:
+        np.testing.assert_allclose(series.values[stat], expected[stat])
+
+
+def test_fed_in_pieces():
+    departure_ts, durations = make_trips(1000, np.random.default_rng(1))
+    whole = rolling.RollingSeries(86400)
+    whole.extend(departure_ts, durations)
+
+    series = rolling.RollingSeries(86400, capacity = 4)
+    for start in range(0, 1000, 37):
+        before = series.slice()
+        series = rolling.update(series, departure_ts[:start + 37], durations[:start + 37])
+        # Slices already handed out are left as they were
+        assert np.array_equal(before['departure_ts'], departure_ts[:len(before['departure_ts'])])
+
+    for stat in rolling.stats:
+        assert np.array_equal(series.values[stat], whole.values[stat])
+
+    with pytest.raises(ValueError):
+        series.extend(departure_ts[:1], durations[:1])
+
+
+def test_update_starts_over_after_reload():
+    departure_ts, durations = make_trips(200, np.random.default_rng(2))
+    series = rolling.RollingSeries(86400)
+    series.extend(departure_ts[:100], durations[:100])
+
+    # A reload that dropped the first trips no longer starts with the series
+    updated = rolling.update(series, departure_ts[10:], durations[10:])
+    assert updated is not series
+    assert np.array_equal(updated.departure_ts, departure_ts[10:])
+
+    same = rolling.update(series, departure_ts, durations)
+    assert same is series
+    assert len(same) == 200
+
+
+def test_slice():
+    departure_ts, durations = make_trips(100, np.random.default_rng(3))
+    series = rolling.RollingSeries(3600)
+    series.extend(departure_ts, durations)
+
+    sliced = series.slice(departure_ts[10], departure_ts[20])
+    assert np.array_equal(sliced['departure_ts'], departure_ts[10:20])
+    assert np.array_equal(sliced['p90'], series.values['p90'][10:20])
+    assert len(series.slice(end_ts = departure_ts[0])['mean']) == 0
@@ -0,0 +1,131 @@
+"""
+Checks the duration sketches (src/common/sketches.py): quantiles within the
+sketch's relative accuracy, and merges, as etl.save_sketches() does with
+the stored sketches, that equal one sketch of all the durations.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import json
+import math
+import os
+import numpy as np
+import pytest
+import benchmark
+
+
+sketches = benchmark.import_from(os.path.join(benchmark.src_dir, 'common'), 'sketches')
+etl = benchmark.import_from(benchmark.etl_dir, 'etl')
+
+
+def sketch_of(durations, alpha = 0.01):
+    """
+    Returns
+    -------
+    [DDSketch] Sketch of `durations`.
+    """
+    sketch = sketches.DDSketch(alpha)
+    for duration in durations:
+        sketch.add(int(duration))
+    return sketch
+
+
+def test_quantiles_within_alpha():
+    rng = np.random.default_rng(0)
+    durations = np.sort(np.concatenate([rng.integers(30, 60, 5000), rng.integers(60, 240, 200)]))
+    sketch = sketch_of(durations)
+
+    for q in [0.01, 0.1, 0.5, 0.9, 0.99]:
+        exact = durations[int(math.floor(q * (len(durations) - 1)))]
+        assert abs(sketch.quantile(q) - exact) <= sketch.alpha * exact
+    assert sketch.quantile(0) == durations[0]
+    assert sketch.quantile(1) == durations[-1]
+    assert sketches.DDSketch().quantile(0.5) is None
+
+
+def test_merge_equals_one_sketch():
+    rng = np.random.default_rng(1)
+    loads = [rng.integers(20, 120, size) for size in [300, 1, 2000]]
+
+    merged = sketches.DDSketch()
+    for durations in loads:
+        merged.merge(sketch_of(durations))
+    merged.merge(sketches.DDSketch())
+    whole = sketch_of(np.concatenate(loads))
+
+    assert merged.to_dict() == whole.to_dict()
+    for q in [0.1, 0.5, 0.9, 0.99]:
+        assert merged.quantile(q) == whole.quantile(q)
+
+
+def test_merge_needs_same_alpha():
+    with pytest.raises(ValueError):
+        sketch_of([40], 0.01).merge(sketch_of([40], 0.02))
+
+
+def test_round_trip_through_json():
+    sketch = sketch_of([0, 41, 43, 46, 52, 60])
+    copy = sketches.DDSketch.from_dict(json.loads(json.dumps(sketch.to_dict())))
+    assert copy.to_dict() == sketch.to_dict()
+    assert copy.quantile(0.5) == sketch.quantile(0.5)
+    assert copy.zero_count == 1
+
+
+def test_hour_of_week():
+    assert sketches.hour_of_week(1, 0) == 0
+    assert sketches.hour_of_week(1, 8) == 8
+    assert sketches.hour_of_week(7, 23) == 167
+
+
+class StoredSketches:
+    """
+    Connection whose cursor answers duration_sketch_select with the sketch
+    stored for that (route_id, week_hour), and records the upserts.
+    """
+
+    def __init__(self, stored):
+        self.stored = stored
+        self.row = None
+        self.upserts = {}
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params):
+        if query == etl.duration_sketch_select:
+            sketch = self.stored.get(params)
+            self.row = None if sketch is None else (sketch.to_dict(),)
+        elif query == etl.duration_sketches_table_upsert:
+            route_id, week_hour, count, data = params
+            self.upserts[(route_id, week_hour)] = (count, json.loads(data))
+
+    def fetchone(self):
+        return self.row
+
+    def set_session(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_save_sketches_merges_stored():
+    rng = np.random.default_rng(2)
+    earlier, later, new_hour = (rng.integers(20, 120, size) for size in [500, 300, 50])
+
+    etl.pending_sketches.clear()
+    etl.pending_sketches[(1, 8)] = sketch_of(later)
+    etl.pending_sketches[(1, 9)] = sketch_of(new_hour)
+    conn = StoredSketches({(1, 8): sketch_of(earlier)})
+
+    etl.save_sketches(conn)
+
+    count, data = conn.upserts[(1, 8)]
+    assert count == 800
+    assert data == sketch_of(np.concatenate([earlier, later])).to_dict()
+    assert conn.upserts[(1, 9)] == (50, sketch_of(new_hour).to_dict())
+    assert etl.pending_sketches == {}
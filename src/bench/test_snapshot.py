@@ -0,0 +1,55 @@
+"""
+Checks that the trips frame the app builds from a snapshot keeps sharing
+its columns with the snapshot's memory mapping, through everything the
+app does with it.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import numpy as np
+import benchmark
+import figure_check
+
+
+app_helpers = benchmark.import_from(benchmark.app_dir, 'app_helpers')
+cube = benchmark.import_from(benchmark.app_dir, 'cube')
+
+
+def load_snapshot(folder):
+    """
+    Returns
+    -------
+    Tuple of the frame app.py loads from a snapshot of synthetic trips
+    written to `folder`, and the snapshot's manifest.
+    """
+    df = figure_check.synthetic_trips_time(2000, 2, np.random.default_rng(0))
+    app_helpers.snapshot.write_snapshot(df, str(folder))
+    manifest = app_helpers.snapshot.read_manifest(str(folder))
+    return app_helpers.sort_df(app_helpers.load_df(manifest)), manifest
+
+
+def test_load_df_maps_columns(tmp_path):
+    df, manifest = load_snapshot(tmp_path)
+    assert app_helpers.unshared_columns(df, manifest) == []
+    assert df['route_id'].tolist()[:1] == ['A']
+
+
+def test_columns_stay_mapped(tmp_path):
+    df, manifest = load_snapshot(tmp_path)
+    start_ts = int(df['departure_ts'].iloc[100])
+
+    view = app_helpers.slice_df(df, start_ts, start_ts + 86400, ['A', 'B'])
+    assert len(view) > 0
+    app_helpers.time_series_figure(view)
+    app_helpers.stats_main(view, 'mean')
+    cube.build(df)
+    app_helpers.data_extent(df)
+
+    assert app_helpers.unshared_columns(df, manifest) == []
+
+
+def test_take_rows_matches_iloc(tmp_path):
+    df, _ = load_snapshot(tmp_path)
+    rows = np.array([5, 1, 1500, 7])
+    assert app_helpers.take_rows(df, rows).equals(df.iloc[rows])
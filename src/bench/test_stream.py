@@ -0,0 +1,150 @@
+"""
+Checks that src/etl/stream.py loads each spooled trip once and counts it
+once in the duration sketches, however flushes fail.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import json
+import random
+from datetime import datetime, timedelta
+import psycopg2
+import benchmark
+import generate_data
+
+
+stream = benchmark.import_from(benchmark.etl_dir, 'stream')
+etl = stream.etl
+
+
+class FakeCursor:
+    """
+    Cursor that records what it is given instead of running it. Rows
+    inserted with RETURNING get a new id, and a second steps row with the
+    same primary key raises IntegrityError, as postgres would.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def execute(self, query, params = None):
+        if query == self.conn.fail_on:
+            raise psycopg2.OperationalError('connection lost')
+        self.conn.executed.append((query, params))
+        self.row = (len(self.conn.executed),) if 'RETURNING' in str(query) else None
+
+    def mogrify(self, query, params):
+        if query == etl.steps_table_insert:
+            key = (params[0], params[1], params[2])
+            if key in self.conn.steps:
+                raise psycopg2.IntegrityError('duplicate key value violates "steps_pkey"')
+            self.conn.steps.add(key)
+        self.conn.executed.append((query, params))
+        return b''
+
+    def fetchone(self):
+        return self.row
+
+    def fetchall(self):
+        return []
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    """
+    Connection handing out FakeCursors, whose statements all end up in
+    `executed`. `fail_on` is a query that raises when executed.
+    """
+
+    def __init__(self, fail_on = None):
+        self.fail_on = fail_on
+        self.executed = []
+        self.steps = set()
+
+    def cursor(self, name = None):
+        return FakeCursor(self)
+
+    def set_session(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def make_trips(num_trips):
+    """
+    Returns
+    -------
+    [list] `num_trips` synthetic trips of route A, 5 minutes apart.
+    """
+    rng = random.Random(0)
+    profile = generate_data.route_profile(0, rng)
+    return [
+        dict(
+            generate_data.make_trip(profile, datetime(2020, 4, 13) + timedelta(minutes = 5 * i), rng),
+            route_id = 'A'
+        )
+        for i in range(num_trips)
+    ]
+
+
+def reset_etl():
+    for cache in [etl.location_ids, etl.route_ids, etl.signature_ids, etl.detectors,
+                  etl.pending_disruptions, etl.pending_sketches]:
+        cache.clear()
+
+
+def sketched_trips(conn):
+    """
+    Returns
+    -------
+    [int] Trips counted in the sketches `conn` saved.
+    """
+    return sum(
+        params[2] for query, params in conn.executed
+        if query == etl.duration_sketches_table_upsert
+    )
+
+
+def test_load_trips_skips_repeats_in_spool():
+    reset_etl()
+    trips = make_trips(3)
+    conn = FakeConnection()
+
+    loaded = stream.load_trips(conn.cursor(), trips + [dict(trips[1])])
+
+    assert [row[0] for row in loaded] == trips
+    assert etl.pending_sketches == {}
+
+
+def test_failed_flush_not_sketched(tmp_path, monkeypatch):
+    reset_etl()
+    path = str(tmp_path / 'spool.jsonl')
+    stream.spool(make_trips(4), path)
+
+    failing = FakeConnection(fail_on = stream.trips_loaded_notify)
+    monkeypatch.setattr(stream.psycopg2, 'connect', lambda **kwargs: failing)
+    assert stream.flush(path) == 0
+    assert etl.pending_sketches == {}
+
+    conn = FakeConnection()
+    monkeypatch.setattr(stream.psycopg2, 'connect', lambda **kwargs: conn)
+    assert stream.flush(path) == 4
+    assert sketched_trips(conn) == 4
+    assert sketched_trips(failing) == 0
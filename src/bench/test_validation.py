@@ -0,0 +1,187 @@
+"""
+Checks that the compiled trip schema (src/etl/validation.py) accepts the
+trips the collector writes and names the first problem of those it
+doesn't, and that etl.process_data() quarantines the files it can't load
+and carries on with the rest.
+
+Usage:
+    python -m pytest src/bench
+"""
+
+import json
+import random
+from datetime import datetime
+import psycopg2
+import benchmark
+import generate_data
+
+
+etl = benchmark.import_from(benchmark.etl_dir, 'etl')
+validation = etl.validation
+
+
+def make_trip(**fields):
+    """
+    Returns
+    -------
+    [dict] A synthetic trip as the collector writes it, with `fields`
+    replaced.
+    """
+    rng = random.Random(0)
+    trip = generate_data.make_trip(generate_data.route_profile(0, rng), datetime(2020, 4, 13), rng)
+    trip.update(fields)
+    return trip
+
+
+def test_valid_trips():
+    assert validation.validate_trip(make_trip()) is None
+    assert validation.validate_trip(make_trip(repeats = [[300, 290]])) is None
+    assert validation.validate_trip(make_trip(
+        route_id = 'A', end_location_id = 'B', end_location = {'lat': 40.7, 'lng': -73.9},
+        mode = 'transit'
+    )) is None
+    assert validation.validate_trip(make_trip(steps = [], source = 'distance_matrix')) is None
+
+
+def test_missing_field():
+    trip = make_trip()
+    del trip['duration']
+    assert validation.validate_trip(trip) == 'duration: missing'
+
+
+def test_wrong_types():
+    assert validation.validate_trip([]) == 'record: expected object, got list'
+    assert validation.validate_trip(make_trip(duration = True)) == \
+        'duration: expected int, got bool'
+    assert validation.validate_trip(make_trip(departure_time = 1586736000.5)) == \
+        'departure_time: expected int, got float'
+    assert validation.validate_trip(make_trip(start_location = {'lat': '40.7', 'lng': -73.9})) == \
+        'start_location.lat: expected number, got str'
+
+
+def test_bounds():
+    assert validation.validate_trip(make_trip(duration = 40000)) == 'duration: more than 32767'
+    assert validation.validate_trip(make_trip(start_location = {'lat': 91, 'lng': 0})) == \
+        'start_location.lat: more than 90'
+    assert validation.validate_trip(make_trip(
+        steps = [{'step': 1, 'line_name': 'LONGLINE'}]
+    )) == 'steps[].line_name: longer than 5 characters'
+    assert validation.validate_trip(make_trip(repeats = [[300]])) == 'repeats[]: not 2 items'
+
+
+def test_end_location_needs_coordinates():
+    assert validation.validate_trip(make_trip(end_location_id = 'B')) == 'end_location: missing'
+
+
+def test_quarantine_and_summarize(tmp_path, capsys):
+    folder = str(tmp_path / 'dead_letter')
+    path = tmp_path / 'A' / '1586736000.json'
+    path.parent.mkdir()
+    path.write_text('{"duration": ')
+
+    rejects = [
+        validation.quarantine(str(path), 'json', 'Expecting value', folder),
+        validation.quarantine(str(path), 'schema', 'duration: missing', folder),
+        validation.quarantine(str(path), 'schema', 'duration: missing', folder),
+    ]
+
+    assert rejects[0]['copy'] == str(tmp_path / 'dead_letter' / 'A' / '1586736000.json')
+    assert (tmp_path / 'dead_letter' / 'A' / '1586736000.json').read_text() == '{"duration": '
+    with open(tmp_path / 'dead_letter' / 'rejects.jsonl') as f:
+        assert [json.loads(line)['stage'] for line in f] == ['json', 'schema', 'schema']
+
+    summary = validation.summarize(rejects, 10, folder)
+    assert summary['num_rejected'] == 3
+    assert summary['by_stage'] == {'json': 1, 'schema': 2}
+    assert summary['top_reasons'][0] == ('duration: missing', 2)
+    with open(tmp_path / 'dead_letter' / 'summary.json') as f:
+        assert json.load(f)['by_stage'] == summary['by_stage']
+    assert '3 of 10 files rejected' in capsys.readouterr().out
+
+    assert validation.summarize([], 10, str(tmp_path / 'empty'))['num_rejected'] == 0
+    assert not (tmp_path / 'empty').exists()
+
+
+class FailingCursor:
+    """
+    Cursor that records the statements it is given instead of running them,
+    hands out a new id for each row inserted with RETURNING, and raises
+    IntegrityError for a trips row departing at `fail_ts`.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.row = None
+
+    def execute(self, query, params = None):
+        if query == etl.trips_table_insert and params[0] == self.conn.fail_ts:
+            raise psycopg2.IntegrityError('duplicate key value violates "trips_pkey"')
+        self.conn.executed.append((query, params))
+        self.row = (len(self.conn.executed),) if 'RETURNING' in query else None
+
+    def fetchone(self):
+        return self.row
+
+
+class FailingConnection:
+    """
+    Connection handing out FailingCursors, counting its rollbacks.
+    """
+
+    def __init__(self, fail_ts):
+        self.fail_ts = fail_ts
+        self.executed = []
+        self.rollbacks = 0
+        self.closed = False
+
+    def cursor(self):
+        return FailingCursor(self)
+
+    def set_session(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def test_process_data_quarantines_and_carries_on(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for cache in [etl.location_ids, etl.route_ids, etl.signature_ids, etl.detectors,
+                  etl.pending_disruptions, etl.pending_sketches]:
+        cache.clear()
+
+    route_dir = tmp_path / 'data' / 'A'
+    route_dir.mkdir(parents = True)
+    trip = make_trip()
+    files = {
+        'good': dict(trip, departure_time = 1586736000),
+        'schema': dict(trip, departure_time = 1586736300, duration = 'slow'),
+        'database': dict(trip, departure_time = 1586736600),
+    }
+    for name, data in files.items():
+        (route_dir / '{}.json'.format(data['departure_time'])).write_text(json.dumps(data))
+    (route_dir / '1586736900.json').write_text('{"duration": ')
+
+    conn = FailingConnection(fail_ts = 1586736600)
+    num_loaded, num_trips = etl.process_data(conn.cursor(), conn, str(tmp_path / 'data'))
+
+    assert (num_loaded, num_trips) == (1, 1)
+    assert conn.rollbacks == 3
+    with open(next((tmp_path / 'dead_letter').iterdir()) / 'rejects.jsonl') as f:
+        rejects = [json.loads(line) for line in f]
+    assert [reject['stage'] for reject in rejects] == ['schema', 'database', 'json']
+    assert rejects[0]['reason'] == 'duration: expected int, got str'
+
+    # Only the committed trip reaches the sketches
+    sketched = [params for query, params in conn.executed
+                if query == etl.duration_sketches_table_upsert]
+    assert sum(params[2] for params in sketched) == 1
@@ -0,0 +1,224 @@
+"""
+This module measures what a running Dash app sends over the wire: the bytes
+of every response, uncompressed and as actually transferred, and the time
+each server round trip takes, for these interactions:
+
+    page load       index page, scripts, layout and callback graph
+    first render    every server callback the page fires on load
+    stats dropdown  switching the statistic through every other option
+    route filter    narrowing the route filter to a single route
+
+Callbacks that run in the browser (clientside callbacks) cost no requests,
+so an interaction handled entirely client side shows 0 requests.
+
+Usage:
+    python src/bench/wire_check.py --url http://127.0.0.1:8050
+"""
+
+import argparse
+import gzip
+import json
+import re
+import time
+import urllib.request
+
+
+def fetch(url, body = None, encoding = 'identity'):
+    """
+    Returns
+    -------
+    Tuple of the response body, decompressed, the number of bytes
+    transferred and the seconds the request took.
+
+    Parameters
+    ----------
+    url: [str] URL to GET, or to POST `body` to as JSON.
+
+    body: [dict] JSON body of a POST. None sends a GET.
+
+    encoding: [str] Accept-Encoding header to send.
+    """
+    headers = {'Accept-Encoding': encoding}
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers['Content-Type'] = 'application/json'
+    request = urllib.request.Request(url, data = data, headers = headers)
+
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout = 60) as response:
+        raw = response.read()
+        content_encoding = response.headers.get('Content-Encoding', 'identity')
+    elapsed = time.perf_counter() - start
+
+    if content_encoding == 'gzip':
+        content = gzip.decompress(raw)
+    elif content_encoding == 'br':
+        import brotli
+        content = brotli.decompress(raw)
+    else:
+        content = raw
+    return content, len(raw), elapsed
+
+
+def component_values(layout, values = None):
+    """
+    Returns
+    -------
+    [dict] Properties of every component with an id in the Dash `layout`
+    tree, keyed by id.
+    """
+    if values is None:
+        values = {}
+    if isinstance(layout, list):
+        for child in layout:
+            component_values(child, values)
+    elif isinstance(layout, dict) and 'props' in layout:
+        props = layout['props']
+        if 'id' in props:
+            values[props['id']] = props
+        component_values(props.get('children'), values)
+    return values
+
+
+def callback_body(dependency, values, changed):
+    """
+    Returns
+    -------
+    [dict] Body of the POST Dash sends to /_dash-update-component to run the
+    callback in `dependency` with the component `values`.
+    """
+    def prop_value(item):
+        return {
+            'id': item['id'],
+            'property': item['property'],
+            'value': values.get(item['id'], {}).get(item['property']),
+        }
+
+    output = dependency['output']
+    if output.startswith('..'):
+        outputs = [
+            {'id': o.split('.')[0], 'property': o.split('.')[1]}
+            for o in output.strip('.').split('...')
+        ]
+    else:
+        outputs = {'id': output.split('.')[0], 'property': output.split('.')[1]}
+
+    return {
+        'output': output,
+        'outputs': outputs,
+        'inputs': [prop_value(item) for item in dependency['inputs']],
+        'state': [prop_value(item) for item in dependency.get('state', [])],
+        'changedPropIds': changed,
+    }
+
+
+def run_callbacks(url, dependencies, values, changed, encoding):
+    """
+    Returns
+    -------
+    [list] (bytes uncompressed, bytes transferred, seconds) of every server
+    callback that has one of the `changed` 'id.property' strings as input.
+    """
+    results = []
+    for dependency in dependencies:
+        if dependency.get('clientside_function'):
+            continue
+        inputs = ['{}.{}'.format(item['id'], item['property']) for item in dependency['inputs']]
+        if not set(inputs) & set(changed):
+            continue
+        body = callback_body(dependency, values, changed)
+        content, num_bytes, elapsed = fetch(url + '/_dash-update-component', body, encoding)
+        results.append((len(content), num_bytes, elapsed))
+    return results
+
+
+def page_load(url, encoding):
+    """
+    Returns
+    -------
+    [list] (bytes uncompressed, bytes transferred, seconds) of the index
+    page, every script and stylesheet it links to on the app's own server,
+    the layout and the callback graph.
+    """
+    results = []
+    content, num_bytes, elapsed = fetch(url + '/', encoding = encoding)
+    results.append((len(content), num_bytes, elapsed))
+
+    assets = re.findall(r'(?:src|href)="(/[^"]+)"', content.decode())
+    for path in assets + ['/_dash-layout', '/_dash-dependencies']:
+        content, num_bytes, elapsed = fetch(url + path, encoding = encoding)
+        results.append((len(content), num_bytes, elapsed))
+    return results
+
+
+def measure(url, encoding):
+    """
+    Returns
+    -------
+    [list] (interaction, results) for every interaction in the module
+    docstring, with results as returned by run_callbacks().
+    """
+    layout = json.loads(fetch(url + '/_dash-layout')[0])
+    dependencies = json.loads(fetch(url + '/_dash-dependencies')[0])
+    values = component_values(layout)
+
+    # Every input is "changed" on the first render
+    all_inputs = [
+        '{}.{}'.format(item['id'], item['property'])
+        for dependency in dependencies for item in dependency['inputs']
+    ]
+
+    interactions = [
+        ('page load', page_load(url, encoding)),
+        ('first render', run_callbacks(url, dependencies, values, all_inputs, encoding)),
+    ]
+
+    stats = []
+    dropdown = values['stats_dropdown']
+    for option in dropdown['options']:
+        if option['value'] == dropdown['value']:
+            continue
+        values['stats_dropdown'] = dict(dropdown, value = option['value'])
+        stats += run_callbacks(url, dependencies, values, ['stats_dropdown.value'], encoding)
+    values['stats_dropdown'] = dropdown
+    interactions.append(('stats dropdown', stats))
+
+    route_filter = values['route_filter']
+    values['route_filter'] = dict(route_filter, value = route_filter['value'][:1])
+    interactions.append(('route filter', run_callbacks(
+        url, dependencies, values, ['route_filter.value'], encoding
+    )))
+
+    return interactions
+
+
+def main():
+    """
+    Parses command line arguments and prints the bytes and latency of each
+    interaction.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Measure the bytes and round trips of Dash app interactions.'
+    )
+    parser.add_argument('--url', default = 'http://127.0.0.1:8050')
+    parser.add_argument('--encoding', default = 'gzip, deflate, br',
+                        help = 'Accept-Encoding to send, as a browser would')
+    args = parser.parse_args()
+    url = args.url.rstrip('/')
+
+    print('{:<16}{:>10}{:>14}{:>14}{:>12}'.format(
+        'interaction', 'requests', 'bytes', 'transferred', 'total ms'
+    ))
+    for name, results in measure(url, args.encoding):
+        print('{:<16}{:>10}{:>14}{:>14}{:>12.1f}'.format(
+            name,
+            len(results),
+            sum(result[0] for result in results),
+            sum(result[1] for result in results),
+            sum(result[2] for result in results) * 1000
+        ))
+
+
+if __name__ == '__main__':
+    main()
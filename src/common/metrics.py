@@ -0,0 +1,298 @@
+"""
+Lightweight counters, timers and histograms shared by the ETL, the data
+collector and the Dash app. Metrics are kept in memory for the life of the
+process and can be rendered in the Prometheus text format or as a JSON
+summary.
+
+Examples
+--------
+>>> import metrics
+>>> with metrics.stage('extract'):
+        data = extract_json(filepath)
+>>> metrics.inc('etl_files_total', status='loaded')
+>>> print(metrics.to_prometheus())
+
+Set the environment variable METRICS_TRACEMALLOC=1 (or call
+metrics.trace_memory()) to also record the peak Python memory allocated in
+each stage.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+# Upper bounds in seconds, the same as the Prometheus client defaults
+default_buckets = (
+    0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0,
+    7.5, 10.0
+)
+
+namespace = 'google_maps'
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values with fixed bucket bounds.
+    """
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+        }
+
+
+class Registry:
+    """
+    Holds every counter, gauge and histogram of one process. All methods are
+    thread safe so the registry can be shared by Dash callbacks.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.started_at = datetime.now()
+        self.memory = bool(os.environ.get('METRICS_TRACEMALLOC'))
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.started_at = datetime.now()
+
+    def to_prometheus(self):
+        """
+        Returns
+        -------
+        [str] Every metric in the Prometheus text exposition format.
+        """
+        lines = []
+        with self.lock:
+            for kind, series in [('counter', self.counters),
+                                 ('gauge', self.gauges)]:
+                for name in sorted({key[0] for key in series}):
+                    lines.append('# TYPE {}_{} {}'.format(namespace, name, kind))
+                    for (key_name, labels), value in sorted(series.items()):
+                        if key_name == name:
+                            lines.append('{}_{}{} {}'.format(
+                                namespace, name, format_labels(labels), value
+                            ))
+
+            for name in sorted({key[0] for key in self.histograms}):
+                lines.append('# TYPE {}_{} histogram'.format(namespace, name))
+                for (key_name, labels), hist in sorted(self.histograms.items()):
+                    if key_name != name:
+                        continue
+                    for bound, count in zip(hist.buckets, hist.bucket_counts):
+                        lines.append('{}_{}_bucket{} {}'.format(
+                            namespace, name,
+                            format_labels(labels + (('le', bound),)), count
+                        ))
+                    lines.append('{}_{}_bucket{} {}'.format(
+                        namespace, name,
+                        format_labels(labels + (('le', '+Inf'),)), hist.count
+                    ))
+                    lines.append('{}_{}_sum{} {}'.format(
+                        namespace, name, format_labels(labels), hist.sum
+                    ))
+                    lines.append('{}_{}_count{} {}'.format(
+                        namespace, name, format_labels(labels), hist.count
+                    ))
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """
+        Returns
+        -------
+        [dict] JSON-serializable summary of every metric.
+        """
+        def flatten(name, labels):
+            return name + format_labels(labels)
+
+        with self.lock:
+            return {
+                'started_at': self.started_at.isoformat(timespec='seconds'),
+                'elapsed_seconds': (datetime.now() - self.started_at).total_seconds(),
+                'counters': {
+                    flatten(*key): value for key, value in sorted(self.counters.items())
+                },
+                'gauges': {
+                    flatten(*key): value for key, value in sorted(self.gauges.items())
+                },
+                'histograms': {
+                    flatten(*key): hist.summary()
+                    for key, hist in sorted(self.histograms.items())
+                },
+            }
+
+
+def format_labels(labels):
+    """
+    Returns
+    -------
+    [str] Prometheus label set, e.g. '{stage="extract"}', or '' if no labels.
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+        for key, value in labels
+    ) + '}'
+
+
+### DEFAULT REGISTRY ###
+
+
+registry = Registry()
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    registry.set(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def to_prometheus():
+    return registry.to_prometheus()
+
+
+def summary():
+    return registry.summary()
+
+
+def trace_memory(enabled=True):
+    """
+    Turns per-stage peak memory reporting on or off.
+    """
+    registry.memory = enabled
+
+
+@contextmanager
+def timer(name, **labels):
+    """
+    Records the wall time of the enclosed block in the histogram
+    '{name}_seconds'.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name + '_seconds', time.perf_counter() - start, **labels)
+
+
+@contextmanager
+def stage(name, prefix='etl'):
+    """
+    Times a pipeline stage into '{prefix}_stage_seconds{stage=name}'. When
+    memory tracing is on, the peak bytes allocated during the stage are kept
+    in the gauge '{prefix}_stage_peak_bytes{stage=name}' (max over all runs
+    of the stage).
+    """
+    trace = registry.memory
+    if trace:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        start_bytes = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+
+    try:
+        with timer(prefix + '_stage', stage=name):
+            yield
+    finally:
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1] - start_bytes
+            key = (prefix + '_stage_peak_bytes', (('stage', name),))
+            with registry.lock:
+                registry.gauges[key] = max(registry.gauges.get(key, 0), peak)
+
+
+def timed(name, **labels):
+    """
+    Decorator that records the wall time of every call to the decorated
+    function in the histogram '{name}_seconds'.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def write_summary(run_name, folder=None):
+    """
+    Writes the metrics of this run to '{folder}/{run_name}.json' and, for
+    the node_exporter textfile collector, '{folder}/{run_name}.prom'. The
+    folder defaults to $METRICS_DIR or 'metrics'.
+
+    Returns
+    -------
+    [dict] The JSON summary that was written.
+    """
+    folder = folder or os.environ.get('METRICS_DIR', 'metrics')
+    os.makedirs(folder, exist_ok=True)
+
+    run_summary = summary()
+    with open(os.path.join(folder, run_name + '.json'), 'w') as f:
+        json.dump(run_summary, f, indent=2)
+    with open(os.path.join(folder, run_name + '.prom'), 'w') as f:
+        f.write(to_prometheus())
+
+    return run_summary
@@ -0,0 +1,157 @@
+"""
+Mergeable quantile sketches (DDSketch) for trip durations.
+
+A DDSketch keeps counts in logarithmically sized buckets, so any quantile it
+returns is within `alpha` relative error of the true value (1% by default),
+using a few dozen buckets for durations of a few minutes to a few hours.
+Two sketches are merged by adding their bucket counts, which lets separate
+ETL loads be combined without rescanning trips.
+
+Reference: Masson, Rim & Lee, "DDSketch: A Fast and Fully-Mergeable Quantile
+Sketch with Relative-Error Guarantees", VLDB 2019.
+
+Examples
+--------
+>>> sketch = DDSketch()
+>>> for duration in [41, 43, 46, 52, 60]:
+        sketch.add(duration)
+>>> round(sketch.quantile(0.5))
+46
+"""
+
+import math
+
+
+class DDSketch:
+    """
+    Quantile sketch over positive values with relative accuracy `alpha`.
+    """
+
+    def __init__(self, alpha = 0.01):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def key(self, value):
+        """
+        Returns
+        -------
+        [int] Index of the bucket holding `value`.
+        """
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def add(self, value, count = 1):
+        """
+        Adds `value` to the sketch `count` times.
+        """
+        if value <= 0:
+            self.zero_count += count
+        else:
+            key = self.key(value)
+            self.bins[key] = self.bins.get(key, 0) + count
+
+        self.count += count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Adds every value summarized by `other` into this sketch. Both
+        sketches must use the same `alpha`.
+        """
+        if other.alpha != self.alpha:
+            raise ValueError('Cannot merge sketches with different alpha')
+
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        for value in [other.min, other.max]:
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+        return self
+
+    def quantile(self, q):
+        """
+        Returns
+        -------
+        [float] Estimate of the `q` quantile (0 <= q <= 1), or None if the
+        sketch is empty.
+        """
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0
+
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                value = 2 * self.gamma ** key / (self.gamma + 1)
+                # Never report outside the observed range
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def to_dict(self):
+        """
+        Returns
+        -------
+        [dict] JSON-serializable form of the sketch, e.g. for a JSONB column.
+        """
+        return {
+            'alpha': self.alpha,
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'bins': {str(key): count for key, count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Returns
+        -------
+        [DDSketch] The sketch serialized by to_dict().
+        """
+        sketch = cls(data['alpha'])
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        sketch.bins = {int(key): count for key, count in data['bins'].items()}
+        return sketch
+
+
+def hour_of_week(day, hour):
+    """
+    Returns
+    -------
+    [int] 0 for Monday 00:00-00:59 up to 167 for Sunday 23:00-23:59.
+
+    Parameters
+    ----------
+    day: [int] ISO weekday, 1 being Monday and 7 being Sunday.
+
+    hour: [int] Hour of the day, 0-23.
+    """
+    return (day - 1) * 24 + hour
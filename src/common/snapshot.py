@@ -0,0 +1,187 @@
+"""
+Versioned, columnar snapshots of the trip data for the Dash app.
+
+A snapshot is a directory of one NumPy .npy file per column plus a
+manifest.json. Snapshots live side by side under one folder:
+
+    snapshot/
+      CURRENT                     <- name of the live version
+      20200426-101500-123456/
+        manifest.json
+        figures.json              <- pre-serialized default figures
+        departure_ts.npy
+        duration.npy
+        ...
+
+Writers build a new version directory and then atomically replace CURRENT,
+so readers never see a half-written snapshot. Readers open the columns with
+mmap_mode='r', so every process on the host shares the same pages from the
+OS page cache instead of holding its own copy.
+"""
+
+from datetime import datetime
+import json
+import os
+import shutil
+import numpy as np
+
+
+# Bump when the on-disk layout changes so old snapshots are ignored
+format_version = 5
+
+default_folder = os.environ.get(
+    'SNAPSHOT_DIR',
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+        'snapshot'
+    )
+)
+
+
+def current_version(folder = default_folder):
+    """
+    Returns
+    -------
+    [str] Path to the live snapshot version, or None if there is none.
+    """
+    try:
+        with open(os.path.join(folder, 'CURRENT'), 'r') as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+
+    path = os.path.join(folder, name)
+    return path if os.path.isdir(path) else None
+
+
+def read_manifest(folder = default_folder):
+    """
+    Returns
+    -------
+    [dict] Manifest of the live snapshot, or None if there is no usable
+    snapshot (missing, or written in an older format).
+    """
+    path = current_version(folder)
+    if path is None:
+        return None
+
+    with open(os.path.join(path, 'manifest.json'), 'r') as f:
+        manifest = json.load(f)
+
+    if manifest.get('format_version') != format_version:
+        return None
+
+    manifest['path'] = path
+    return manifest
+
+
+def to_array(series):
+    """
+    Returns
+    -------
+    [np.ndarray] The values of a pandas Series in a fixed-width dtype that
+    can be memory mapped. Text columns become fixed-width unicode.
+    """
+    values = series.to_numpy()
+    if values.dtype == object:
+        values = values.astype(str)
+    return values
+
+
+def write_snapshot(df, folder = default_folder, extra = None, keep = 2,
+                   figures_json = None):
+    """
+    Writes `df` as a new snapshot version and makes it the live one.
+
+    Returns
+    -------
+    [str] Path of the new version directory.
+
+    Parameters
+    ----------
+    df: [Pandas df] Data to store, e.g. the trips_time frame.
+
+    folder: [str] Snapshot root directory.
+
+    extra: [dict] Additional fields for the manifest.
+
+    keep: [int] Number of versions to keep on disk, including the new one.
+
+    figures_json: [str] Figures already serialized to JSON, stored as-is so
+    the app can serve them without building them again.
+    """
+    os.makedirs(folder, exist_ok = True)
+
+    name = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    path = os.path.join(folder, name)
+    os.mkdir(path)
+
+    for column in df.columns:
+        np.save(os.path.join(path, column + '.npy'), to_array(df[column]))
+
+    if figures_json is not None:
+        with open(os.path.join(path, 'figures.json'), 'w') as f:
+            f.write(figures_json)
+
+    manifest = {
+        'format_version': format_version,
+        'has_figures': figures_json is not None,
+        'created_at': datetime.now().isoformat(timespec = 'seconds'),
+        'num_rows': len(df),
+        'columns': list(df.columns),
+    }
+    manifest.update(extra or {})
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent = 2)
+
+    # Atomically point CURRENT at the new version
+    tmp_pointer = os.path.join(folder, 'CURRENT.tmp')
+    with open(tmp_pointer, 'w') as f:
+        f.write(name)
+    os.replace(tmp_pointer, os.path.join(folder, 'CURRENT'))
+
+    prune(folder, keep)
+
+    return path
+
+
+def prune(folder, keep):
+    """
+    Deletes all but the newest `keep` snapshot versions. Processes that still
+    have an older version mapped keep reading it until they close it.
+    """
+    versions = sorted(
+        name for name in os.listdir(folder)
+        if os.path.isdir(os.path.join(folder, name))
+    )
+    for name in versions[:-keep]:
+        shutil.rmtree(os.path.join(folder, name), ignore_errors = True)
+
+
+def read_columns(manifest):
+    """
+    Returns
+    -------
+    [dict] Column name to read-only memory-mapped array for the snapshot
+    described by `manifest`.
+    """
+    return {
+        column: np.load(
+            os.path.join(manifest['path'], column + '.npy'), mmap_mode = 'r'
+        )
+        for column in manifest['columns']
+    }
+
+
+def read_figures(manifest):
+    """
+    Returns
+    -------
+    [dict] The figures stored with the snapshot described by `manifest`, or
+    None if it has none.
+    """
+    if not manifest.get('has_figures'):
+        return None
+
+    with open(os.path.join(manifest['path'], 'figures.json'), 'r') as f:
+        return json.load(f)
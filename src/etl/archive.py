@@ -0,0 +1,291 @@
+"""
+This module archives the raw Google Maps Directions responses the collector
+receives, so trips can be re-parsed later (see reprocess.py) when a new field
+is needed, instead of only the fields parse_directions() kept at the time.
+
+Responses are small and nearly identical, so each one is compressed on its
+own with zstd using a dictionary trained on earlier responses, and appended
+to one file per route and day:
+
+    archive/
+      dictionaries/
+        1234567890.dict           <- named by zstd dictionary id
+      A/
+        2020-04-13.zst            <- length-prefixed zstd frames
+      B/
+        2020-04-13.zst
+
+Every record is a 4-byte big-endian length followed by one complete zstd
+frame, so a file can be appended to at any time and read back one response
+at a time. Each frame records the id of the dictionary it was compressed
+with, so retraining never makes older frames unreadable.
+
+Usage:
+    python src/etl/archive.py train [--size 16384]
+    python src/etl/archive.py stats
+"""
+
+import argparse
+import glob
+import json
+import os
+import struct
+import zstandard as zstd
+
+
+archive_folder = 'archive'
+
+frame_header = struct.Struct('>I')
+
+compression_level = 10
+
+
+def dictionary_folder(folder = archive_folder):
+    """
+    Returns
+    -------
+    [str] Directory holding the trained dictionaries of archive `folder`.
+    """
+    return os.path.join(folder, 'dictionaries')
+
+
+def load_dictionaries(folder = archive_folder):
+    """
+    Returns
+    -------
+    [dict] zstd dictionary id to ZstdCompressionDict for every dictionary
+    trained for archive `folder`.
+    """
+    dictionaries = {}
+    for path in glob.glob(os.path.join(dictionary_folder(folder), '*.dict')):
+        with open(path, 'rb') as f:
+            dictionary = zstd.ZstdCompressionDict(f.read())
+        dictionaries[dictionary.dict_id()] = dictionary
+    return dictionaries
+
+
+def latest_dictionary(folder = archive_folder):
+    """
+    Returns
+    -------
+    [ZstdCompressionDict] The most recently trained dictionary, or None if
+    none has been trained yet.
+    """
+    paths = glob.glob(os.path.join(dictionary_folder(folder), '*.dict'))
+    if not paths:
+        return None
+
+    with open(max(paths, key = os.path.getmtime), 'rb') as f:
+        return zstd.ZstdCompressionDict(f.read())
+
+
+def archive_path(route_id, date, folder = archive_folder):
+    """
+    Returns
+    -------
+    [str] Path of the archive file for `route_id` on `date`.
+    """
+    return os.path.join(folder, route_id, date.strftime('%Y-%m-%d') + '.zst')
+
+
+def append_response(full_directions, start_location_id, requested_at,
+                    folder = archive_folder, dictionary = None, route = None):
+    """
+    Compresses one raw Directions response and appends it to the day's
+    archive file.
+
+    Returns
+    -------
+    [int] Compressed size of the record in bytes.
+
+    Parameters
+    ----------
+    full_directions: dict returned by get_full_directions().
+
+    start_location_id: [str] Either 'A' or 'B'.
+
+    requested_at: [datetime] Time the API was asked for the best trip.
+
+    folder: [str] Archive root directory.
+
+    dictionary: [ZstdCompressionDict] Dictionary to compress with. Defaults
+    to the latest one trained for `folder`, or none if there is none yet.
+
+    route: [dict] Output of data_collection.route_fields(), kept with the
+    response so reprocessed trips keep their route. Responses without one are
+    filed under `start_location_id`.
+    """
+    if dictionary is None:
+        dictionary = latest_dictionary(folder)
+
+    record = {
+        'start_location_id': start_location_id,
+        'requested_at': requested_at.timestamp(),
+        'response': full_directions,
+    }
+    if route is not None:
+        record['route'] = route
+    route_id = record.get('route', {}).get('route_id', start_location_id)
+    compressor = zstd.ZstdCompressor(level = compression_level, dict_data = dictionary)
+    frame = compressor.compress(json.dumps(record).encode())
+
+    path = archive_path(route_id, requested_at, folder)
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    # One write per record so concurrent appenders never interleave frames
+    with open(path, 'ab') as f:
+        f.write(frame_header.pack(len(frame)) + frame)
+
+    return frame_header.size + len(frame)
+
+
+def read_frames(path):
+    """
+    Yields every compressed frame in the archive file at `path`. A frame cut
+    short by an interrupted write at the end of the file is skipped.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(frame_header.size)
+            if len(header) < frame_header.size:
+                return
+            size, = frame_header.unpack(header)
+            frame = f.read(size)
+            if len(frame) < size:
+                return
+            yield frame
+
+
+def decompress_frame(frame, dictionaries):
+    """
+    Returns
+    -------
+    [dict] The record stored in `frame`, decompressed with the dictionary it
+    was compressed with.
+    """
+    dict_id = zstd.get_frame_parameters(frame).dict_id
+    decompressor = zstd.ZstdDecompressor(dict_data = dictionaries.get(dict_id))
+    return json.loads(decompressor.decompress(frame))
+
+
+def read_archive(path, dictionaries):
+    """
+    Yields every record, a dict with keys start_location_id, requested_at,
+    response and, for responses archived with one, route, in the archive
+    file at `path`.
+
+    Parameters
+    ----------
+    path: [str] Archive file, e.g. 'archive/A/2020-04-13.zst'.
+
+    dictionaries: [dict] Output of load_dictionaries().
+    """
+    for frame in read_frames(path):
+        yield decompress_frame(frame, dictionaries)
+
+
+def archive_files(folder = archive_folder, start_date = None, end_date = None):
+    """
+    Returns
+    -------
+    [list] Paths of the archive files for days between `start_date` and
+    `end_date` inclusive, for every starting location. Dates are
+    'YYYY-MM-DD' strings; None means unbounded.
+    """
+    paths = []
+    for path in glob.glob(os.path.join(folder, '*', '*.zst')):
+        date = os.path.basename(path)[:-len('.zst')]
+        if start_date and date < start_date:
+            continue
+        if end_date and date > end_date:
+            continue
+        paths.append(path)
+    return sorted(paths)
+
+
+def train_dictionary(folder = archive_folder, size = 16384, max_samples = 5000):
+    """
+    Trains a new dictionary on the most recent archived responses and saves
+    it for append_response() to use from then on.
+
+    Returns
+    -------
+    [ZstdCompressionDict] The new dictionary.
+
+    Parameters
+    ----------
+    folder: [str] Archive root directory.
+
+    size: [int] Maximum dictionary size in bytes.
+
+    max_samples: [int] Number of responses to train on.
+    """
+    dictionaries = load_dictionaries(folder)
+
+    samples = []
+    for path in reversed(archive_files(folder)):
+        for frame in read_frames(path):
+            record = decompress_frame(frame, dictionaries)
+            samples.append(json.dumps(record).encode())
+        if len(samples) >= max_samples:
+            break
+
+    if not samples:
+        raise ValueError('No archived responses in {} to train on'.format(folder))
+
+    dictionary = zstd.train_dictionary(size, samples[:max_samples])
+
+    os.makedirs(dictionary_folder(folder), exist_ok = True)
+    path = os.path.join(dictionary_folder(folder), '{}.dict'.format(dictionary.dict_id()))
+    with open(path, 'wb') as f:
+        f.write(dictionary.as_bytes())
+
+    print('Trained dictionary {} ({} bytes) on {} responses'.format(
+        path, len(dictionary.as_bytes()), len(samples[:max_samples])
+    ))
+    print_ratios(samples[:max_samples], dictionary)
+
+    return dictionary
+
+
+def print_ratios(samples, dictionary):
+    """
+    Prints how well `samples` compress with and without `dictionary`.
+    """
+    raw = sum(len(sample) for sample in samples)
+    for name, dict_data in [('no dictionary', None), ('dictionary', dictionary)]:
+        compressor = zstd.ZstdCompressor(level = compression_level, dict_data = dict_data)
+        compressed = sum(len(compressor.compress(sample)) for sample in samples)
+        print('{:<16}{:>12} bytes{:>8.1f}x'.format(name, compressed, raw / compressed))
+
+
+def print_stats(folder = archive_folder):
+    """
+    Prints the number of responses and bytes archived per route.
+    """
+    print('{:<8}{:>8}{:>12}{:>14}'.format('route', 'days', 'responses', 'bytes'))
+    for route_folder in sorted(glob.glob(os.path.join(folder, '*'))):
+        route_id = os.path.basename(route_folder)
+        if route_id == 'dictionaries':
+            continue
+        paths = glob.glob(os.path.join(route_folder, '*.zst'))
+        num_responses = sum(sum(1 for _ in read_frames(path)) for path in paths)
+        num_bytes = sum(os.path.getsize(path) for path in paths)
+        print('{:<8}{:>8}{:>12}{:>14}'.format(
+            route_id, len(paths), num_responses, num_bytes
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Manage the raw response archive.')
+    parser.add_argument('command', choices = ['train', 'stats'])
+    parser.add_argument('--folder', default = archive_folder)
+    parser.add_argument('--size', type = int, default = 16384,
+                        help = 'maximum dictionary size in bytes')
+    parser.add_argument('--max-samples', type = int, default = 5000)
+    args = parser.parse_args()
+
+    if args.command == 'train':
+        train_dictionary(args.folder, args.size, args.max_samples)
+    else:
+        print_stats(args.folder)
@@ -1,5 +1,10 @@
+import argparse
 import psycopg2
 from sql_queries import create_table_queries, drop_table_queries, trips_time_create
+from sql_queries import (
+    database_exists_select, schema_drop, schema_create, search_path_set,
+    shadow_schema
+)
 
 
 def create_database():
@@ -43,6 +48,54 @@ def create_database():
     return cur, conn
 
 
+def ensure_database():
+    """
+    Returns
+    -------
+    psycopg2 cursor and connection objects.
+
+    Like create_database(), but google_maps is only created if it does not
+    exist yet. Existing data is left untouched so it can keep being served
+    during a blue/green reload.
+    """
+    conn = psycopg2.connect(
+        host = '127.0.0.1',
+        dbname = 'defaultdb',
+        user = 'google_user',
+        password = 'passw0rd',
+    )
+    cur = conn.cursor()
+    conn.set_session(autocommit = True)
+
+    cur.execute(database_exists_select, ('google_maps',))
+    if cur.fetchone() is None:
+        cur.execute("CREATE DATABASE google_maps WITH ENCODING 'utf8' TEMPLATE template0")
+
+    conn.close()
+
+    conn = psycopg2.connect(
+        host = '127.0.0.1',
+        dbname = 'google_maps',
+        user = 'google_user',
+        password = 'passw0rd'
+    )
+    cur = conn.cursor()
+    conn.set_session(autocommit = True)
+
+    return cur, conn
+
+
+def create_schema(cur, schema):
+    """
+    Drops `schema` if it is left over from a failed reload, creates it empty,
+    and points this session's search_path at it so the tables and view
+    created next land there.
+    """
+    cur.execute(schema_drop.format(schema))
+    cur.execute(schema_create.format(schema))
+    cur.execute(search_path_set.format(schema))
+
+
 def drop_tables(cur):
     """
     All tables in google_maps are dropped as specified by the queries in
@@ -79,15 +132,23 @@ def create_view(cur):
         print('ERROR: Could not create the view')
         print(e)
 
-def main():
+def main(blue_green = False):
     """
     Bundles up the script: creates db and opens connection, drops all tables
     that exist, creates all five tables, and then closes the connection to the
     database.
+
+    With `blue_green`, the database is kept and the tables are created in an
+    empty shadow schema instead, for `etl.py --blue-green` to populate and
+    swap in.
     """
-    cur, conn = create_database()
+    if blue_green:
+        cur, conn = ensure_database()
+        create_schema(cur, shadow_schema)
+    else:
+        cur, conn = create_database()
+        drop_tables(cur)
 
-    drop_tables(cur)
     create_tables(cur)
     create_view(cur)
 
@@ -95,4 +156,11 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description = 'Create the google_maps tables.')
+    parser.add_argument(
+        '--blue-green', action = 'store_true',
+        help = 'create the tables in a shadow schema without touching live data'
+    )
+    args = parser.parse_args()
+
+    main(args.blue_green)
@@ -6,14 +6,110 @@ in two newly created subdirectories.
 Author: M. Sanchez-Ayala (04/10/2020)
 """
 
+import argparse
 from datetime import datetime
 import json
 import os
+import sys
 import googlemaps
 from google.cloud import storage
 import config
+import archive
+import dedup
+import scheduler
 from download_storage import establish_directories
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+
+
+def call_api(endpoint, func, **kwargs):
+    """
+    Returns
+    -------
+    The result of func(**kwargs), a Google Maps API client method. The call
+    latency and any error are recorded in metrics under `endpoint`.
+    """
+    metrics.inc('gmaps_requests_total', endpoint=endpoint)
+    try:
+        with metrics.timer('gmaps_request', endpoint=endpoint):
+            return func(**kwargs)
+    except Exception as e:
+        metrics.inc('gmaps_errors_total', endpoint=endpoint, error=type(e).__name__)
+        raise
+
+
+class RedirectedClient(googlemaps.Client):
+    """
+    Google Maps client that sends every request to `base_url` instead of
+    https://maps.googleapis.com, e.g. to the fake server in
+    src/bench/fake_maps.py. googlemaps 4.1.0 has no setting for this.
+    """
+
+    def __init__(self, key, base_url, **kwargs):
+        super().__init__(key, **kwargs)
+        self.base_url = base_url
+
+    def _request(self, url, params, first_request_time = None, retry_counter = 0,
+                 base_url = None, *args, **kwargs):
+        return super()._request(
+            url, params, first_request_time, retry_counter, self.base_url,
+            *args, **kwargs
+        )
+
+
+def create_client(api_key, base_url = None):
+    """
+    Returns
+    -------
+    googlemaps.Client for `api_key`, talking to `base_url` if given.
+    """
+    if base_url is None:
+        return googlemaps.Client(api_key)
+    return RedirectedClient(api_key, base_url)
+
+
+def configured_routes():
+    """
+    Returns
+    -------
+    Tuple of the locations to collect between, a dict of location code to
+    address, and the routes to collect, a list of (route_id, origin code,
+    destination code, mode) tuples.
+
+    Both come from `locations` and `routes` in config.py. Without them, the
+    two trips between location_A and location_B are collected, as routes A
+    and B.
+    """
+    locations = getattr(config, 'locations', None)
+    if locations is None:
+        locations = {'A': config.location_A, 'B': config.location_B}
+
+    routes = getattr(config, 'routes', None)
+    if routes is None:
+        routes = [('A', 'A', 'B', 'transit'), ('B', 'B', 'A', 'transit')]
+
+    return locations, routes
+
+
+def geocode_locations(locations, gmaps_client):
+    """
+    Returns
+    -------
+    Dict of location code to coordinates for every address in `locations`.
+
+    Parameters
+    ----------
+    locations: [dict] Location code to address as you would input into
+    Google Maps.
+
+    gmaps_client: the connection to the Google Maps API.
+    """
+    return {
+        code: call_api('geocode', gmaps_client.geocode, address=address)[0]['geometry']['location']
+        for code, address in locations.items()
+    }
+
 
 def locations_to_coords(location_A, location_B, gmaps_client):
     """
@@ -40,7 +136,7 @@ def locations_to_coords(location_A, location_B, gmaps_client):
     """
     # Convert each location to coordinates and store in list
     coords = [
-        gmaps_client.geocode(location)[0]['geometry']['location']
+        call_api('geocode', gmaps_client.geocode, address=location)[0]['geometry']['location']
         for location in [location_A, location_B]
     ]
     return coords
@@ -65,7 +161,9 @@ def get_full_directions(gmaps_client, coords, mode, start_time):
     """
 
     # Call API
-    directions = gmaps_client.directions(
+    directions = call_api(
+        'directions',
+        gmaps_client.directions,
         origin = coords[0],
         destination = coords[1],
         mode = mode,
@@ -74,6 +172,116 @@ def get_full_directions(gmaps_client, coords, mode, start_time):
     return directions
 
 
+# Distance Matrix API limits per request
+max_matrix_side = 25
+max_matrix_elements = 100
+
+
+def matrix_batches(pairs):
+    """
+    Yields (origins, destinations) lists of indexes, each the block of one
+    Distance Matrix request within the API limits. Requests are billed per
+    element, i.e. per origin and destination in the block, so a block only
+    holds origins that go to the very same destinations: every element
+    requested is one of `pairs`, and each of `pairs` is requested once.
+
+    Parameters
+    ----------
+    pairs: [list] (origin, destination) indexes of the trips to collect.
+    """
+    destinations_of = {}
+    for origin, destination in pairs:
+        destinations = destinations_of.setdefault(origin, [])
+        if destination not in destinations:
+            destinations.append(destination)
+
+    # Origins going to the same destinations share their requests
+    origins_of = {}
+    for origin, destinations in destinations_of.items():
+        origins_of.setdefault(tuple(destinations), []).append(origin)
+
+    for destinations, origins in origins_of.items():
+        for d_start in range(0, len(destinations), max_matrix_side):
+            block = list(destinations[d_start:d_start + max_matrix_side])
+            origin_step = min(max_matrix_side, max_matrix_elements // len(block))
+            for o_start in range(0, len(origins), origin_step):
+                yield origins[o_start:o_start + origin_step], block
+
+
+def get_duration_matrix(gmaps_client, origins, destinations, pairs, mode, start_time):
+    """
+    Returns
+    -------
+    Dict of (i, j) to the Distance Matrix element (status, duration and
+    distance) for origins[i] to destinations[j], for each (i, j) in `pairs`.
+
+    Parameters
+    ----------
+    gmaps_client: the connection to the Google Maps API.
+
+    origins, destinations: [list] Coordinates as returned by
+    locations_to_coords().
+
+    pairs: [list] (i, j) indexes of the origin and destination of each trip.
+
+    mode: [str] A method of transportation. Walking, driving, biking, or transit.
+
+    start_time: [datetime] Time at which the API is called to look for the best trip.
+    """
+    elements = {}
+
+    for block_origins, block_destinations in matrix_batches(pairs):
+        response = call_api(
+            'distance_matrix',
+            gmaps_client.distance_matrix,
+            origins = [origins[i] for i in block_origins],
+            destinations = [destinations[j] for j in block_destinations],
+            mode = mode,
+            departure_time = start_time
+        )
+        for i, row in zip(block_origins, response['rows']):
+            for j, element in zip(block_destinations, row['elements']):
+                elements[i, j] = element
+
+    return elements
+
+
+def parse_matrix_element(element, start_location, start_location_id, start_time):
+    """
+    Returns
+    -------
+    A trip in the same format as parse_directions(), or None if the Distance
+    Matrix found no route. The matrix has no step detail, so `steps` is
+    empty and `source` marks the trip's lines as unknown rather than walk
+    only. The trip departs when it was requested.
+
+    Parameters
+    ----------
+    element: One element of get_duration_matrix().
+
+    start_location: [dict] Coordinates of the origin.
+
+    start_location_id: [str] Either 'A' or 'B'.
+
+    start_time: [datetime] Time at which the API was called.
+    """
+    if element.get('status') != 'OK':
+        return None
+
+    departure_time = int(start_time.timestamp())
+    duration = element['duration']['value']  # Seconds
+
+    return {
+        'start_location': start_location,
+        'start_location_id': start_location_id,
+        'departure_time': departure_time,
+        'arrival_time': departure_time + duration,
+        'duration': int(duration/60),
+        'steps': [],
+        'source': 'distance_matrix'
+    }
+
+
 def parse_steps(steps):
     """
     Returns
@@ -147,10 +355,10 @@ def parse_directions(full_directions, start_location_id):
     return trip_directions
 
 
-def to_json(trip_directions):
+def to_json(trip_directions, folder = 'data'):
     """
-    Saves `trip_directions` as JSON in 'data/{sub_dir}' where sub_dir is
-    A or B depending on the start_location_id.
+    Saves `trip_directions` as JSON in '{folder}/{sub_dir}' where sub_dir is
+    the route_id, or the start_location_id for trips without one.
 
     Returns
     -------
@@ -160,13 +368,15 @@ def to_json(trip_directions):
     ----------
     trip_directions: the parsed directions dictionary derived from
     parse_directions() method.
+
+    folder: [str] Data directory, 'data' unless reprocessing elsewhere.
     """
-    sub_dir = trip_directions['start_location_id']
+    sub_dir = trip_directions.get('route_id', trip_directions['start_location_id'])
 
     # Convert departure time timestamp to string for JSON naming
     date = datetime.fromtimestamp(trip_directions['departure_time'])
     date_str = datetime.strftime(date, '%Y-%m-%d_%H-%M-%S')
-    filename = 'data/{}/{}.json'.format(sub_dir, date_str)
+    filename = '{}/{}/{}.json'.format(folder, sub_dir, date_str)
 
     # Export to a JSON
     with open(filename, 'w') as f:
@@ -190,48 +400,272 @@ def to_google_storage(project, bucket, filename):
         blob.upload_from_file(json_file)
 
 
-def main():
+def route_fields(trip):
+    """
+    Returns
+    -------
+    Dict of the fields that tie a parsed trip to its route: route_id,
+    end_location_id, end_location and mode.
+    """
+    return {
+        'route_id': trip['route_id'],
+        'end_location_id': trip['end_location_id'],
+        'end_location': trip['coords'][1],
+        'mode': trip['mode'],
+    }
+
+
+def collect_directions(gmaps_client, trip, start_time, dictionary):
+    """
+    Returns
+    -------
+    The parsed directions for `trip` from a full Directions API call. The raw
+    response is archived first.
+    """
+    # Get full directions for this trip
+    full_directions = get_full_directions(
+        gmaps_client, trip['coords'], trip['mode'], start_time
+    )
+
+    # Keep the raw response so it can be re-parsed later (reprocess.py)
+    archived_bytes = archive.append_response(
+        full_directions, trip['start_location_id'], start_time,
+        dictionary = dictionary, route = route_fields(trip)
+    )
+    metrics.inc('collector_archived_bytes_total', archived_bytes)
+
+    # Parse directions for this trip
+    parsed_directions = parse_directions(full_directions, trip['start_location_id'])
+    parsed_directions.update(route_fields(trip))
+    return parsed_directions
+
+
+def collect_matrix(gmaps_client, trips, start_time):
+    """
+    Returns
+    -------
+    List of parsed trips, without steps, for every trip in `trips` that has a
+    route, from batched Distance Matrix calls over their origins and
+    destinations, per travel mode. Only the trips' own origin/destination
+    pairs are requested, not every origin to every destination.
+    """
+    parsed_trips = []
+
+    for mode in sorted(set(trip['mode'] for trip in trips)):
+        mode_trips = [trip for trip in trips if trip['mode'] == mode]
+
+        origins = []
+        destinations = []
+        pairs = []
+        for trip in mode_trips:
+            if trip['coords'][0] not in origins:
+                origins.append(trip['coords'][0])
+            if trip['coords'][1] not in destinations:
+                destinations.append(trip['coords'][1])
+            pairs.append((
+                origins.index(trip['coords'][0]), destinations.index(trip['coords'][1])
+            ))
+
+        elements = get_duration_matrix(
+            gmaps_client, origins, destinations, pairs, mode, start_time
+        )
+
+        for trip, pair in zip(mode_trips, pairs):
+            element = elements[pair]
+            parsed_directions = parse_matrix_element(
+                element, trip['coords'][0], trip['start_location_id'], start_time
+            )
+            if parsed_directions is None:
+                metrics.inc('collector_no_route_total', route_id=trip['route_id'])
+                continue
+            parsed_directions.update(route_fields(trip))
+            parsed_trips.append(parsed_directions)
+
+    return parsed_trips
+
+
+def save_trip(parsed_directions, dedup_state = None):
+    """
+    Exports one parsed trip to JSON in its subdirectory and records it in
+    metrics.
+
+    With `dedup_state`, from dedup.load_state(), a trip identical to the
+    last one of its route but for its times is appended to that trip's file
+    instead (see dedup.py).
+
+    Returns
+    -------
+    The filepath of the JSON file holding the trip.
+    """
+    route_id = parsed_directions['route_id']
+    filename = None
+    if dedup_state is not None:
+        filename = dedup.append_repeat(dedup_state, parsed_directions)
+    if filename is None:
+        filename = to_json(parsed_directions)
+        if dedup_state is not None:
+            dedup.start_run(dedup_state, parsed_directions, filename)
+    else:
+        metrics.inc('collector_repeats_total', route_id=route_id)
+    metrics.inc('collector_trips_total', route_id=route_id)
+    metrics.set_gauge(
+        'collector_last_duration_minutes',
+        parsed_directions['duration'],
+        route_id=route_id
+    )
+    return filename
+
+
+def main(batch = False, detail_ids = (), adaptive = False, budget = 576, tick = 5,
+         deduplicate = False, start_time = None, stream_trips = False):
     """
     Wraps data collection together.
 
     Creates the correct in which to store collected data.
-    Connects to Google Maps API and gets the coordinates of the two addresses.
-    Exports each trip's parsed directions as a JSON in the subdirectories defined
-    above.
-    """
-    establish_directories()
+    Connects to Google Maps API and gets the coordinates of every location.
+    Exports each route's parsed directions as a JSON in the subdirectories
+    defined above.
+
+    With `batch`, durations come from Distance Matrix calls that cover every
+    trip at once, and only the routes in `detail_ids` get a full Directions
+    call for their steps.
+
+    With `adaptive`, scheduler.py picks which routes are due this run, given
+    `tick`, the minutes between runs, and a `budget` of API calls per day.
+
+    With `deduplicate`, a trip that only differs from the route's last one
+    in its times is recorded as a repeat of it rather than a new file.
 
-    # Connect to Google Maps API
-    gmaps_client = googlemaps.Client(config.api_key)
+    `start_time` is the datetime the trips are requested to depart at, now
+    by default. src/bench/replay.py sets it to replay days in minutes.
 
-    # Convert locations to coordinates
-    coords = locations_to_coords(config.location_A, config.location_B, gmaps_client)
+    With `stream_trips`, the trips are also loaded into postgres right away
+    through a local spool, and the app is notified (see stream.py).
+    """
+    locations, routes = configured_routes()
+    route_ids = [route[0] for route in routes]
+    establish_directories(route_ids)
+
+    if start_time is None:
+        start_time = datetime.now()
+
+    if adaptive:
+        state = scheduler.load_state()
+        decisions = scheduler.decide(state, route_ids, start_time, budget, tick)
+        scheduler.log_decisions(decisions, start_time)
+        route_ids = [decision['route_id'] for decision in decisions if decision['sample']]
+        for decision in decisions:
+            metrics.inc(
+                'collector_schedule_total',
+                route_id=decision['route_id'],
+                decision='sample' if decision['sample'] else 'skip'
+            )
+        if not route_ids:
+            scheduler.save_state(state)
+            metrics.write_summary('data_collection')
+            return
+
+    routes = [route for route in routes if route[0] in route_ids]
+
+    # Connect to Google Maps API (or the server in config.base_url, if set)
+    gmaps_client = create_client(config.api_key, getattr(config, 'base_url', None))
+
+    # Convert the locations these routes need to coordinates
+    needed = set(route[1] for route in routes) | set(route[2] for route in routes)
+    coords = geocode_locations(
+        {code: address for code, address in locations.items() if code in needed},
+        gmaps_client
+    )
+
+    # Every response is archived raw with the same dictionary
+    dictionary = archive.latest_dictionary()
 
-    # Set start time and trip specifications
-    start_time = datetime.now()
+    # Set trip specifications
     trips = [
-        {'start_location_id': 'A', 'coords': coords},
-        {'start_location_id': 'B', 'coords': coords[::-1]}
+        {
+            'route_id': route_id,
+            'start_location_id': origin,
+            'end_location_id': destination,
+            'coords': [coords[origin], coords[destination]],
+            'mode': mode,
+        }
+        for route_id, origin, destination, mode in routes
     ]
 
-    for trip in trips:
+    if batch:
+        detail_trips = [trip for trip in trips if trip['route_id'] in detail_ids]
+        matrix_trips = [trip for trip in trips if trip['route_id'] not in detail_ids]
+    else:
+        detail_trips = trips
+        matrix_trips = []
 
-        # Get full directions for this trip
-        full_directions = get_full_directions(
-            gmaps_client, trip['coords'], 'transit', start_time
-        )
+    parsed_trips = [
+        collect_directions(gmaps_client, trip, start_time, dictionary)
+        for trip in detail_trips
+    ]
+    parsed_trips += collect_matrix(gmaps_client, matrix_trips, start_time)
 
-        # Parse directions for this trip
-        parsed_directions = parse_directions(
-            full_directions, trip['start_location_id']
-        )
+    dedup_state = dedup.load_state() if deduplicate else None
 
-        # Export locally to JSON in subdirectory and store file name
-        filename = to_json(parsed_directions)
+    for parsed_directions in parsed_trips:
+        filename = save_trip(parsed_directions, dedup_state)
+        if adaptive:
+            scheduler.record_sample(
+                state, parsed_directions['route_id'], start_time,
+                parsed_directions['duration']
+            )
 
         # Push that file to Google Storage
         # to_google_storage(config.project, config.bucket, filename)
 
+    if adaptive:
+        scheduler.save_state(state)
+    if deduplicate:
+        dedup.save_state(dedup_state)
+
+    if stream_trips:
+        # Imported here so collecting without it needs no postgres driver
+        import stream
+        stream.spool(parsed_trips)
+        print('{} trips streamed'.format(stream.flush()))
+
+    metrics.write_summary('data_collection')
+
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description = 'Collect one round of trips.')
+    parser.add_argument(
+        '--batch', action = 'store_true',
+        help = 'get durations from batched Distance Matrix calls instead of '
+               'one Directions call per trip'
+    )
+    parser.add_argument(
+        '--detail', nargs = '*', default = [], metavar = 'ROUTE_ID',
+        help = 'with --batch, routes that still get a full Directions call '
+               'for their steps, e.g. --detail A'
+    )
+    parser.add_argument(
+        '--adaptive', action = 'store_true',
+        help = 'only collect the routes the adaptive scheduler says are due'
+    )
+    parser.add_argument(
+        '--budget', type = int, default = 576,
+        help = 'with --adaptive, API calls allowed per day'
+    )
+    parser.add_argument(
+        '--tick', type = int, default = 5,
+        help = 'with --adaptive, minutes between runs of this script'
+    )
+    parser.add_argument(
+        '--dedup', action = 'store_true',
+        help = 'record trips that repeat the route\'s last one as repeats of '
+               'its file instead of new files'
+    )
+    parser.add_argument(
+        '--stream', action = 'store_true',
+        help = 'also load the trips into postgres right away and notify the app'
+    )
+    args = parser.parse_args()
+
+    main(args.batch, args.detail, args.adaptive, args.budget, args.tick, args.dedup,
+         stream_trips = args.stream)
@@ -0,0 +1,212 @@
+"""
+This module run-length encodes trips that come back unchanged. A route often
+returns the same trip run after run: same duration, same steps, only the
+departure and arrival times move on. With deduplication on, such a trip is
+not written to a file of its own; its times are appended to the `repeats`
+of the file that started the run, as offsets from that file's departure and
+arrival times:
+
+    {"departure_time": 1586809354, "arrival_time": 1586812163, ...,
+     "repeats": [[300, 300], [600, 598]]}
+
+etl.py expands every run back into one trip per sample, so the dashboard
+still gets the full time series. A run ends at the first trip that differs,
+or after max_repeats repeats.
+
+The collector keeps the open run of each route in dedup.json in the working
+directory, since each cron run is a new process.
+
+Usage:
+    python src/etl/data_collection.py --dedup
+    python src/etl/dedup.py data data_runs
+
+The second form re-encodes a folder of one-file-per-trip data, e.g. from
+before deduplication was turned on.
+"""
+
+import argparse
+import glob
+import json
+import os
+
+
+state_file = 'dedup.json'
+
+# A day of 5-minute samples, so no file grows without bound
+max_repeats = 287
+
+# Fields that may differ between the trips of a run
+varying_fields = ('departure_time', 'arrival_time', 'repeats')
+
+
+def fingerprint(trip):
+    """
+    Returns
+    -------
+    [str] The trip without the fields that vary within a run, as canonical
+    JSON. Two trips with the same fingerprint can share a run.
+    """
+    return json.dumps(
+        {key: value for key, value in trip.items() if key not in varying_fields},
+        sort_keys = True
+    )
+
+
+def new_state():
+    """
+    Returns
+    -------
+    [dict] State with no open runs.
+    """
+    return {'routes': {}}
+
+
+def load_state(path = state_file):
+    """
+    Returns
+    -------
+    [dict] Open runs saved at `path`, or a new state if there is none.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return new_state()
+
+
+def save_state(state, path = state_file):
+    """
+    Writes `state` to `path`, replacing the old file atomically.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def write_json(data, path):
+    """
+    Writes `data` to `path`, replacing the old file atomically so an ETL run
+    never reads half a run.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def trip_route(trip):
+    """
+    Returns
+    -------
+    [str] Route of `trip`, as data_collection.to_json() files it.
+    """
+    return trip.get('route_id', trip['start_location_id'])
+
+
+def append_repeat(state, trip):
+    """
+    Appends `trip` to the open run of its route if it repeats it.
+
+    Returns
+    -------
+    [str] Path of the run's file, or None if `trip` starts a new run and
+    has to be written to a file of its own (then call start_run()).
+    """
+    run = state['routes'].get(trip_route(trip))
+    if run is None or run['key'] != fingerprint(trip) \
+            or run['num_repeats'] >= max_repeats:
+        return None
+
+    try:
+        with open(run['path'], 'r') as f:
+            data = json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+    data.setdefault('repeats', []).append([
+        trip['departure_time'] - data['departure_time'],
+        trip['arrival_time'] - data['arrival_time']
+    ])
+    write_json(data, run['path'])
+    run['num_repeats'] += 1
+    return run['path']
+
+
+def start_run(state, trip, path):
+    """
+    Records that `trip`, just written to `path`, opens its route's run.
+    """
+    state['routes'][trip_route(trip)] = {
+        'path': path,
+        'key': fingerprint(trip),
+        'num_repeats': 0,
+    }
+
+
+def expand(data):
+    """
+    Returns
+    -------
+    [list] Every trip recorded in the file `data`: the trip itself, then one
+    per repeat, which differ only in departure and arrival time. Files
+    without repeats hold a single trip.
+    """
+    trip = {key: value for key, value in data.items() if key != 'repeats'}
+    trips = [trip]
+    for departure_offset, arrival_offset in data.get('repeats', []):
+        trips.append(dict(
+            trip,
+            departure_time = trip['departure_time'] + departure_offset,
+            arrival_time = trip['arrival_time'] + arrival_offset
+        ))
+    return trips
+
+
+def encode_folder(source, dest):
+    """
+    Writes the trips in the route subdirectories of `source` to the same
+    subdirectories of `dest`, run-length encoded as the collector would
+    have with deduplication on.
+
+    Returns
+    -------
+    Tuple of the number of trips read and files written.
+    """
+    num_trips = 0
+    num_files = 0
+    for sub_dir in sorted(os.listdir(source)):
+        paths = sorted(glob.glob(os.path.join(source, sub_dir, '*.json')))
+        if not paths:
+            continue
+        os.makedirs(os.path.join(dest, sub_dir), exist_ok = True)
+
+        # Each folder is one route, so its trips are one series of runs
+        state = new_state()
+        for path in paths:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            for trip in expand(data):
+                num_trips += 1
+                if append_repeat(state, trip) is None:
+                    # Named after the first trip of the run, like to_json()
+                    new_path = os.path.join(dest, sub_dir, os.path.basename(path))
+                    if os.path.exists(new_path):
+                        new_path = new_path[:-len('.json')] + '_{}.json'.format(trip['departure_time'])
+                    write_json(trip, new_path)
+                    start_run(state, trip, new_path)
+                    num_files += 1
+
+    return num_trips, num_files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Run-length encode a folder of trip JSON files.'
+    )
+    parser.add_argument('source', help = 'folder of route subdirectories, e.g. data')
+    parser.add_argument('dest', help = 'folder to write the encoded files to')
+    args = parser.parse_args()
+
+    num_trips, num_files = encode_folder(args.source, args.dest)
+    print('{} trips written to {} files in {}'.format(num_trips, num_files, args.dest))
@@ -0,0 +1,273 @@
+"""
+This module watches the trips as they are loaded for service disruptions,
+so a suspended line or a detour shows up in the disruptions table, and as
+markers on the dashboard's time series, instead of being spotted in the
+plot after the fact.
+
+Every trip is compared with what is usual for its route at that hour of the
+week, e.g. Mondays 08:00-08:59:
+
+- Slow: for each route and hour of the week, an exponentially weighted mean
+  and mean absolute deviation of the duration are kept. Once an hour has
+  `min_samples` trips, each is clipped to `clip` deviations before it
+  updates them, so one disrupted morning barely moves the baseline. A
+  trip's robust z-score is how many deviations it is above the mean, and
+  the route's score a moving average of those, so one slow trip needs to be
+  far off to count. A slow disruption opens when the score reaches
+  `enter_score` and the trip is at least `min_delay` minutes late, and
+  closes once the score drops below `exit_score`.
+
+- Detour: for each route, exponentially decayed counts of the trips riding
+  each line are kept. A trip riding a line that less than `min_share` of
+  the route's recent trips rode, e.g. a shuttle bus, is off route, and
+  `min_run` of those in a row open a detour, which closes at the first trip
+  that rides none of the lines it detoured on.
+
+Either way, the state of a route is at most 168 hourly baselines, a few
+dozen line counts and its open disruptions, however long its history, and a
+trip costs a constant amount of work. etl.py and stream.py run every trip
+they load through it, and keep the state in the disruption_baselines table
+next to the disruptions it flags.
+
+Usage:
+    python src/bench/disruption_check.py --data data
+"""
+
+# Weight of the newest trip in an hour's baseline
+alpha = 0.1
+
+# Trips an hour of the week needs before its trips are scored
+min_samples = 8
+
+# Deviation, in minutes, assumed for an hour with no spread yet, and a floor
+# so steady hours don't flag a minute's wobble
+min_deviation = 1.0
+
+# Deviations beyond which a trip is clipped before updating the baseline
+clip = 3.0
+
+# Weight of the newest trip's z-score in the route's score
+score_alpha = 0.3
+
+# Score at which a slow disruption opens, and below which it closes
+enter_score = 2.0
+exit_score = 1.0
+
+# Minutes over the baseline a trip must take to open a slow disruption
+min_delay = 5
+
+# A gap between trips longer than this, in seconds, restarts the score
+max_gap = 3 * 3600
+
+# Lines counted per route, and the decay of their counts per trip
+max_lines = 32
+line_decay = 0.002
+
+# Share of recent trips below which a line is off route, and the weight of
+# recent trips a route needs before detours are flagged
+min_share = 0.02
+min_weight = 100
+
+# Off route trips in a row that make a detour
+min_run = 3
+
+# The mean absolute deviation of a normal distribution is 0.8 of its
+# standard deviation
+mad_to_std = 1.25
+
+
+def new_route():
+    """
+    Returns
+    -------
+    [dict] Detector state of a route with no history.
+    """
+    return {
+        'baselines': {},
+        'score': 0.0,
+        'last_ts': None,
+        'lines': {},
+        'weight': 0.0,
+        'rare_trips': 0,
+        'rare_since': None,
+        'open': {},
+    }
+
+
+def score_trip(baseline, duration):
+    """
+    Returns
+    -------
+    [float] Robust z-score of `duration` against an hour's `baseline`, or
+    None if the hour has too few trips yet.
+    """
+    mean, deviation, n = baseline
+    if n < min_samples:
+        return None
+    return (duration - mean) / max(deviation * mad_to_std, min_deviation)
+
+
+def update_baseline(baseline, duration):
+    """
+    Returns
+    -------
+    [list] `baseline`, [mean, mean absolute deviation, trips], updated with
+    `duration`. The first trips are averaged evenly; once the hour is
+    scored, trips are clipped to `clip` deviations of the mean.
+    """
+    if baseline is None:
+        return [float(duration), 0.0, 1]
+    mean, deviation, n = baseline
+    if n >= min_samples:
+        spread = clip * max(deviation * mad_to_std, min_deviation)
+        duration = min(max(duration, mean - spread), mean + spread)
+    weight = max(alpha, 1 / (n + 1))
+    diff = duration - mean
+    return [mean + weight * diff, deviation + weight * (abs(diff) - deviation), n + 1]
+
+
+def rare_lines(route, lines):
+    """
+    Returns
+    -------
+    [list] Those of `lines` ridden by less than `min_share` of the route's
+    recent trips, or none until it has `min_weight` of them.
+    """
+    weight = route['weight']
+    if weight < min_weight:
+        return []
+    return [line for line in lines if route['lines'].get(line, 0.0) < weight * min_share]
+
+
+def count_lines(route, lines):
+    """
+    Counts a trip riding `lines` in the route's decayed counts, dropping the
+    least ridden line if there are more than `max_lines`.
+    """
+    counts = route['lines']
+    for line in counts:
+        counts[line] *= 1 - line_decay
+    for line in lines:
+        counts[line] = counts.get(line, 0.0) + 1
+    while len(counts) > max_lines:
+        del counts[min(counts, key = counts.get)]
+    route['weight'] = route['weight'] * (1 - line_decay) + 1
+
+
+def open_disruption(route, kind, departure_ts, duration, expected, score, signature):
+    """
+    Returns
+    -------
+    [dict] A new disruption of `kind` starting with this trip, left open in
+    the route's state.
+    """
+    disruption = {
+        'kind': kind,
+        'started_ts': departure_ts,
+        'ended_ts': None,
+        'num_trips': 0,
+        'peak_ts': departure_ts,
+        'peak_score': score,
+        'duration': duration,
+        'expected': expected,
+        'signature': signature,
+    }
+    route['open'][kind] = disruption
+    return disruption
+
+
+def add_trip(disruption, departure_ts, duration, expected, score):
+    """
+    Counts a trip in an open `disruption`, keeping the worst one.
+    """
+    disruption['num_trips'] += 1
+    if score is not None and score > disruption['peak_score']:
+        disruption['peak_ts'] = departure_ts
+        disruption['peak_score'] = score
+        disruption['duration'] = duration
+        disruption['expected'] = expected
+
+
+def observe(route, week_hour, departure_ts, duration, signature):
+    """
+    Scores one trip of a route and updates the route's state with it. Trips
+    must be observed in order of departure; earlier ones are ignored.
+
+    Returns
+    -------
+    [list] Disruptions the trip opened, added to or closed, as dicts of the
+    disruptions table's columns (closed ones have an 'ended_ts').
+
+    Parameters
+    ----------
+    route: [dict] Output of new_route(), as kept for the trip's route.
+
+    week_hour: [int] sketches.hour_of_week() of the departure.
+
+    departure_ts: [int] Unix departure time.
+
+    duration: [int] Trip duration in minutes.
+
+    signature: [str] etl.encode_signature() of the trip's lines, '' if it
+    has none, or None if they aren't known. Such trips are only scored for
+    slow service, never counted towards a detour.
+    """
+    if route['last_ts'] is not None and departure_ts <= route['last_ts']:
+        return []
+    if route['last_ts'] is None or departure_ts - route['last_ts'] > max_gap:
+        route['score'] = 0.0
+    route['last_ts'] = departure_ts
+
+    key = str(week_hour)
+    baseline = route['baselines'].get(key)
+    z = None if baseline is None else score_trip(baseline, duration)
+    expected = None if baseline is None else round(baseline[0], 1)
+    route['baselines'][key] = update_baseline(baseline, duration)
+
+    changed = []
+
+    if z is not None:
+        route['score'] += score_alpha * (z - route['score'])
+        score = round(route['score'], 2)
+        slow = route['open'].get('slow')
+        if slow is None:
+            if score >= enter_score and duration - expected >= min_delay:
+                slow = open_disruption(route, 'slow', departure_ts, duration, expected,
+                                       score, signature or '')
+        elif score < exit_score:
+            slow['ended_ts'] = departure_ts
+            del route['open']['slow']
+            changed.append(slow)
+            slow = None
+        if slow is not None:
+            add_trip(slow, departure_ts, duration, expected, score)
+            changed.append(slow)
+
+    if signature:
+        lines = sorted(set(signature.split('>')))
+        rare = rare_lines(route, lines)
+        count_lines(route, lines)
+        if rare:
+            if not route['rare_trips']:
+                route['rare_since'] = departure_ts
+            route['rare_trips'] += 1
+        else:
+            route['rare_trips'] = 0
+
+        detour = route['open'].get('detour')
+        if detour is None:
+            if route['rare_trips'] >= min_run:
+                detour = open_disruption(route, 'detour', route['rare_since'], duration,
+                                         expected, z or 0.0, signature)
+                detour['lines'] = rare
+                detour['num_trips'] = min_run - 1
+        elif not set(lines) & set(detour['lines']):
+            detour['ended_ts'] = departure_ts
+            del route['open']['detour']
+            changed.append(detour)
+            detour = None
+        if detour is not None:
+            add_trip(detour, departure_ts, duration, expected, z)
+            changed.append(detour)
+
+    return changed
@@ -8,22 +8,25 @@ Author M. Sanchez-Ayala (04/13/2020)
 import logging
 import os
 import json
+import sys
 from google.cloud import storage
 from config import *
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
 
-def establish_directories():
+
+def establish_directories(sub_dirs = ('A', 'B')):
     """
     Checks if the necessary data-storing directories exist. If not, creates them
     within the current directory.
+
+    Parameters
+    ----------
+    sub_dirs: [list] One subdirectory of data per route.
     """
-    if not os.path.exists('data'):
-        os.mkdir('data')
-        os.mkdir('data/A')
-        os.mkdir('data/B')
-    elif (not os.path.exists('data/A')) or (not os.path.exists('data/B')):
-        os.mkdir('data/A')
-        os.mkdir('data/B')
+    for sub_dir in sub_dirs:
+        os.makedirs(os.path.join('data', sub_dir), exist_ok = True)
 
 
 def get_blobs(bucket):
@@ -70,8 +73,11 @@ def download_blobs(blobs, folder):
     for i, blob in enumerate(blobs, 1):
         # logging.info('File: {}'.format(blob.name))
         destination_uri = '{}/{}'.format(folder, blob.name)
-        with open(destination_uri, "wb") as file_obj:
-            blob.download_to_file(file_obj, raw_download=True)
+        with metrics.timer('storage_download'):
+            with open(destination_uri, "wb") as file_obj:
+                blob.download_to_file(file_obj, raw_download=True)
+        metrics.inc('storage_blobs_total')
+        metrics.inc('storage_bytes_total', blob.size or 0)
         # logging.info('Exported {} to {}'.format(
         #    blob.name, destination_uri)
         # )
@@ -104,6 +110,8 @@ def main(bucket, folder):
     # Download to this directory
     download_blobs(blobs, folder)
 
+    metrics.write_summary('download_storage')
+
 
 if __name__ == '__main__':
     main(config.bucket, config.folder)
@@ -2,13 +2,24 @@
 This module calls the Google Maps API, parses information, and stores into
 google_maps.trips MySQL db.
 """
+import argparse
 from datetime import datetime
 import os
 import json
 import glob
 import psycopg2
+import subprocess
+import sys
 import time
+import uuid
 from sql_queries import *
+import dedup
+import disruptions
+import validation
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+import metrics
+from sketches import DDSketch, hour_of_week
 
 
 def extract_json(filepath):
@@ -81,7 +92,47 @@ def transform_location(data):
     )
 
 
-def transform_trip(data):
+def transform_end_location(data):
+    """
+    Returns
+    -------
+    Tuple of values to be inserted into locations table for the trip's
+    destination, or None for trips collected before destinations were
+    recorded.
+
+    Parameters
+    ----------
+    data: a dictionary representing the parsed JSON data file with trip info.
+    """
+    if 'end_location_id' not in data:
+        return None
+
+    return (
+        data['end_location_id'],
+        data['end_location']['lat'],
+        data['end_location']['lng']
+    )
+
+
+def transform_route(data):
+    """
+    Returns
+    -------
+    Tuple of the route code and travel mode of the trip. Trips collected
+    before routes existed were all by transit, with one route per starting
+    location, named after it.
+
+    Parameters
+    ----------
+    data: a dictionary representing the parsed JSON data file with trip info.
+    """
+    return (
+        data.get('route_id', data['start_location_id']),
+        data.get('mode', 'transit')
+    )
+
+
+def transform_trip(data, route_id, location_id, signature_id):
     """
     Returns
     -------
@@ -90,16 +141,165 @@ def transform_trip(data):
     Parameters
     ----------
     data: a dictionary representing the parsed JSON data file with trip info.
+
+    route_id: [int] id of this trip's route in routes.
+
+    location_id: [int] id of this trip's start location in locations.
+
+    signature_id: [int] id of this trip's route signature in route_signatures,
+    None if its lines aren't known.
     """
     return (
         data['departure_time'],
-        data['start_location_id'],
+        route_id,
+        location_id,
         data['duration'],
-        len(data['steps'])
+        len(data['steps']),
+        signature_id
     )
 
 
-def transform_steps(data):
+def transform_signature(data):
+    """
+    Returns
+    -------
+    Tuple of line names in the order they are ridden, e.g. ('L', 'G', 'E').
+    This is the route signature of the trip. None for Distance Matrix trips,
+    which have no steps although they may well ride some lines.
+
+    Parameters
+    ----------
+    data: a dictionary representing the parsed JSON data file with trip info.
+    """
+    if data.get('source') == 'distance_matrix':
+        return None
+    steps = sorted(data['steps'], key=lambda step: step['step'])
+    return tuple(step['line_name'] for step in steps)
+
+
+def encode_signature(signature):
+    """
+    Returns
+    -------
+    [str] The signature as stored in route_signatures, e.g. 'L>G>E'.
+    """
+    return '>'.join(signature)
+
+
+# Natural key -> integer id for every location, route and signature seen in
+# this process, so each distinct value costs at most one round trip to the
+# database.
+location_ids = {}
+route_ids = {}
+signature_ids = {}
+
+
+def get_dimension_id(cur, cache, key, insert_query, insert_data, select_query):
+    """
+    Returns
+    -------
+    [int] The integer id of `key` in a dimension table, inserting the row if
+    it is new. `insert_query` must use ON CONFLICT DO NOTHING RETURNING id,
+    and `select_query` looks up the id of an existing row by `key`.
+
+    Parameters
+    ----------
+    cur: cursor
+
+    cache: [dict] Ids already looked up in this process.
+
+    key: Natural key of the row, as passed to `select_query`.
+
+    insert_data: [tuple] Values for `insert_query`.
+    """
+    if key in cache:
+        return cache[key]
+
+    cur.execute(insert_query, insert_data)
+    row = cur.fetchone()
+    if row is None:
+        # Already stored by an earlier run
+        cur.execute(select_query, (key,))
+        row = cur.fetchone()
+
+    cache[key] = row[0]
+    return row[0]
+
+
+def get_location_id(cur, location_data):
+    """
+    Returns
+    -------
+    [int] The id of the location in locations, inserting it if it is new.
+
+    Parameters
+    ----------
+    cur: cursor
+
+    location_data: [tuple] Output of transform_location().
+    """
+    return get_dimension_id(
+        cur, location_ids, location_data[0],
+        locations_table_insert, location_data, location_select
+    )
+
+
+def get_route_id(cur, route_data, origin_id, destination_id):
+    """
+    Returns
+    -------
+    [int] The id of the route in routes, inserting it and creating its trips
+    and steps partitions if it is new.
+
+    Parameters
+    ----------
+    cur: cursor
+
+    route_data: [tuple] Output of transform_route().
+
+    origin_id, destination_id: [int] ids of the route's ends in locations.
+    destination_id is None if unknown.
+    """
+    route_code, mode = route_data
+    is_new = route_code not in route_ids
+
+    route_id = get_dimension_id(
+        cur, route_ids, route_code,
+        routes_table_insert, (route_code, origin_id, destination_id, mode),
+        route_select
+    )
+
+    if is_new:
+        cur.execute(trips_partition_create.format(route_id))
+        cur.execute(steps_partition_create.format(route_id))
+
+    return route_id
+
+
+def get_signature_id(cur, signature):
+    """
+    Returns
+    -------
+    [int] The id of `signature` in route_signatures, inserting it if it is
+    new, or None if `signature` is None.
+
+    Parameters
+    ----------
+    cur: cursor
+
+    signature: [tuple] Output of transform_signature().
+    """
+    if signature is None:
+        return None
+    encoded = encode_signature(signature)
+    return get_dimension_id(
+        cur, signature_ids, encoded,
+        route_signatures_table_insert, (encoded, len(signature)),
+        route_signature_select
+    )
+
+
+def transform_steps(data, route_id):
     """
     Returns
     -------
@@ -108,13 +308,15 @@ def transform_steps(data):
     Parameters
     ----------
     data: a dictionary representing the parsed JSON data file with trip info.
+
+    route_id: [int] id of this trip's route in routes.
     """
     steps = data['steps']
 
     return [
         (
             data['departure_time'],
-            data['start_location_id'],
+            route_id,
             step['step'],
             step['line_name']
         )
@@ -122,28 +324,237 @@ def transform_steps(data):
     ]
 
 
+# (route_id, hour_of_week) -> DDSketch of the durations loaded in this
+# run. Merged into duration_sketches by save_sketches() at the end.
+pending_sketches = {}
+
+
+def add_to_sketch(route_id, time_data, duration):
+    """
+    Adds one trip's duration to the sketch for its route and hour of the
+    week.
+
+    Parameters
+    ----------
+    route_id: [int] id of the trip's route.
+
+    time_data: [tuple] Output of transform_time().
+
+    duration: [int] Trip duration in minutes.
+    """
+    hour, day = time_data[2], time_data[3]
+    key = (route_id, hour_of_week(day, hour))
+    if key not in pending_sketches:
+        pending_sketches[key] = DDSketch()
+    pending_sketches[key].add(duration)
+
+
+def save_sketches(conn):
+    """
+    Merges this run's sketches into the duration_sketches table, in one
+    transaction. Existing sketches are combined with the new ones rather
+    than recomputed, so earlier loads never need to be rescanned.
+    """
+    cur = conn.cursor()
+    conn.set_session(autocommit = False)
+    with conn:
+        for (route_id, week_hour), sketch in pending_sketches.items():
+            cur.execute(duration_sketch_select, (route_id, week_hour))
+            row = cur.fetchone()
+            if row is not None:
+                sketch.merge(DDSketch.from_dict(row[0]))
+            cur.execute(
+                duration_sketches_table_upsert,
+                (route_id, week_hour, sketch.count, json.dumps(sketch.to_dict()))
+            )
+    conn.set_session(autocommit = True)
+
+    pending_sketches.clear()
+
+
+# route_id -> disruptions.new_route() state of each route loaded in this
+# run, read from disruption_baselines when the route is first seen, and the
+# disruptions it flagged or updated, by (route_id, kind, started_ts). Both
+# are written by save_disruptions().
+detectors = {}
+pending_disruptions = {}
+
+
+def read_detector(cur, route_id):
+    """
+    Returns
+    -------
+    [dict] The detector state of a route as last saved to
+    disruption_baselines, or a new one if it has none.
+    """
+    cur.execute(disruption_baseline_select, (route_id,))
+    row = cur.fetchone()
+    return disruptions.new_route() if row is None else row[0]
+
+
+def detect_disruptions(cur, route_id, time_data, duration, signature):
+    """
+    Runs one trip through the disruption detector of its route (see
+    disruptions.py).
+
+    Parameters
+    ----------
+    cur: cursor
+
+    route_id: [int] id of the trip's route.
+
+    time_data: [tuple] Output of transform_time().
+
+    duration: [int] Trip duration in minutes.
+
+    signature: [tuple] Output of transform_signature().
+    """
+    if route_id not in detectors:
+        detectors[route_id] = read_detector(cur, route_id)
+    observe_disruptions(route_id, time_data, duration, signature)
+
+
+def observe_disruptions(route_id, time_data, duration, signature):
+    """
+    detect_disruptions() for a route whose detector is already in
+    `detectors`.
+    """
+    departure_ts, hour, day = time_data[0], time_data[2], time_data[3]
+    for disruption in disruptions.observe(
+        detectors[route_id], hour_of_week(day, hour), departure_ts, duration,
+        None if signature is None else encode_signature(signature)
+    ):
+        key = (route_id, disruption['kind'], disruption['started_ts'])
+        pending_disruptions[key] = disruption
+
+
+def save_disruptions(cur):
+    """
+    Writes the state of this run's detectors to disruption_baselines and
+    the disruptions they flagged to disruptions, in the caller's
+    transaction.
+    """
+    for route_id, state in detectors.items():
+        cur.execute(disruption_baselines_table_upsert, (route_id, json.dumps(state)))
+    for (route_id, kind, started_ts), disruption in pending_disruptions.items():
+        cur.execute(disruptions_table_upsert, (
+            route_id,
+            kind,
+            started_ts,
+            disruption['ended_ts'],
+            disruption['num_trips'],
+            disruption['peak_ts'],
+            disruption['peak_score'],
+            disruption['duration'],
+            disruption['expected'],
+            disruption['signature']
+        ))
+    pending_disruptions.clear()
+
+
+def refresh_departure_slots(conn):
+    """
+    Rebuilds departure_slots from every trip loaded so far, in one
+    transaction so the app never reads a half-built table.
+    """
+    cur = conn.cursor()
+    conn.set_session(autocommit = False)
+    with conn:
+        cur.execute(departure_slots_delete)
+        cur.execute(departure_slots_refresh)
+    conn.set_session(autocommit = True)
+
+
 def load_data(filepath, cur):
     """
     Loads `data` into all four tables in postgres.
 
+    A file holding a run of repeated trips (see dedup.py) is loaded as one
+    trip per repeat, each with its own trips, time and steps rows, as if it
+    had been collected to a file of its own.
+
+    Nothing is added to this run's sketches or detectors yet: the caller
+    passes the result to apply_staged() once the trips are committed, so a
+    file that is rolled back leaves no trace of them.
+
+    Raises validation.ValidationError if the record doesn't match the trip
+    schema, before anything is loaded.
+
+    Returns
+    -------
+    [dict] The file's trips staged for apply_staged(): its route_id, the
+    route's detector state if this run hasn't seen the route yet, the time
+    row and duration of each trip, and its signature.
+
     Parameters
     ----------
     filepath: [str] The filepath to the JSON file to load.
 
     cur: cursor
     """
-    data = extract_json(filepath)
-
-    trips_data = transform_trip(data)
-    location_data = transform_location(data)
-    time_data = transform_time(data)
-    steps_data = transform_steps(data)
-
-    cur.execute(trips_table_insert, trips_data)
-    cur.execute(locations_table_insert, location_data)
-    cur.execute(time_table_insert, time_data)
-    for step in steps_data:
-        cur.execute(steps_table_insert, step)
+    with metrics.stage('extract'):
+        data = extract_json(filepath)
+
+    with metrics.stage('transform'):
+        reason = validation.validate_trip(data)
+        if reason is not None:
+            raise validation.ValidationError(reason)
+        trips = dedup.expand(data)
+        signature = transform_signature(data)
+        location_data = transform_location(data)
+        end_location_data = transform_end_location(data)
+        route_data = transform_route(data)
+        time_data = [transform_time(trip) for trip in trips]
+
+    with metrics.stage('load'):
+        # Dimensions first so trips and steps can reference their ids
+        with metrics.timer('etl_load', table='locations'):
+            location_id = get_location_id(cur, location_data)
+            if end_location_data is None:
+                end_location_id = None
+            else:
+                end_location_id = get_location_id(cur, end_location_data)
+        with metrics.timer('etl_load', table='routes'):
+            route_id = get_route_id(cur, route_data, location_id, end_location_id)
+        with metrics.timer('etl_load', table='route_signatures'):
+            signature_id = get_signature_id(cur, signature)
+        trips_data = [
+            transform_trip(trip, route_id, location_id, signature_id) for trip in trips
+        ]
+        steps_data = [step for trip in trips for step in transform_steps(trip, route_id)]
+        with metrics.timer('etl_load', table='trips'):
+            for trip in trips_data:
+                cur.execute(trips_table_insert, trip)
+        with metrics.timer('etl_load', table='time'):
+            for time_row in time_data:
+                cur.execute(time_table_insert, time_row)
+        with metrics.timer('etl_load', table='steps'):
+            for step in steps_data:
+                cur.execute(steps_table_insert, step)
+
+    metrics.inc('etl_rows_total', 2 * len(trips) + 1 + len(steps_data))
+    if len(trips) > 1:
+        metrics.inc('etl_repeats_total', len(trips) - 1)
+
+    return {
+        'route_id': route_id,
+        'detector': None if route_id in detectors else read_detector(cur, route_id),
+        'trips': [(time_row, trip['duration']) for trip, time_row in zip(trips, time_data)],
+        'signature': signature,
+    }
+
+
+def apply_staged(staged):
+    """
+    Adds the trips of a committed file, as staged by load_data(), to this
+    run's sketches and runs them through their route's disruption detector.
+    """
+    route_id = staged['route_id']
+    if route_id not in detectors:
+        detectors[route_id] = staged['detector']
+    for time_row, duration in staged['trips']:
+        add_to_sketch(route_id, time_row, duration)
+        observe_disruptions(route_id, time_row, duration, staged['signature'])
 
 
 def process_data(cur, conn, filepath):
@@ -156,7 +567,12 @@ def process_data(cur, conn, filepath):
 
     filepath: string containing the filepath to the data directory.
 
-    func: function that performs ETL on the given set of files.
+    Files that can't be loaded are skipped, copied to the dead letter
+    folder with the reason (see validation.py) and summarized at the end.
+
+    Returns
+    -------
+    Tuple of the number of files and the number of trips loaded.
     """
     # get all files matching extension from directory
     all_files = []
@@ -164,27 +580,202 @@ def process_data(cur, conn, filepath):
         files = glob.glob(os.path.join(root,'*.json'))
         for f in files :
             all_files.append(os.path.abspath(f))
+    # Files are named after their departure, so this loads each route's
+    # trips in order, as the disruption detector needs
+    all_files.sort()
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
-    # iterate over files and perform ETL
+    # iterate over files and perform ETL, each file in its own transaction
+    # so one that fails is rolled back whole and the rest still load
+    num_loaded = 0
+    num_trips = 0
+    rejects = []
+    dead_letter = validation.run_folder(datetime.now())
+    conn.set_session(autocommit = False)
     for i, datafile in enumerate(all_files, 1):
+        stage = None
+        try:
+            staged = load_data(datafile, cur)
+            conn.commit()
+            apply_staged(staged)
+            num_trips += len(staged['trips'])
+            num_loaded += 1
+            metrics.inc('etl_files_total', status='loaded')
+        except (json.decoder.JSONDecodeError, UnicodeDecodeError) as e:
+            stage, reason = 'json', str(e)
+        except validation.ValidationError as e:
+            stage, reason = 'schema', str(e)
+        except psycopg2.Error as e:
+            if conn.closed:
+                raise
+            stage, reason = 'database', str(e).strip()
+        except (KeyError, TypeError, ValueError) as e:
+            stage, reason = 'transform', '{}: {}'.format(type(e).__name__, e)
+
+        if stage is not None:
+            conn.rollback()
+            # Ids cached during the rolled back transaction may not exist.
+            # The file's trips were never applied to sketches or detectors.
+            for cache in [location_ids, route_ids, signature_ids]:
+                cache.clear()
+            rejects.append(validation.quarantine(datafile, stage, reason, dead_letter))
+            metrics.inc('etl_files_total', status='rejected')
+            metrics.inc('etl_rejects_total', stage=stage)
+
+        # Only display progress every 50 files
+        if (not i % 50) or (i == num_files):
+            print('{}/{} files processed.'.format(i, num_files))
+
+    with metrics.timer('etl_load', table='disruptions'):
+        save_disruptions(cur)
+        conn.commit()
+    conn.set_session(autocommit = True)
+
+    validation.summarize(rejects, num_files, dead_letter)
+
+    cur.execute(legacy_routes_backfill)
+
+    with metrics.timer('etl_load', table='duration_sketches'):
+        save_sketches(conn)
+    with metrics.timer('etl_load', table='departure_slots'):
+        refresh_departure_slots(conn)
+
+    return num_loaded, num_trips
+
+
+def record_load(cur, num_loaded):
+    """
+    Records a completed load in the loads table.
+
+    Returns
+    -------
+    [str] The load's unique token. Snapshots built from this load carry the
+    same token, which is how the app knows they are up to date.
+    """
+    load_token = str(uuid.uuid4())
+    cur.execute(loads_table_insert, (load_token, num_loaded))
+    return load_token
+
+
+def build_snapshot():
+    """
+    Runs src/app/build_snapshot.py so the app can cold start from the data
+    just loaded. It runs in its own process because it needs the app's
+    modules, pandas and plotly, none of which the ETL otherwise imports.
+    """
+    script = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'app', 'build_snapshot.py'
+    )
+    result = subprocess.run([sys.executable, script])
+    if result.returncode != 0:
+        print('WARNING: Could not build the app snapshot; the app will read '
+              'from the database instead')
+
+
+def count_live_trips(cur):
+    """
+    Returns
+    -------
+    [int] Number of trips currently being served, or None if nothing has
+    been loaded yet.
+    """
+    for schema in [live_schema, 'public']:
+        cur.execute(schema_exists_select, (schema,))
+        if cur.fetchone() is None:
+            continue
         try:
-            load_data(datafile, cur)
-            # Only display progress every 50 files
-            if (not i % 50) or (i == num_files):
-                print('{}/{} files processed.'.format(i, num_files))
-        except json.decoder.JSONDecodeError as e:
-            print(e)
-            print(datafile)
+            cur.execute(live_trips_count_select.format(schema))
+            return cur.fetchone()[0]
+        except psycopg2.errors.UndefinedTable:
+            continue
+    return None
 
 
-def main():
+def validate_reload(cur, num_trips, live_trips, min_ratio):
+    """
+    Checks the row counts of the freshly loaded shadow schema before it is
+    swapped in.
+
+    Returns
+    -------
+    [list] Reasons the reload is not safe to swap in. Empty if it is.
+
+    Parameters
+    ----------
+    cur: cursor whose search_path points at the shadow schema.
+
+    num_trips: [int] Number of trips process_data() loaded.
+
+    live_trips: [int] Trips in the live schema, or None if there is none.
+
+    min_ratio: [float] Smallest acceptable ratio of new to live trips.
+    """
+    cur.execute(row_counts_select)
+    columns = [column[0] for column in cur.description]
+    counts = dict(zip(columns, cur.fetchone()))
+    print('Shadow schema row counts: {}'.format(counts))
+
+    problems = []
+    if counts['trips'] != num_trips:
+        problems.append('{} trips for {} loaded'.format(counts['trips'], num_trips))
+    for table in ['trips', 'time', 'locations', 'routes', 'route_signatures']:
+        if counts[table] == 0:
+            problems.append('{} is empty'.format(table))
+    if live_trips and counts['trips'] < live_trips * min_ratio:
+        problems.append('{} trips is less than {:.0%} of the {} being served'.format(
+            counts['trips'], min_ratio, live_trips
+        ))
+
+    return problems
+
+
+def swap_schema(conn):
+    """
+    Atomically replaces the live schema with the shadow schema and drops the
+    old one. Queries already running finish against the old tables; every
+    query after the commit sees the new ones.
+
+    On the first swap the data being served is in the public schema, so its
+    tables and views are retired instead, leaving public to extensions.
+    """
+    cur = conn.cursor()
+
+    cur.execute(schema_exists_select, (live_schema,))
+    has_live = cur.fetchone() is not None
+
+    conn.set_session(autocommit = False)
+    with conn:
+        cur.execute(schema_drop.format(retired_schema))
+        if has_live:
+            cur.execute(schema_rename.format(live_schema, retired_schema))
+        else:
+            cur.execute(schema_create.format(retired_schema))
+            cur.execute(public_relations_select)
+            for name, kind in cur.fetchall():
+                cur.execute(relation_move.format(kind, name, retired_schema))
+        cur.execute(schema_rename.format(shadow_schema, live_schema))
+        # New connections resolve trips_time etc. in the live schema only
+        cur.execute(database_search_path_set.format(live_schema))
+    conn.set_session(autocommit = True)
+
+    cur.execute(schema_drop.format(retired_schema))
+
+
+def main(blue_green = False, min_ratio = 0.9, snapshot = True):
     """
     Connects to google_maps db, performs ETL on directions JSON files and then
     closes the connection to the database.
+
+    With `blue_green`, the files are loaded into the shadow schema made by
+    `create_tables.py --blue-green`. The live schema keeps serving until the
+    load is validated, and is then swapped out in one transaction. A failed
+    or suspicious load leaves the live data untouched.
+
+    With `snapshot`, a snapshot for the app's fast cold start is built at
+    the end of the load.
     """
     conn = psycopg2.connect(
         host = '127.0.0.1',
@@ -195,10 +786,47 @@ def main():
     conn.set_session(autocommit = True)
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data')
+    if blue_green:
+        live_trips = count_live_trips(cur)
+        cur.execute(search_path_set.format(shadow_schema))
+
+    num_loaded, num_trips = process_data(cur, conn, filepath='data')
+    record_load(cur, num_loaded)
+
+    if blue_green:
+        problems = validate_reload(cur, num_trips, live_trips, min_ratio)
+        if problems:
+            print('Not swapping in the new load: ' + '; '.join(problems))
+            conn.close()
+            sys.exit(1)
+        swap_schema(conn)
+        print('Swapped schema {} in as {}'.format(shadow_schema, live_schema))
 
     conn.close()
 
+    if snapshot:
+        build_snapshot()
+
+    # Write run metrics to metrics/etl.{json,prom} and show the summary
+    run_summary = metrics.write_summary('etl')
+    print(json.dumps(run_summary, indent=2))
+
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description = 'Load trip JSON files into google_maps.')
+    parser.add_argument(
+        '--blue-green', action = 'store_true',
+        help = 'load into the shadow schema and swap it in once validated'
+    )
+    parser.add_argument(
+        '--min-ratio', type = float, default = 0.9,
+        help = 'refuse to swap if the new load has fewer trips than this '
+               'fraction of the live data'
+    )
+    parser.add_argument(
+        '--no-snapshot', action = 'store_true',
+        help = 'skip building the snapshot the app cold starts from'
+    )
+    args = parser.parse_args()
+
+    main(args.blue_green, args.min_ratio, not args.no_snapshot)
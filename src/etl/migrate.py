@@ -0,0 +1,204 @@
+"""
+This module migrates an existing google_maps database to the schema in
+sql_queries.py without dropping it. First the compact column types: SMALLINT
+calendar fields, DOUBLE PRECISION coordinates, and SMALLINT location/route
+signature keys in place of the padded CHAR(1) location id. Databases loaded
+before route signatures existed have them backfilled from steps. Then
+routes: one per starting location, as etl.py loads trips collected before
+routes, with trips and steps rebuilt partitioned by route, and the
+duration sketches and departure slots built from the trips already loaded.
+Then trips are allowed a NULL signature, which Distance Matrix trips are
+now loaded with, and tables added since are created.
+
+All schema changes run in one transaction, so a failure leaves the database
+as it was. The on-disk size of every table is reported before and after.
+
+Usage:
+    python src/etl/migrate.py [--no-vacuum]
+"""
+
+import argparse
+import psycopg2
+import etl
+from sql_queries import (
+    compact_types_migration, migrated_check, routes_migration, routes_backfill, routes_check,
+    signature_nullable_migration, signature_nullable_check, route_ids_select,
+    trips_partition_create, steps_partition_create, create_table_queries, trips_time_create,
+    trip_durations_select, table_sizes_select
+)
+
+
+def table_sizes(cur):
+    """
+    Returns
+    -------
+    Dict of table name to total on-disk size in bytes, including indexes and
+    TOAST. Partitioned tables include their partitions.
+    """
+    cur.execute(table_sizes_select)
+    return dict(cur.fetchall())
+
+
+def print_sizes(before, after):
+    """
+    Prints the size of every table before and after the migration, then
+    the size of trips and steps, which hold a row per trip and step, and of
+    all the tables there were before. Tables the migration added are listed
+    last and left out of both.
+    """
+    row = '{:<20}{:>12}{:>12}'
+    print(row.format('table', 'before', 'after'))
+    for table in sorted(before):
+        print(row.format(table, format_bytes(before[table]), format_bytes(after.get(table, 0))))
+    for table in sorted(set(after) - set(before)):
+        print(row.format(table, '-', format_bytes(after[table])))
+
+    for name, tables in [('trips + steps', ['trips', 'steps']), ('existing tables', before)]:
+        print(row.format(
+            name,
+            format_bytes(sum(before.get(table, 0) for table in tables)),
+            format_bytes(sum(after.get(table, 0) for table in tables))
+        ))
+
+
+def format_bytes(num_bytes):
+    """
+    Returns
+    -------
+    [str] `num_bytes` in human readable units, e.g. '1.5 MB'.
+    """
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return '{:.1f} {}'.format(num_bytes, unit)
+        num_bytes /= 1024
+    return '{:.1f} TB'.format(num_bytes)
+
+
+def migrate(conn):
+    """
+    Runs compact_types_migration if the database doesn't have the compact
+    types yet, then routes_migration if it has no routes, then lets trips
+    without a known signature be loaded, in a single transaction.
+
+    Returns
+    -------
+    [list] Names of the stages run: 'compact', 'routes' and 'signatures',
+    empty if the database was already migrated.
+    """
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute(migrated_check)
+            compact = cur.fetchone() is not None
+            cur.execute(routes_check)
+            has_routes = cur.fetchone() is not None
+            cur.execute(signature_nullable_check)
+            signature_nullable = cur.fetchone() is not None
+            if compact and has_routes and signature_nullable:
+                return []
+
+            stages = []
+            if not compact:
+                stages.append('compact')
+                for query in compact_types_migration:
+                    cur.execute(query)
+
+            if not has_routes:
+                stages.append('routes')
+                for query in routes_migration:
+                    cur.execute(query)
+                cur.execute(route_ids_select)
+                for (route_id,) in cur.fetchall():
+                    cur.execute(trips_partition_create.format(route_id))
+                    cur.execute(steps_partition_create.format(route_id))
+                for query in routes_backfill:
+                    cur.execute(query)
+
+            # A no-op for trips just rebuilt by routes_migration
+            if not signature_nullable:
+                stages.append('signatures')
+                cur.execute(signature_nullable_migration)
+
+            # Tables added since, e.g. loads and duration_sketches
+            for query in create_table_queries:
+                cur.execute(query)
+            cur.execute(trips_time_create)
+
+    return stages
+
+
+def backfill_summaries(conn):
+    """
+    Builds duration_sketches and departure_slots from every trip, as
+    etl.py would have loading them. Disruptions are only flagged from the
+    trips loaded next.
+    """
+    # Streamed from a server-side cursor, however many trips there are
+    with conn:
+        with conn.cursor('trip_durations') as cur:
+            cur.execute(trip_durations_select)
+            for row in cur:
+                etl.add_to_sketch(row[0], row[2:], row[1])
+    etl.save_sketches(conn)
+    etl.refresh_departure_slots(conn)
+
+
+def vacuum(conn, tables):
+    """
+    Rewrites `tables` to reclaim the space left behind by dropped columns and
+    updated rows. Takes an exclusive lock on each table while it runs.
+    """
+    conn.set_session(autocommit = True)
+    cur = conn.cursor()
+    for table in tables:
+        cur.execute('VACUUM FULL ANALYZE {}'.format(table))
+    conn.set_session(autocommit = False)
+
+
+def main():
+    """
+    Connects to google_maps, migrates it to the current schema and reports
+    table sizes before and after.
+    """
+    parser = argparse.ArgumentParser(
+        description='Migrate google_maps to the current schema in place.'
+    )
+    parser.add_argument('--no-vacuum', action='store_true',
+                        help='skip VACUUM FULL; sizes will not shrink until '
+                             'autovacuum and later writes reuse the space')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(
+        host = '127.0.0.1',
+        dbname = 'google_maps',
+        user = 'google_user',
+        password = 'passw0rd',
+    )
+
+    cur = conn.cursor()
+    before = table_sizes(cur)
+    conn.commit()
+
+    stages = migrate(conn)
+    if not stages:
+        print('google_maps already uses the current schema.')
+        conn.close()
+        return
+
+    # Sketches are merged into, so only built along with the trips' routes
+    if 'routes' in stages:
+        backfill_summaries(conn)
+
+    if stages != ['signatures'] and not args.no_vacuum:
+        vacuum(conn, ['time', 'locations', 'route_signatures', 'routes', 'trips', 'steps'])
+
+    cur = conn.cursor()
+    after = table_sizes(cur)
+    conn.commit()
+
+    print_sizes(before, after)
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+"""
+This module regenerates the parsed trip JSON files in data/ from the raw
+responses in archive/ (see archive.py), re-running parse_directions() on
+every archived response in a date range. Run it after changing what
+parse_directions() or parse_steps() extract, then reload with etl.py.
+
+Each archive file is one starting location on one day, so files are spread
+over a pool of worker processes, one per core by default.
+
+Usage:
+    python src/etl/reprocess.py --start 2020-04-13 --end 2020-04-20
+    python src/etl/reprocess.py --workers 4 --output data
+"""
+
+import argparse
+from multiprocessing import Pool
+import os
+import sys
+import time
+import archive
+from data_collection import parse_directions, to_json
+
+
+# Set in each worker process by init_worker()
+dictionaries = None
+output_folder = None
+
+
+def init_worker(archive_folder, output):
+    """
+    Loads the archive's dictionaries once per worker process.
+    """
+    global dictionaries, output_folder
+    dictionaries = archive.load_dictionaries(archive_folder)
+    output_folder = output
+
+
+def reprocess_file(path):
+    """
+    Parses every response archived in `path` and writes each trip to the
+    output folder.
+
+    Returns
+    -------
+    Tuple of the number of trips written and the number of responses that
+    could not be parsed.
+    """
+    num_written = 0
+    num_failed = 0
+    for record in archive.read_archive(path, dictionaries):
+        try:
+            trip_directions = parse_directions(
+                record['response'], record['start_location_id']
+            )
+            trip_directions.update(record.get('route', {}))
+        except (KeyError, IndexError, TypeError) as e:
+            print('Could not parse a response in {}: {!r}'.format(path, e))
+            num_failed += 1
+            continue
+        to_json(trip_directions, output_folder)
+        num_written += 1
+    return num_written, num_failed
+
+
+def reprocess(archive_folder = archive.archive_folder, output = 'data',
+              start_date = None, end_date = None, workers = None):
+    """
+    Re-parses every archived response between `start_date` and `end_date`
+    (inclusive 'YYYY-MM-DD' strings, None for unbounded) into `output`,
+    overwriting trips that were already there.
+
+    Returns
+    -------
+    Tuple of the number of trips written and the number that failed.
+    """
+    paths = archive.archive_files(archive_folder, start_date, end_date)
+    print('{} archive files found in {}'.format(len(paths), archive_folder))
+
+    for path in paths:
+        route_id = os.path.basename(os.path.dirname(path))
+        os.makedirs(os.path.join(output, route_id), exist_ok = True)
+
+    with Pool(workers, initializer = init_worker, initargs = (archive_folder, output)) as pool:
+        results = pool.map(reprocess_file, paths, chunksize = 1)
+
+    num_written = sum(written for written, failed in results)
+    num_failed = sum(failed for written, failed in results)
+    return num_written, num_failed
+
+
+def main():
+    """
+    Parses command line arguments and reprocesses the archive.
+    """
+    parser = argparse.ArgumentParser(
+        description = 'Regenerate trip JSON files from archived raw responses.'
+    )
+    parser.add_argument('--archive', default = archive.archive_folder)
+    parser.add_argument('--output', default = 'data')
+    parser.add_argument('--start', help = 'first day to reprocess, YYYY-MM-DD')
+    parser.add_argument('--end', help = 'last day to reprocess, YYYY-MM-DD')
+    parser.add_argument('--workers', type = int,
+                        help = 'number of processes; defaults to one per core')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    num_written, num_failed = reprocess(
+        args.archive, args.output, args.start, args.end, args.workers
+    )
+    print('{} trips written to {} in {:.1f}s, {} responses failed to parse'.format(
+        num_written, args.output, time.perf_counter() - start, num_failed
+    ))
+
+    if num_failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,432 @@
+"""
+This module decides which routes data_collection.py samples on each run, so
+API calls go where travel times actually move.
+
+For every route and hour of the day, separately for weekdays and weekends,
+it keeps an exponentially weighted mean and variance of the sampled
+durations, so recent days count most. Each day's budget of API calls is
+shared out over routes and hours in proportion to the standard deviation of
+duration there (Neyman allocation): a volatile rush hour is sampled up to
+every run, while a flat 3am hour is sampled as rarely as once an hour. Hours
+without enough samples yet are treated as volatile, so they are explored
+first. Once the day's budget is spent, nothing more is sampled until the
+next day.
+
+The state lives in scheduler.json in the working directory, since each cron
+run is a new process.
+
+Usage:
+    python src/etl/data_collection.py --adaptive --budget 400 --tick 5
+    python src/etl/scheduler.py --simulate data --budget 100 200 400
+
+The simulation replays the trips in `data/` as if they were the live API,
+and reports how well the adaptive schedule tracks them against sampling at
+a fixed interval for the same number of calls.
+"""
+
+import argparse
+from datetime import datetime
+import glob
+import json
+import os
+
+
+state_file = 'scheduler.json'
+
+# Weight of the newest sample in the moving mean and variance
+alpha = 0.2
+
+# Samples an hour needs before its variance is trusted
+min_samples = 4
+
+# Standard deviation, in minutes, assumed for hours with too few samples
+prior_std = 5.0
+
+# Floor on the standard deviation so quiet hours keep a minimum rate
+min_std = 0.5
+
+# Longest gap between samples of a route, in minutes
+max_interval = 60
+
+
+def new_state():
+    """
+    Returns
+    -------
+    [dict] Scheduler state with no history.
+    """
+    return {'routes': {}, 'day': None, 'calls_today': 0}
+
+
+def load_state(path = state_file):
+    """
+    Returns
+    -------
+    [dict] Scheduler state saved at `path`, or a new one if there is none.
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return new_state()
+
+
+def save_state(state, path = state_file):
+    """
+    Writes `state` to `path`, replacing the old file atomically.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def route_state(state, route_id):
+    """
+    Returns
+    -------
+    [dict] History of `route_id`: moving stats per time_bucket() and the
+    time of its last sample.
+    """
+    return state['routes'].setdefault(route_id, {'stats': {}, 'last_sample': None})
+
+
+def time_bucket(day, hour):
+    """
+    Returns
+    -------
+    [str] Key of the moving stats for one hour of a 'weekday' or 'weekend'
+    `day`, e.g. 'weekday-07'.
+    """
+    return '{}-{:02d}'.format(day, hour)
+
+
+def day_type(when):
+    """
+    Returns
+    -------
+    [str] 'weekend' for Saturday and Sunday, otherwise 'weekday'.
+    """
+    return 'weekend' if when.isoweekday() in [6, 7] else 'weekday'
+
+
+def count_call(state, when):
+    """
+    Counts one API call against the budget of the day of `when`.
+    """
+    day = when.strftime('%Y-%m-%d')
+    if state['day'] != day:
+        state['day'] = day
+        state['calls_today'] = 0
+    state['calls_today'] += 1
+
+
+def record_sample(state, route_id, when, duration):
+    """
+    Adds a sampled trip to the route's moving stats for its hour and counts
+    the call.
+
+    Parameters
+    ----------
+    state: [dict] Output of load_state().
+
+    route_id: [str] Route of the trip.
+
+    when: [datetime] Time the trip was requested.
+
+    duration: [int] Trip duration in minutes.
+    """
+    route = route_state(state, route_id)
+    key = time_bucket(day_type(when), when.hour)
+
+    if key not in route['stats']:
+        route['stats'][key] = [float(duration), 0.0, 1]
+    else:
+        mean, var, n = route['stats'][key]
+        diff = duration - mean
+        increment = alpha * diff
+        route['stats'][key] = [mean + increment, (1 - alpha) * (var + diff * increment), n + 1]
+
+    route['last_sample'] = when.timestamp()
+    count_call(state, when)
+
+
+def bucket_std(route, key):
+    """
+    Returns
+    -------
+    [float] Standard deviation of duration to plan with for the hour `key`
+    of `route`.
+    """
+    mean, var, n = route['stats'].get(key, [0.0, 0.0, 0])
+    if n < min_samples:
+        return prior_std
+    return max(var ** 0.5, min_std)
+
+
+def hourly_rates(state, route_ids, budget, tick, day):
+    """
+    Returns
+    -------
+    [dict] (route_id, hour) to planned samples per hour on a day of type
+    `day`, spending `budget` calls over the day in proportion to each hour's
+    standard deviation, and kept between one sample every `max_interval`
+    minutes and one every `tick` minutes.
+
+    Parameters
+    ----------
+    state: [dict] Output of load_state().
+
+    route_ids: [list] Routes being collected.
+
+    budget: [int] API calls allowed per day.
+
+    tick: [int] Minutes between runs of the collector.
+
+    day: [str] 'weekday' or 'weekend'.
+    """
+    min_rate = 60 / max_interval
+    max_rate = 60 / tick
+
+    weights = {
+        (route_id, hour): bucket_std(route_state(state, route_id), time_bucket(day, hour))
+        for route_id in route_ids for hour in range(24)
+    }
+
+    # Clip to the rate limits and share what clipping frees up among the rest
+    rates = {}
+    free = dict(weights)
+    remaining = budget
+    while free:
+        scale = remaining / sum(free.values())
+        clipped = {}
+        for key, weight in free.items():
+            rate = weight * scale
+            if rate < min_rate:
+                clipped[key] = min_rate
+            elif rate > max_rate:
+                clipped[key] = max_rate
+        if not clipped:
+            rates.update({key: weight * scale for key, weight in free.items()})
+            break
+        rates.update(clipped)
+        remaining = max(remaining - sum(clipped.values()), 0)
+        for key in clipped:
+            del free[key]
+
+    return rates
+
+
+def decide(state, route_ids, now, budget, tick):
+    """
+    Returns
+    -------
+    [list] One decision per route: a dict with route_id, sample (whether to
+    call the API for it now), interval (planned minutes between samples),
+    std (of duration at this hour, in minutes) and reason.
+
+    Parameters
+    ----------
+    state: [dict] Output of load_state().
+
+    route_ids: [list] Routes being collected.
+
+    now: [datetime] Time of this run.
+
+    budget: [int] API calls allowed per day.
+
+    tick: [int] Minutes between runs of the collector.
+    """
+    rates = hourly_rates(state, route_ids, budget, tick, day_type(now))
+    key = time_bucket(day_type(now), now.hour)
+    calls_today = state['calls_today'] if state['day'] == now.strftime('%Y-%m-%d') else 0
+
+    decisions = []
+    for route_id in route_ids:
+        route = route_state(state, route_id)
+        interval = 60 / rates[(route_id, now.hour)]
+        decision = {
+            'route_id': route_id,
+            'interval': interval,
+            'std': bucket_std(route, key),
+        }
+
+        if calls_today >= budget:
+            decision.update(sample = False, reason = 'daily budget of {} spent'.format(budget))
+        elif route['last_sample'] is None:
+            decision.update(sample = True, reason = 'never sampled')
+        else:
+            waited = (now.timestamp() - route['last_sample']) / 60
+            # Due if the next run would overshoot the interval by more than now
+            due = waited + tick / 2 >= interval
+            decision.update(
+                sample = due,
+                reason = '{:.0f} of {:.0f} minutes waited'.format(waited, interval)
+            )
+
+        if decision['sample']:
+            calls_today += 1
+        decisions.append(decision)
+
+    return decisions
+
+
+def log_decisions(decisions, now):
+    """
+    Prints one line per scheduling decision.
+    """
+    for decision in decisions:
+        print('{} scheduler: {} {} (every {:.0f} min, std {:.1f} min: {})'.format(
+            now.strftime('%Y-%m-%d %H:%M'),
+            'sample' if decision['sample'] else 'skip',
+            decision['route_id'],
+            decision['interval'],
+            decision['std'],
+            decision['reason']
+        ))
+
+
+### SIMULATION ###
+
+
+def load_history(folder, tick):
+    """
+    Returns
+    -------
+    [dict] route_id to {tick timestamp: duration} for every trip in `folder`,
+    with departure times rounded down to the tick.
+    """
+    history = {}
+    for path in glob.glob(os.path.join(folder, '*', '*.json')):
+        try:
+            with open(path, 'r') as f:
+                trip = json.load(f)
+        except json.decoder.JSONDecodeError:
+            continue
+        ts = trip['departure_time'] // (tick * 60) * (tick * 60)
+        route_id = trip.get('route_id', trip['start_location_id'])
+        history.setdefault(route_id, {}).setdefault(ts, trip['duration'])
+    return history
+
+
+def replay(history, tick, sample_due):
+    """
+    Replays `history` one tick at a time, sampling the routes `sample_due`
+    picks and estimating every other tick by the route's last sample.
+
+    Returns
+    -------
+    [dict] calls made, calls per day, mean absolute error in minutes, and
+    coverage: the share of ticks estimated within 2 minutes.
+
+    Parameters
+    ----------
+    history: [dict] Output of load_history().
+
+    tick: [int] Minutes between ticks.
+
+    sample_due: function(now, route_ids, tick_index) returning the routes to
+    sample at this tick, and told afterwards of each sample through its
+    `record` attribute, function(route_id, now, duration).
+    """
+    route_ids = sorted(history)
+    ticks = sorted(set(ts for route in history.values() for ts in route))
+
+    calls = 0
+    errors = []
+    last = {}
+    for i, ts in enumerate(ticks):
+        now = datetime.fromtimestamp(ts)
+        for route_id in sample_due(now, route_ids, i):
+            if ts in history[route_id]:
+                last[route_id] = history[route_id][ts]
+                sample_due.record(route_id, now, last[route_id])
+                calls += 1
+
+        for route_id in route_ids:
+            if ts in history[route_id] and route_id in last:
+                errors.append(abs(history[route_id][ts] - last[route_id]))
+
+    days = max((ticks[-1] - ticks[0]) / 86400, 1 / 24) if ticks else 1
+    return {
+        'calls': calls,
+        'calls_per_day': calls / days,
+        'mae': sum(errors) / len(errors) if errors else float('nan'),
+        'coverage': sum(error <= 2 for error in errors) / len(errors) if errors else 0,
+    }
+
+
+def adaptive_policy(budget, tick):
+    """
+    Returns
+    -------
+    A sample_due function for replay() driven by decide().
+    """
+    state = new_state()
+
+    def sample_due(now, route_ids, tick_index):
+        return [
+            decision['route_id']
+            for decision in decide(state, route_ids, now, budget, tick)
+            if decision['sample']
+        ]
+
+    sample_due.record = lambda route_id, now, duration: record_sample(state, route_id, now, duration)
+    return sample_due
+
+
+def fixed_policy(every):
+    """
+    Returns
+    -------
+    A sample_due function for replay() that samples every route once every
+    `every` ticks.
+    """
+    def sample_due(now, route_ids, tick_index):
+        return route_ids if tick_index % every == 0 else []
+
+    sample_due.record = lambda route_id, now, duration: None
+    return sample_due
+
+
+def simulate(folder, budgets, tick = 5):
+    """
+    Prints, for each daily budget, how the adaptive schedule compares with a
+    fixed interval that makes about as many calls, on the trips in `folder`.
+    """
+    history = load_history(folder, tick)
+    num_trips = sum(len(route) for route in history.values())
+    print('{} trips on {} routes in {}'.format(num_trips, len(history), folder))
+
+    full = replay(history, tick, fixed_policy(1))
+    print('{:<10}{:<16}{:>10}{:>12}{:>10}{:>10}'.format(
+        'budget', 'policy', 'calls', 'calls/day', 'mae', 'coverage'
+    ))
+    print('{:<10}{:<16}{:>10}{:>12.0f}{:>10.2f}{:>10.1%}'.format(
+        '-', 'every tick', full['calls'], full['calls_per_day'], full['mae'], full['coverage']
+    ))
+
+    for budget in budgets:
+        adaptive = replay(history, tick, adaptive_policy(budget, tick))
+        every = max(round(full['calls'] / max(adaptive['calls'], 1)), 1)
+        fixed = replay(history, tick, fixed_policy(every))
+        for name, result in [('adaptive', adaptive), ('every {} ticks'.format(every), fixed)]:
+            print('{:<10}{:<16}{:>10}{:>12.0f}{:>10.2f}{:>10.1%}'.format(
+                budget, name, result['calls'], result['calls_per_day'],
+                result['mae'], result['coverage']
+            ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description = 'Replay collected trips to compare sampling schedules.'
+    )
+    parser.add_argument('--simulate', default = 'data', metavar = 'FOLDER',
+                        help = 'folder of collected trips to replay')
+    parser.add_argument('--budget', type = int, nargs = '*', default = [100, 200, 300],
+                        help = 'daily API call budgets to try')
+    parser.add_argument('--tick', type = int, default = 5,
+                        help = 'minutes between collector runs in the data')
+    args = parser.parse_args()
+
+    simulate(args.simulate, args.budget, args.tick)
@@ -12,26 +12,51 @@ locations_table_drop = "DROP TABLE IF EXISTS locations"
 time_table_drop = "DROP TABLE IF EXISTS time"
 trips_table_drop = "DROP TABLE IF EXISTS trips"
 steps_table_drop = "DROP TABLE IF EXISTS steps"
+route_signatures_table_drop = "DROP TABLE IF EXISTS route_signatures"
+routes_table_drop = "DROP TABLE IF EXISTS routes"
+loads_table_drop = "DROP TABLE IF EXISTS loads"
+duration_sketches_table_drop = "DROP TABLE IF EXISTS duration_sketches"
+departure_slots_table_drop = "DROP TABLE IF EXISTS departure_slots"
+disruption_baselines_table_drop = "DROP TABLE IF EXISTS disruption_baselines"
+disruptions_table_drop = "DROP TABLE IF EXISTS disruptions"
 
 ### CREATE TABLES ###
 
+# trips and steps are partitioned by route, one partition per route created
+# by etl.py when it first sees the route, so queries for a few routes only
+# read those routes' partitions. signature_id is NULL for trips whose lines
+# aren't known, i.e. those collected with the Distance Matrix.
 trips_table_create = """
     CREATE TABLE IF NOT EXISTS
       trips (
-        trip_id SERIAL PRIMARY KEY,
+        trip_id SERIAL,
+        route_id SMALLINT NOT NULL REFERENCES routes,
         departure_ts BIGINT NOT NULL,
-        start_location_id CHAR(1) NOT NULL,
-        duration INT NOT NULL,
-        num_steps SMALLINT NOT NULL
+        start_location_id SMALLINT NOT NULL REFERENCES locations,
+        duration SMALLINT NOT NULL,
+        num_steps SMALLINT NOT NULL,
+        signature_id SMALLINT REFERENCES route_signatures,
+        PRIMARY KEY(route_id, trip_id)
       )
+    PARTITION BY LIST (route_id)
+"""
+
+# Created on every partition, so trips of a route after a departure, as the
+# app and stream.py look them up, are found without scanning the route
+trips_departure_index_create = """
+    CREATE INDEX IF NOT EXISTS
+      trips_route_departure_idx
+    ON
+      trips (route_id, departure_ts)
 """
 
 locations_table_create = """
     CREATE TABLE IF NOT EXISTS
       locations (
-        location_id CHAR(1) PRIMARY KEY,
-        latitude NUMERIC NOT NULL,
-        longitude NUMERIC NOT NULL
+        location_id SMALLSERIAL PRIMARY KEY,
+        location_code VARCHAR(8) NOT NULL UNIQUE,
+        latitude DOUBLE PRECISION NOT NULL,
+        longitude DOUBLE PRECISION NOT NULL
       )
 """
 
@@ -39,12 +64,12 @@ time_table_create = """
     CREATE TABLE IF NOT EXISTS
       time (
         departure_ts BIGINT NOT NULL,
-        minute INT,
-        hour INT,
-        day INT,
-        week_of_year INT,
-        month INT,
-        year INT,
+        minute SMALLINT,
+        hour SMALLINT,
+        day SMALLINT,
+        week_of_year SMALLINT,
+        month SMALLINT,
+        year SMALLINT,
         is_weekday BOOLEAN,
         PRIMARY KEY(departure_ts)
       )
@@ -53,11 +78,124 @@ time_table_create = """
 steps_table_create = """
     CREATE TABLE IF NOT EXISTS
       steps (
+        route_id SMALLINT NOT NULL,
         departure_ts BIGINT NOT NULL,
-        start_location_id CHAR(1) NOT NULL,
         step_num SMALLINT,
         line_name VARCHAR(5),
-        PRIMARY KEY(departure_ts, start_location_id, step_num)
+        PRIMARY KEY(route_id, departure_ts, step_num)
+      )
+    PARTITION BY LIST (route_id)
+"""
+
+trips_partition_create = """
+    CREATE TABLE IF NOT EXISTS
+      trips_route_{0}
+    PARTITION OF
+      trips
+    FOR VALUES IN ({0})
+"""
+
+steps_partition_create = """
+    CREATE TABLE IF NOT EXISTS
+      steps_route_{0}
+    PARTITION OF
+      steps
+    FOR VALUES IN ({0})
+"""
+
+# One row per origin, destination and travel mode collected. route_code is
+# the name used in data/ and the app, e.g. 'A'. destination_id is NULL for
+# trips collected before routes existed, whose files did not record it.
+routes_table_create = """
+    CREATE TABLE IF NOT EXISTS
+      routes (
+        route_id SMALLSERIAL PRIMARY KEY,
+        route_code VARCHAR(16) NOT NULL UNIQUE,
+        origin_id SMALLINT NOT NULL REFERENCES locations,
+        destination_id SMALLINT REFERENCES locations,
+        mode VARCHAR(16) NOT NULL
+      )
+"""
+
+# Dictionary of distinct line sequences, e.g. 'L>G>E'. Trips store the
+# integer id so route choice can be grouped without touching steps.
+route_signatures_table_create = """
+    CREATE TABLE IF NOT EXISTS
+      route_signatures (
+        signature_id SMALLSERIAL PRIMARY KEY,
+        signature VARCHAR(255) NOT NULL UNIQUE,
+        num_steps SMALLINT NOT NULL
+      )
+"""
+
+# One row per completed ETL run. The app compares load_token with the one
+# recorded in its snapshot to tell whether the snapshot is stale.
+loads_table_create = """
+    CREATE TABLE IF NOT EXISTS
+      loads (
+        load_id SERIAL PRIMARY KEY,
+        load_token UUID NOT NULL,
+        loaded_at TIMESTAMP NOT NULL DEFAULT now(),
+        num_files INT NOT NULL
+      )
+"""
+
+# Mergeable DDSketch of trip duration (see src/common/sketches.py) for each
+# route and hour of the week (0 = Monday 00:00).
+duration_sketches_table_create = """
+    CREATE TABLE IF NOT EXISTS
+      duration_sketches (
+        route_id SMALLINT NOT NULL REFERENCES routes,
+        hour_of_week SMALLINT NOT NULL,
+        num_trips INT NOT NULL,
+        sketch JSONB NOT NULL,
+        PRIMARY KEY(route_id, hour_of_week)
+      )
+"""
+
+# Trip duration percentiles for each route, ISO weekday and
+# 5-minute departure slot of the day (0 = 00:00-00:04, 287 = 23:55-23:59).
+# Rebuilt from trips by every ETL run; read by the app's /api/departures.
+departure_slots_table_create = """
+    CREATE TABLE IF NOT EXISTS
+      departure_slots (
+        route_id SMALLINT NOT NULL REFERENCES routes,
+        day SMALLINT NOT NULL,
+        slot SMALLINT NOT NULL,
+        num_trips INT NOT NULL,
+        p50 REAL NOT NULL,
+        p90 REAL NOT NULL,
+        PRIMARY KEY(route_id, day, slot)
+      )
+"""
+
+# State of the disruption detector (see disruptions.py) for each route as of
+# its last trip loaded, so the next load carries on where this one stopped.
+disruption_baselines_table_create = """
+    CREATE TABLE IF NOT EXISTS
+      disruption_baselines (
+        route_id SMALLINT PRIMARY KEY REFERENCES routes,
+        state JSONB NOT NULL
+      )
+"""
+
+# Disruptions flagged by disruptions.py: 'slow' or 'detour', from the trip
+# that opened them to the one that closed them, ended_ts being NULL while
+# they last. duration and expected are of the worst trip, in minutes.
+disruptions_table_create = """
+    CREATE TABLE IF NOT EXISTS
+      disruptions (
+        route_id SMALLINT NOT NULL REFERENCES routes,
+        kind VARCHAR(8) NOT NULL,
+        started_ts BIGINT NOT NULL,
+        ended_ts BIGINT,
+        num_trips INT NOT NULL,
+        peak_ts BIGINT NOT NULL,
+        peak_score REAL NOT NULL,
+        duration SMALLINT NOT NULL,
+        expected REAL,
+        signature VARCHAR(255) NOT NULL,
+        PRIMARY KEY(route_id, kind, started_ts)
       )
 """
 
@@ -68,24 +206,28 @@ trips_table_insert = """
       trips (
         trip_id,
         departure_ts,
+        route_id,
         start_location_id,
         duration,
-        num_steps
+        num_steps,
+        signature_id
       )
     VALUES
-      (DEFAULT, %s, %s, %s, %s)
+      (DEFAULT, %s, %s, %s, %s, %s, %s)
 """
 
 locations_table_insert = """
     INSERT INTO
       locations (
-        location_id,
+        location_code,
         latitude,
         longitude
       )
     VALUES
       (%s, %s, %s)
-    ON CONFLICT DO NOTHING
+    ON CONFLICT (location_code) DO NOTHING
+    RETURNING
+      location_id
 """
 
 time_table_insert = """
@@ -109,7 +251,7 @@ steps_table_insert = """
     INSERT INTO
       steps (
         departure_ts,
-        start_location_id,
+        route_id,
         step_num,
         line_name
       )
@@ -117,41 +259,688 @@ steps_table_insert = """
       (%s, %s, %s, %s)
 """
 
+route_signatures_table_insert = """
+    INSERT INTO
+      route_signatures (
+        signature,
+        num_steps
+      )
+    VALUES
+      (%s, %s)
+    ON CONFLICT (signature) DO NOTHING
+    RETURNING
+      signature_id
+"""
+
+routes_table_insert = """
+    INSERT INTO
+      routes (
+        route_code,
+        origin_id,
+        destination_id,
+        mode
+      )
+    VALUES
+      (%s, %s, %s, %s)
+    ON CONFLICT (route_code) DO NOTHING
+    RETURNING
+      route_id
+"""
+
+loads_table_insert = """
+    INSERT INTO
+      loads (
+        load_token,
+        num_files
+      )
+    VALUES
+      (%s, %s)
+"""
+
+duration_sketches_table_upsert = """
+    INSERT INTO
+      duration_sketches (
+        route_id,
+        hour_of_week,
+        num_trips,
+        sketch
+      )
+    VALUES
+      (%s, %s, %s, %s)
+    ON CONFLICT (route_id, hour_of_week) DO UPDATE SET
+      num_trips = EXCLUDED.num_trips,
+      sketch = EXCLUDED.sketch
+"""
+
+disruption_baselines_table_upsert = """
+    INSERT INTO
+      disruption_baselines (
+        route_id,
+        state
+      )
+    VALUES
+      (%s, %s)
+    ON CONFLICT (route_id) DO UPDATE SET
+      state = EXCLUDED.state
+"""
+
+disruptions_table_upsert = """
+    INSERT INTO
+      disruptions (
+        route_id,
+        kind,
+        started_ts,
+        ended_ts,
+        num_trips,
+        peak_ts,
+        peak_score,
+        duration,
+        expected,
+        signature
+      )
+    VALUES
+      (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (route_id, kind, started_ts) DO UPDATE SET
+      ended_ts = EXCLUDED.ended_ts,
+      num_trips = EXCLUDED.num_trips,
+      peak_ts = EXCLUDED.peak_ts,
+      peak_score = EXCLUDED.peak_score,
+      duration = EXCLUDED.duration,
+      expected = EXCLUDED.expected,
+      signature = EXCLUDED.signature
+"""
+
+departure_slots_delete = "DELETE FROM departure_slots"
+
+departure_slots_refresh = """
+    INSERT INTO
+      departure_slots (
+        route_id,
+        day,
+        slot,
+        num_trips,
+        p50,
+        p90
+      )
+    SELECT
+      trips.route_id,
+      time.day,
+      (time.hour * 60 + time.minute) / 5 AS slot,
+      COUNT(*),
+      PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY trips.duration),
+      PERCENTILE_CONT(0.9) WITHIN GROUP (ORDER BY trips.duration)
+    FROM
+      trips
+    JOIN
+      time
+    USING
+      (departure_ts)
+    GROUP BY
+      1, 2, 3
+"""
+
+# Before routes existed, the collector only ever made the trips A to B and
+# B to A, so those routes' missing destinations are known
+legacy_routes_backfill = """
+    UPDATE
+      routes
+    SET
+      destination_id = locations.location_id
+    FROM
+      locations
+    WHERE
+      routes.destination_id IS NULL
+      AND routes.route_code IN ('A', 'B')
+      AND locations.location_code = CASE routes.route_code WHEN 'A' THEN 'B' ELSE 'A' END
+"""
+
+### SELECT QUERIES ###
+
+location_select = """
+    SELECT
+      location_id
+    FROM
+      locations
+    WHERE
+      location_code = %s
+"""
+
+route_signature_select = """
+    SELECT
+      signature_id
+    FROM
+      route_signatures
+    WHERE
+      signature = %s
+"""
+
+route_select = """
+    SELECT
+      route_id
+    FROM
+      routes
+    WHERE
+      route_code = %s
+"""
+
+duration_sketch_select = """
+    SELECT
+      sketch
+    FROM
+      duration_sketches
+    WHERE
+      route_id = %s
+      AND hour_of_week = %s
+    FOR UPDATE
+"""
+
+disruption_baseline_select = """
+    SELECT
+      state
+    FROM
+      disruption_baselines
+    WHERE
+      route_id = %s
+    FOR UPDATE
+"""
+
+# Departures of a route already loaded, among those about to be streamed in
+# (see stream.py), so a spool flushed twice doesn't load its trips twice
+loaded_departures_select = """
+    SELECT
+      departure_ts
+    FROM
+      trips
+    WHERE
+      route_id = %s
+      AND departure_ts = ANY(%s)
+"""
+
+### STREAMING ###
+
+# Sent by stream.py in the transaction that loads trips, so listeners hear
+# of them as soon as they are committed
+trips_loaded_notify = """
+    SELECT pg_notify(%s, %s)
+"""
+
 ### QUERIES FOR APP ###
 
+# Routes and locations are exposed by their codes ('A', 'B', ...) so the app
+# does not need to know about the integer keys.
 trips_time_create = """
     CREATE OR REPLACE VIEW
       trips_time
     AS
     SELECT
-      *
+      trips.departure_ts,
+      trips.trip_id,
+      routes.route_code AS route_id,
+      locations.location_code AS start_location_id,
+      trips.duration,
+      trips.num_steps,
+      trips.signature_id,
+      time.minute,
+      time.hour,
+      time.day,
+      time.week_of_year,
+      time.month,
+      time.year,
+      time.is_weekday
     FROM
       trips
     JOIN
       time
     USING
       (departure_ts)
+    JOIN
+      locations
+    ON
+      locations.location_id = trips.start_location_id
+    JOIN
+      routes
+    ON
+      routes.route_id = trips.route_id
 """
 
+trips_time_drop = "DROP VIEW IF EXISTS trips_time"
+
 ### QUERY LISTS ###
 
 drop_table_queries = [
+    trips_time_drop,
+    duration_sketches_table_drop,
+    departure_slots_table_drop,
+    disruption_baselines_table_drop,
+    disruptions_table_drop,
     trips_table_drop,
+    steps_table_drop,
+    routes_table_drop,
     locations_table_drop,
     time_table_drop,
-    steps_table_drop
+    route_signatures_table_drop,
+    loads_table_drop
 ]
 
 create_table_queries = [
     time_table_create,
     locations_table_create,
+    routes_table_create,
+    route_signatures_table_create,
     trips_table_create,
-    steps_table_create
+    trips_departure_index_create,
+    steps_table_create,
+    loads_table_create,
+    duration_sketches_table_create,
+    departure_slots_table_create,
+    disruption_baselines_table_create,
+    disruptions_table_create
 ]
 
 insert_table_queries = [
     time_table_insert,
     locations_table_insert,
     trips_table_insert,
-    steps_table_insert
+    steps_table_insert,
+    route_signatures_table_insert,
+    routes_table_insert
+]
+
+
+### BLUE/GREEN RELOADS ###
+
+# A blue/green reload builds everything in shadow_schema while live_schema
+# keeps serving, then renames one over the other in a single transaction.
+live_schema = 'live'
+shadow_schema = 'next'
+retired_schema = 'retired'
+
+database_exists_select = """
+    SELECT
+      1
+    FROM
+      pg_database
+    WHERE
+      datname = %s
+"""
+
+schema_exists_select = """
+    SELECT
+      1
+    FROM
+      information_schema.schemata
+    WHERE
+      schema_name = %s
+"""
+
+schema_drop = "DROP SCHEMA IF EXISTS {} CASCADE"
+schema_create = "CREATE SCHEMA {}"
+search_path_set = "SET search_path TO {}"
+
+# Count of every table in the schema on the search_path
+row_counts_select = """
+    SELECT
+      (SELECT COUNT(*) FROM trips) AS trips,
+      (SELECT COUNT(*) FROM time) AS time,
+      (SELECT COUNT(*) FROM locations) AS locations,
+      (SELECT COUNT(*) FROM routes) AS routes,
+      (SELECT COUNT(*) FROM steps) AS steps,
+      (SELECT COUNT(*) FROM route_signatures) AS route_signatures
+"""
+
+# Number of trips currently served, from live_schema or, before the first
+# blue/green reload, the public schema
+live_trips_count_select = """
+    SELECT
+      COUNT(*)
+    FROM
+      {}.trips
+"""
+
+schema_rename = "ALTER SCHEMA {} RENAME TO {}"
+
+# Only the live schema, so a table or view missing from it is an error rather
+# than read from a stale copy elsewhere
+database_search_path_set = "ALTER DATABASE google_maps SET search_path = {}"
+
+# Tables and views a database loaded before its first blue/green reload has
+# in the public schema, leaving out those of extensions. Partitions are
+# listed on their own, as moving a parent leaves them behind.
+public_relations_select = """
+    SELECT
+      pg_class.relname,
+      CASE pg_class.relkind
+        WHEN 'v' THEN 'VIEW'
+        WHEN 'm' THEN 'MATERIALIZED VIEW'
+        ELSE 'TABLE'
+      END
+    FROM
+      pg_class
+    JOIN
+      pg_namespace
+    ON
+      pg_namespace.oid = pg_class.relnamespace
+    WHERE
+      pg_namespace.nspname = 'public'
+      AND pg_class.relkind IN ('r', 'p', 'v', 'm')
+      AND NOT EXISTS (
+        SELECT
+          1
+        FROM
+          pg_depend
+        WHERE
+          pg_depend.objid = pg_class.oid
+          AND pg_depend.deptype = 'e'
+      )
+    ORDER BY
+      pg_class.relname
+"""
+
+relation_move = "ALTER {} public.{} SET SCHEMA {}"
+
+### MIGRATIONS ###
+
+# Moves a database created before compact column types were introduced to the
+# current schema in place. Run by migrate.py inside a single transaction.
+compact_types_migration = [
+    trips_time_drop,
+
+    # Databases loaded before route signatures existed get them backfilled
+    # from steps, while steps are still keyed on the old location code
+    route_signatures_table_create,
+    "ALTER TABLE trips ADD COLUMN IF NOT EXISTS signature_id INT",
+    """
+    WITH trip_signatures AS (
+      SELECT
+        trips.trip_id,
+        COALESCE(string_agg(steps.line_name, '>' ORDER BY steps.step_num), '') AS signature,
+        COUNT(steps.step_num) AS num_steps
+      FROM
+        trips
+      LEFT JOIN
+        steps
+      ON
+        steps.departure_ts = trips.departure_ts
+        AND steps.start_location_id = trips.start_location_id
+      WHERE
+        trips.signature_id IS NULL
+      GROUP BY
+        trips.trip_id
+    )
+    INSERT INTO
+      route_signatures (signature, num_steps)
+    SELECT DISTINCT
+      signature, num_steps
+    FROM
+      trip_signatures
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    UPDATE trips
+    SET signature_id = route_signatures.signature_id
+    FROM (
+      SELECT
+        trips.trip_id,
+        COALESCE(string_agg(steps.line_name, '>' ORDER BY steps.step_num), '') AS signature
+      FROM
+        trips
+      LEFT JOIN
+        steps
+      ON
+        steps.departure_ts = trips.departure_ts
+        AND steps.start_location_id = trips.start_location_id
+      WHERE
+        trips.signature_id IS NULL
+      GROUP BY
+        trips.trip_id
+    ) AS trip_signatures
+    JOIN route_signatures USING (signature)
+    WHERE trips.trip_id = trip_signatures.trip_id
+    """,
+
+    # Calendar fields never exceed a few thousand
+    """
+    ALTER TABLE time
+      ALTER COLUMN minute TYPE SMALLINT,
+      ALTER COLUMN hour TYPE SMALLINT,
+      ALTER COLUMN day TYPE SMALLINT,
+      ALTER COLUMN week_of_year TYPE SMALLINT,
+      ALTER COLUMN month TYPE SMALLINT,
+      ALTER COLUMN year TYPE SMALLINT
+    """,
+
+    # Re-key locations on a SMALLSERIAL, keeping the old 'A'/'B' as a code
+    """
+    ALTER TABLE locations
+      ALTER COLUMN latitude TYPE DOUBLE PRECISION,
+      ALTER COLUMN longitude TYPE DOUBLE PRECISION
+    """,
+    "ALTER TABLE locations RENAME COLUMN location_id TO location_code",
+    "ALTER TABLE locations ALTER COLUMN location_code TYPE VARCHAR(8)",
+    "ALTER TABLE locations DROP CONSTRAINT locations_pkey",
+    "ALTER TABLE locations ADD COLUMN location_id SMALLSERIAL PRIMARY KEY",
+    "ALTER TABLE locations ADD CONSTRAINT locations_location_code_key UNIQUE (location_code)",
+
+    # Point trips at the new location keys
+    "ALTER TABLE trips ADD COLUMN location_id SMALLINT",
+    """
+    UPDATE trips
+    SET location_id = locations.location_id
+    FROM locations
+    WHERE locations.location_code = trips.start_location_id
+    """,
+    "ALTER TABLE trips DROP COLUMN start_location_id",
+    "ALTER TABLE trips RENAME COLUMN location_id TO start_location_id",
+    """
+    ALTER TABLE trips
+      ALTER COLUMN start_location_id SET NOT NULL,
+      ALTER COLUMN duration TYPE SMALLINT,
+      ALTER COLUMN signature_id TYPE SMALLINT,
+      ALTER COLUMN signature_id SET NOT NULL,
+      ADD FOREIGN KEY (start_location_id) REFERENCES locations
+    """,
+
+    # Route signatures fit in a SMALLINT id
+    "ALTER TABLE route_signatures ALTER COLUMN signature_id TYPE SMALLINT",
+    "ALTER SEQUENCE route_signatures_signature_id_seq AS SMALLINT",
+    "ALTER TABLE trips ADD FOREIGN KEY (signature_id) REFERENCES route_signatures",
+
+    # Same for steps, whose primary key includes the location
+    "ALTER TABLE steps ADD COLUMN location_id SMALLINT",
+    """
+    UPDATE steps
+    SET location_id = locations.location_id
+    FROM locations
+    WHERE locations.location_code = steps.start_location_id
+    """,
+    "ALTER TABLE steps DROP CONSTRAINT steps_pkey",
+    "ALTER TABLE steps DROP COLUMN start_location_id",
+    "ALTER TABLE steps RENAME COLUMN location_id TO start_location_id",
+    """
+    ALTER TABLE steps
+      ALTER COLUMN start_location_id SET NOT NULL,
+      ADD PRIMARY KEY (departure_ts, start_location_id, step_num)
+    """,
 ]
+
+# Moves a database from before routes, e.g. one compact_types_migration
+# just converted, to routes, with trips and steps partitioned by route.
+# Every trip then was by transit, on the route named after its starting
+# location, as etl.transform_route() loads them. migrate.py runs the first
+# part, creates each route's partitions, then runs routes_backfill, all in
+# the same transaction.
+routes_migration = [
+    trips_time_drop,
+    routes_table_create,
+    """
+    INSERT INTO
+      routes (route_code, origin_id, destination_id, mode)
+    SELECT DISTINCT
+      locations.location_code,
+      locations.location_id,
+      NULL::SMALLINT,
+      'transit'
+    FROM
+      trips
+    JOIN
+      locations
+    ON
+      locations.location_id = trips.start_location_id
+    ON CONFLICT (route_code) DO NOTHING
+    """,
+    legacy_routes_backfill,
+
+    # The old tables make way for the partitioned ones, keys included
+    "ALTER TABLE trips RENAME TO trips_unpartitioned",
+    "ALTER TABLE trips_unpartitioned RENAME CONSTRAINT trips_pkey TO trips_unpartitioned_pkey",
+    "ALTER TABLE steps RENAME TO steps_unpartitioned",
+    "ALTER TABLE steps_unpartitioned RENAME CONSTRAINT steps_pkey TO steps_unpartitioned_pkey",
+    trips_table_create,
+    trips_departure_index_create,
+    steps_table_create,
+]
+
+routes_backfill = [
+    # Trips keep their ids
+    """
+    INSERT INTO
+      trips (trip_id, route_id, departure_ts, start_location_id, duration, num_steps,
+             signature_id)
+    SELECT
+      old.trip_id,
+      routes.route_id,
+      old.departure_ts,
+      old.start_location_id,
+      old.duration,
+      old.num_steps,
+      old.signature_id
+    FROM
+      trips_unpartitioned AS old
+    JOIN
+      locations
+    ON
+      locations.location_id = old.start_location_id
+    JOIN
+      routes
+    ON
+      routes.route_code = locations.location_code
+    """,
+    """
+    SELECT
+      setval(pg_get_serial_sequence('trips', 'trip_id'), COALESCE(MAX(trip_id), 1),
+             MAX(trip_id) IS NOT NULL)
+    FROM
+      trips
+    """,
+    """
+    INSERT INTO
+      steps (route_id, departure_ts, step_num, line_name)
+    SELECT
+      routes.route_id,
+      old.departure_ts,
+      old.step_num,
+      old.line_name
+    FROM
+      steps_unpartitioned AS old
+    JOIN
+      locations
+    ON
+      locations.location_id = old.start_location_id
+    JOIN
+      routes
+    ON
+      routes.route_code = locations.location_code
+    """,
+    "DROP TABLE trips_unpartitioned",
+    "DROP TABLE steps_unpartitioned",
+]
+
+# Distance Matrix trips have no signature. Trips loaded before they were told
+# apart keep the empty one, as their files don't say which they were.
+signature_nullable_migration = "ALTER TABLE trips ALTER COLUMN signature_id DROP NOT NULL"
+
+route_ids_select = """
+    SELECT
+      route_id
+    FROM
+      routes
+    ORDER BY
+      route_id
+"""
+
+# Every trip's route, duration and the start of its time row, in the order
+# of etl.transform_time(), to build duration_sketches for a migrated database
+trip_durations_select = """
+    SELECT
+      trips.route_id,
+      trips.duration,
+      time.departure_ts,
+      time.minute,
+      time.hour,
+      time.day
+    FROM
+      trips
+    JOIN
+      time
+    USING
+      (departure_ts)
+"""
+
+migrated_check = """
+    SELECT
+      1
+    FROM
+      information_schema.columns
+    WHERE
+      table_schema = current_schema()
+      AND table_name = 'locations'
+      AND column_name = 'location_code'
+"""
+
+routes_check = """
+    SELECT
+      1
+    FROM
+      information_schema.tables
+    WHERE
+      table_schema = current_schema()
+      AND table_name = 'routes'
+"""
+
+signature_nullable_check = """
+    SELECT
+      1
+    FROM
+      information_schema.columns
+    WHERE
+      table_schema = current_schema()
+      AND table_name = 'trips'
+      AND column_name = 'signature_id'
+      AND is_nullable = 'YES'
+"""
+
+# On-disk size of every table, including indexes and TOAST. A partitioned
+# table is one row, summing its partitions, so trips and steps compare before
+# and after they were partitioned.
+table_sizes_select = """
+    SELECT
+      pg_class.relname,
+      (
+        SELECT
+          SUM(pg_total_relation_size(tree.relid))
+        FROM
+          pg_partition_tree(pg_class.oid) AS tree
+      )::BIGINT
+    FROM
+      pg_class
+    JOIN
+      pg_namespace
+    ON
+      pg_namespace.oid = pg_class.relnamespace
+    WHERE
+      pg_namespace.nspname = current_schema()
+      AND pg_class.relkind IN ('r', 'p')
+      AND NOT pg_class.relispartition
+    ORDER BY
+      pg_class.relname
+"""
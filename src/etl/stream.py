@@ -0,0 +1,255 @@
+"""
+This module streams the trips data_collection.py collects straight into
+postgres, so they reach the dashboard seconds after they are collected
+rather than after the next etl.py run and app restart.
+
+With --stream, each round's parsed trips are appended to a local spool,
+spool.jsonl in the working directory, and fsynced. The spool is then
+flushed: its trips are loaded in batches, with the same transforms as
+etl.py, in one transaction that also runs them through the disruption
+detector (see disruptions.py), records a load and sends
+
+    NOTIFY trips_loaded, '{"route_ids": ["A"], "min_departure_ts": ..., ...}'
+
+which postgres delivers when the transaction commits. The app LISTENs on
+that channel (see src/app/live.py) and fetches just the new trips.
+
+If postgres can't be reached, the trips stay in the spool and go with the
+next round's. A spool being flushed is first renamed to spool.jsonl.flushing,
+so trips spooled meanwhile aren't lost, and trips already loaded by a flush
+that committed but didn't get to delete its file are skipped. The trip
+files are still written to data/ as before, so etl.py can reload
+everything from them.
+
+Usage:
+    python src/etl/data_collection.py --stream
+    python src/etl/stream.py            # flush the spool by hand
+"""
+
+import json
+import os
+import psycopg2
+from psycopg2.extras import execute_batch
+import etl
+import validation
+from sql_queries import (
+    loaded_departures_select, trips_loaded_notify, trips_table_insert,
+    time_table_insert, steps_table_insert
+)
+
+metrics = etl.metrics
+
+
+spool_file = 'spool.jsonl'
+channel = 'trips_loaded'
+
+# Rows sent to postgres per round trip
+batch_size = 500
+
+
+def spool(trips, path = spool_file):
+    """
+    Appends the parsed `trips` to the spool at `path` as JSON lines and
+    flushes them to disk.
+    """
+    with open(path, 'a') as f:
+        for trip in trips:
+            f.write(json.dumps(trip) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    metrics.inc('stream_spooled_total', len(trips))
+
+
+def read_spool(path):
+    """
+    Returns
+    -------
+    [list] Trips in the spool at `path`, without a last line cut short by a
+    crash while it was written.
+    """
+    trips = []
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                trips.append(json.loads(line))
+            except json.decoder.JSONDecodeError:
+                print('Skipping a torn line in {}'.format(path))
+    return trips
+
+
+def transform(cur, trip):
+    """
+    Returns
+    -------
+    Tuple of the route's id and rows for trips, time and steps, as
+    etl.load_data() builds them. Dimension rows are inserted if new.
+    """
+    location_id = etl.get_location_id(cur, etl.transform_location(trip))
+    end_location_data = etl.transform_end_location(trip)
+    end_location_id = None if end_location_data is None \
+        else etl.get_location_id(cur, end_location_data)
+    route_id = etl.get_route_id(cur, etl.transform_route(trip), location_id, end_location_id)
+    signature_id = etl.get_signature_id(cur, etl.transform_signature(trip))
+
+    return (
+        route_id,
+        etl.transform_trip(trip, route_id, location_id, signature_id),
+        etl.transform_time(trip),
+        etl.transform_steps(trip, route_id)
+    )
+
+
+def load_trips(cur, trips):
+    """
+    Loads `trips` with batched inserts, skipping any that don't match the
+    trip schema, are already loaded or repeat one earlier in `trips`. They
+    are run through the disruption detectors, but not added to the duration
+    sketches: the caller does that with add_to_sketches() once they are
+    committed.
+
+    Returns
+    -------
+    [list] (trip, route_id, time row) of each trip loaded.
+    """
+    # (trip, route_id, trip row, time row, step rows) of each valid trip
+    batch = []
+    for trip in trips:
+        reason = validation.validate_trip(trip)
+        if reason is not None:
+            print('Not streaming a trip of route {}: {}'.format(trip.get('route_id'), reason))
+            metrics.inc('stream_rejects_total')
+            continue
+        batch.append((trip,) + transform(cur, trip))
+
+    # One lookup per route for trips a previous flush committed
+    departures = {}
+    for _, route_id, trip_row, _, _ in batch:
+        departures.setdefault(route_id, []).append(trip_row[0])
+    loaded = set()
+    for route_id, route_departures in departures.items():
+        cur.execute(loaded_departures_select, (route_id, route_departures))
+        loaded.update((route_id, row[0]) for row in cur.fetchall())
+
+    # A trip spooled twice would otherwise hit the steps primary key and
+    # fail every flush of the spool
+    new_batch = []
+    for row in batch:
+        key = (row[1], row[2][0])
+        if key not in loaded:
+            loaded.add(key)
+            new_batch.append(row)
+    batch = new_batch
+
+    with metrics.timer('stream_load', table='trips'):
+        execute_batch(cur, trips_table_insert, [row[2] for row in batch],
+                      page_size = batch_size)
+    with metrics.timer('stream_load', table='time'):
+        execute_batch(cur, time_table_insert, [row[3] for row in batch],
+                      page_size = batch_size)
+    with metrics.timer('stream_load', table='steps'):
+        execute_batch(cur, steps_table_insert, [step for row in batch for step in row[4]],
+                      page_size = batch_size)
+
+    for trip, route_id, _, time_row, _ in batch:
+        etl.detect_disruptions(cur, route_id, time_row, trip['duration'],
+                               etl.transform_signature(trip))
+
+    return [(trip, route_id, time_row) for trip, route_id, _, time_row, _ in batch]
+
+
+def add_to_sketches(loaded):
+    """
+    Adds the trips of a committed flush, as returned by load_trips(), to
+    this process's duration sketches.
+    """
+    for trip, route_id, time_row in loaded:
+        etl.add_to_sketch(route_id, time_row, trip['duration'])
+
+
+def notification(trips, load_token):
+    """
+    Returns
+    -------
+    [str] JSON payload of the notification for `trips`: their routes and
+    range of departures, and the load they were recorded as.
+    """
+    departures = [trip['departure_time'] for trip in trips]
+    return json.dumps({
+        'route_ids': sorted(set(etl.transform_route(trip)[0] for trip in trips)),
+        'min_departure_ts': min(departures),
+        'max_departure_ts': max(departures),
+        'num_trips': len(trips),
+        'load_token': load_token,
+    })
+
+
+def flush(path = spool_file):
+    """
+    Loads every trip in the spool at `path` into postgres in one
+    transaction and notifies listeners once it commits. If postgres can't
+    be reached the trips are kept for the next flush.
+
+    Returns
+    -------
+    [int] Number of trips loaded.
+    """
+    flushing = path + '.flushing'
+    if os.path.exists(path):
+        if os.path.exists(flushing):
+            # Trips left by a failed flush go first
+            with open(path, 'r') as new, open(flushing, 'a') as old:
+                old.write(new.read())
+            os.remove(path)
+        else:
+            os.replace(path, flushing)
+    if not os.path.exists(flushing):
+        return 0
+
+    try:
+        conn = psycopg2.connect(
+            host = '127.0.0.1',
+            dbname = 'google_maps',
+            user = 'google_user',
+            password = 'passw0rd',
+        )
+    except psycopg2.OperationalError as e:
+        print('Could not stream trips, keeping them spooled: {}'.format(str(e).strip()))
+        metrics.inc('stream_flushes_total', status='unreachable')
+        return 0
+
+    trips = read_spool(flushing)
+    cur = conn.cursor()
+    try:
+        with metrics.timer('stream_flush'):
+            with conn:
+                loaded = load_trips(cur, trips)
+                if loaded:
+                    etl.save_disruptions(cur)
+                    load_token = etl.record_load(cur, len(loaded))
+                    cur.execute(trips_loaded_notify, (
+                        channel, notification([row[0] for row in loaded], load_token)
+                    ))
+            if loaded:
+                add_to_sketches(loaded)
+                etl.save_sketches(conn)
+    except psycopg2.Error as e:
+        # Ids cached in the rolled back transaction may not exist, and the
+        # detectors have seen trips that weren't loaded. The sketches only
+        # get trips once they are committed, so they are kept.
+        for cache in [etl.location_ids, etl.route_ids, etl.signature_ids,
+                      etl.detectors, etl.pending_disruptions]:
+            cache.clear()
+        print('Could not stream trips, keeping them spooled: {}'.format(str(e).strip()))
+        metrics.inc('stream_flushes_total', status='failed')
+        conn.close()
+        return 0
+
+    conn.close()
+    os.remove(flushing)
+    metrics.inc('stream_flushes_total', status='loaded')
+    metrics.inc('stream_trips_total', len(loaded))
+    return len(loaded)
+
+
+if __name__ == '__main__':
+    print('{} trips streamed'.format(flush()))
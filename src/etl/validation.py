@@ -0,0 +1,261 @@
+"""
+This module checks trip records before etl.py loads them, and quarantines
+the files it can't load.
+
+The trip schema is compiled once, at import, into the source of a single
+Python function with every field's type test and bounds inlined, so
+checking a record is a handful of dict lookups and comparisons. Records that
+fail come back with the first problem found, e.g.
+
+    'steps[].line_name: longer than 5 characters'
+
+Any file etl.py rejects (invalid JSON, a schema problem, an error from
+postgres) is copied into a folder for the run under dead_letter/, and its
+reason is appended to that folder's rejects.jsonl. The files in data/ are
+left alone, so a fixed file can simply be loaded again. etl.py prints a
+summary of the rejects at the end of each run.
+"""
+
+from collections import Counter
+from datetime import datetime
+import json
+import os
+import shutil
+
+
+dead_letter_folder = 'dead_letter'
+
+# Python types of each schema type; JSON numbers load as int or float
+kinds = {
+    'int': (int,),
+    'number': (int, float),
+    'str': (str,),
+    'list': (list,),
+    'object': (dict,),
+}
+
+
+class ValidationError(ValueError):
+    """
+    A record that does not match the trip schema.
+    """
+
+
+coordinates = {
+    'type': 'object',
+    'fields': {
+        'lat': {'type': 'number', 'min': -90, 'max': 90},
+        'lng': {'type': 'number', 'min': -180, 'max': 180},
+    },
+}
+
+# Lengths and ranges are those of the columns the fields are loaded into
+step_schema = {
+    'type': 'object',
+    'fields': {
+        'step': {'type': 'int', 'min': 1, 'max': 32767},
+        'line_name': {'type': 'str', 'max_length': 5},
+        'distance': {'type': 'number', 'optional': True},
+        'html_instructions': {'type': 'str', 'optional': True},
+    },
+}
+
+trip_schema = {
+    'type': 'object',
+    'fields': {
+        'start_location': coordinates,
+        'start_location_id': {'type': 'str', 'max_length': 8},
+        'departure_time': {'type': 'int', 'min': 0},
+        'arrival_time': {'type': 'int', 'min': 0},
+        'duration': {'type': 'int', 'min': 0, 'max': 32767},
+        'steps': {'type': 'list', 'items': step_schema},
+        # Written since routes were added (data_collection.route_fields())
+        'route_id': {'type': 'str', 'max_length': 8, 'optional': True},
+        'end_location_id': {'type': 'str', 'max_length': 8, 'optional': True},
+        'end_location': dict(coordinates, optional = True),
+        'mode': {'type': 'str', 'optional': True},
+        # Trips without step detail (data_collection.parse_matrix_element())
+        'source': {'type': 'str', 'optional': True},
+        # Runs of repeated trips (dedup.py)
+        'repeats': {
+            'type': 'list',
+            'optional': True,
+            'items': {'type': 'list', 'length': 2, 'items': {'type': 'int'}},
+        },
+    },
+}
+
+
+def schema_lines(schema, var, path, depth, lines):
+    """
+    Helper for compile_schema()
+
+    Appends to `lines` the Python source that returns the reason the value
+    in the variable `var` doesn't match `schema`, or falls through if it
+    does.
+    """
+    indent = '    ' * depth
+    kind = schema['type']
+
+    def fail(condition, reason):
+        lines.append('{}if {}:'.format(indent, condition))
+        lines.append('{}    return {}'.format(indent, reason))
+
+    # type() rather than isinstance() so booleans aren't taken for ints
+    types = kinds[kind]
+    if len(types) == 1:
+        condition = 'type({}) is not {}'.format(var, types[0].__name__)
+    else:
+        condition = 'type({}) not in ({})'.format(var, ', '.join(t.__name__ for t in types))
+    expected = '{}: expected {}, got '.format(path or 'record', kind)
+    fail(condition, '{!r} + type({}).__name__'.format(expected, var))
+
+    if 'min' in schema:
+        fail('{} < {!r}'.format(var, schema['min']),
+             repr('{}: less than {}'.format(path, schema['min'])))
+    if 'max' in schema:
+        fail('{} > {!r}'.format(var, schema['max']),
+             repr('{}: more than {}'.format(path, schema['max'])))
+    if 'max_length' in schema:
+        fail('len({}) > {!r}'.format(var, schema['max_length']),
+             repr('{}: longer than {} characters'.format(path, schema['max_length'])))
+    if 'length' in schema:
+        fail('len({}) != {!r}'.format(var, schema['length']),
+             repr('{}: not {} items'.format(path, schema['length'])))
+
+    if 'items' in schema:
+        item = 'v{}'.format(depth + 1)
+        lines.append('{}for {} in {}:'.format(indent, item, var))
+        schema_lines(schema['items'], item, path + '[]', depth + 1, lines)
+
+    for name, spec in schema.get('fields', {}).items():
+        field_path = path + '.' + name if path else name
+        field = 'v{}'.format(depth + 1)
+        lines.append('{}if {!r} in {}:'.format(indent, name, var))
+        lines.append('{}    {} = {}[{!r}]'.format(indent, field, var, name))
+        schema_lines(spec, field, field_path, depth + 1, lines)
+        if not spec.get('optional', False):
+            lines.append('{}else:'.format(indent))
+            lines.append('{}    return {!r}'.format(indent, field_path + ': missing'))
+
+
+def compile_schema(schema):
+    """
+    Returns
+    -------
+    Function of a value that returns None if it matches `schema`, or else
+    the reason it doesn't, prefixed with its path in the record. The checks
+    are generated as the source of one flat function and compiled, so no
+    time goes on walking the schema.
+
+    Parameters
+    ----------
+    schema: [dict] With a 'type' from `kinds` and optionally 'min', 'max'
+    (numbers), 'max_length' (strings), 'length' and 'items' (lists), and
+    'fields' (objects), each field a schema that may be 'optional'.
+    """
+    lines = ['def check(v1):']
+    schema_lines(schema, 'v1', '', 1, lines)
+    lines.append('    return None')
+
+    namespace = {}
+    exec(compile('\n'.join(lines), '<schema>', 'exec'), namespace)
+    return namespace['check']
+
+
+check_trip = compile_schema(trip_schema)
+
+
+def validate_trip(data):
+    """
+    Returns
+    -------
+    [str] The first reason the trip record `data` can't be loaded, or None
+    if it can.
+    """
+    reason = check_trip(data)
+    if reason is None and 'end_location_id' in data and 'end_location' not in data:
+        reason = 'end_location: missing'
+    return reason
+
+
+def run_folder(started_at, folder = dead_letter_folder):
+    """
+    Returns
+    -------
+    [str] Folder the files rejected by the run started at `started_at` are
+    copied to. It is only created once something is rejected.
+    """
+    return os.path.join(folder, started_at.strftime('%Y-%m-%d_%H-%M-%S'))
+
+
+def quarantine(filepath, stage, reason, folder):
+    """
+    Copies the file at `filepath` into `folder`, under its route
+    subdirectory, and records why it was rejected in folder/rejects.jsonl.
+
+    Returns
+    -------
+    [dict] The record written to rejects.jsonl.
+
+    Parameters
+    ----------
+    stage: [str] Where the file failed: 'json', 'schema', 'transform' or
+    'database'.
+
+    reason: [str] What was wrong with it.
+    """
+    sub_dir = os.path.basename(os.path.dirname(filepath))
+    os.makedirs(os.path.join(folder, sub_dir), exist_ok = True)
+    dest = os.path.join(folder, sub_dir, os.path.basename(filepath))
+    shutil.copyfile(filepath, dest)
+
+    reject = {
+        'file': filepath,
+        'copy': dest,
+        'stage': stage,
+        'reason': reason,
+        'rejected_at': datetime.now().isoformat(timespec = 'seconds'),
+    }
+    with open(os.path.join(folder, 'rejects.jsonl'), 'a') as f:
+        f.write(json.dumps(reject) + '\n')
+    return reject
+
+
+def summarize(rejects, num_files, folder, top_n = 5):
+    """
+    Prints how many files were rejected at each stage and the most common
+    reasons, and writes the same to folder/summary.json if any were.
+
+    Returns
+    -------
+    [dict] The summary.
+
+    Parameters
+    ----------
+    rejects: [list] Records returned by quarantine().
+
+    num_files: [int] Number of files the run read.
+    """
+    by_stage = Counter(reject['stage'] for reject in rejects)
+    by_reason = Counter(reject['reason'] for reject in rejects)
+    summary = {
+        'num_files': num_files,
+        'num_rejected': len(rejects),
+        'by_stage': dict(by_stage),
+        'top_reasons': by_reason.most_common(top_n),
+    }
+
+    if not rejects:
+        print('No files rejected')
+        return summary
+
+    print('{} of {} files rejected and copied to {}'.format(len(rejects), num_files, folder))
+    for stage, count in by_stage.most_common():
+        print('  {:<10}{:>8}'.format(stage, count))
+    for reason, count in summary['top_reasons']:
+        print('  {:>8}  {}'.format(count, reason))
+
+    with open(os.path.join(folder, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent = 2)
+    return summary